@@ -26,11 +26,14 @@ import os
 import sys
 from app.utils import DatabaseHandler
 from app.utils import CacheHandler
+from app.utils import PluginRegistry
+from app.utils import LogHandler
 from app.celery_schedule import build_plugin_beat_schedule
 from app.celery_scheduler import get_beat_refresh_interval
 from app.runtime_restart import start_runtime_restart_monitor
 from app.api.system.services import update_option, clear_cache
 from app.utils import SkillManager
+from app.utils.functions import STATS_REFRESH_INTERVAL
 
 # leer variables de entorno desde el archivo .env
 from dotenv import load_dotenv
@@ -58,6 +61,14 @@ def get_translation_directories():
 def create_app(config_class=config[os.environ['FLASK_ENV']]):
     from app.api.system.services import set_system_setting
     set_system_setting()
+    from app.api.resources.services import create_tree_indexes
+    create_tree_indexes()
+    from app.api.logs.services import create_log_indexes
+    create_log_indexes()
+    from app.api.tasks.services import create_task_indexes
+    create_task_indexes()
+    from app.utils.functions import create_transcription_indexes
+    create_transcription_indexes()
     SkillManager.SkillManager().start()
     
     app = Flask(__name__)
@@ -130,6 +141,7 @@ def create_app(config_class=config[os.environ['FLASK_ENV']]):
     plugins = mongodb.get_record('system', {'name': 'active_plugins'})
     for p in plugins['data']:
         register_plugin(app, p, p)
+    PluginRegistry.PluginRegistry().load(plugins['data'])
 
     # Registrar users blueprint
     from app.api.users import bp as users_bp
@@ -282,6 +294,13 @@ def celery_init_app(app: Flask) -> Celery:
             with app.app_context():
                 return self.run(*args, **kwargs)
 
+        # el progreso que reportan las tareas también se publica a los clientes que escuchan sus eventos
+        def update_state(self, task_id=None, state=None, meta=None, **kwargs):
+            super().update_state(task_id=task_id, state=state, meta=meta, **kwargs)
+            if state == 'PROGRESS':
+                from app.api.tasks.services import task_progress
+                task_progress(task_id or self.request.id, meta)
+
     celery_app = Celery(app.name, task_cls=FlaskTask)
     celery_app.config_from_object(app.config["CELERY"])
     celery_app.conf.enable_utc = False
@@ -307,6 +326,15 @@ def celery_init_app(app: Flask) -> Celery:
 
     celery_app.conf.update(**celery_config)
     celery_app.conf.beat_schedule = build_plugin_beat_schedule(mongodb)
+    if LogHandler.LOG_SPOOL == 'redis':
+        celery_app.conf.beat_schedule['logs.drain_spool'] = {
+            'task': 'logs.drain_spool',
+            'schedule': LogHandler.LOG_FLUSH_INTERVAL,
+        }
+    celery_app.conf.beat_schedule['views.refresh_stats'] = {
+        'task': 'views.refresh_stats',
+        'schedule': STATS_REFRESH_INTERVAL,
+    }
     celery_app.set_default()
     app.extensions["celery"] = celery_app
     return celery_app
@@ -38,6 +38,7 @@ class Conversation(BaseModel):
     resource_id: str = None
     page: Optional[int] = None
     applied_skills: List[Any] = Field(default_factory=list)
+    context_usage: List[Any] = Field(default_factory=list)
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
     
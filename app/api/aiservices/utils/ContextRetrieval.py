@@ -0,0 +1,211 @@
+from app.utils import DatabaseHandler
+from bson.objectid import ObjectId
+from bson import json_util
+import hashlib
+import time
+import os
+
+mongodb = DatabaseHandler.DatabaseHandler()
+
+# tokens de cada fragmento, máximo de tokens del contexto por turno y número de fragmentos candidatos de la búsqueda
+CONTEXT_CHUNK_TOKENS = int(os.environ.get('CONTEXT_CHUNK_TOKENS', 400))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 6000))
+CONTEXT_TOP_K = int(os.environ.get('CONTEXT_TOP_K', 24))
+
+
+# Agrupa unidades consecutivas (segmentos de la transcripción o bloques de una página) en fragmentos de hasta
+# CONTEXT_CHUNK_TOKENS tokens. Cada unidad es un dict con text y opcionalmente start, end y page
+def split_chunks(units, provider):
+    chunks = []
+    current = None
+    for unit in units:
+        text = (unit.get('text') or '').strip()
+        if not text:
+            continue
+        tokens = provider.calculate_tokens(text)
+        if current and (current['tokens'] + tokens > CONTEXT_CHUNK_TOKENS or current.get('page') != unit.get('page')):
+            chunks.append(current)
+            current = None
+        if current is None:
+            current = {'text': text, 'tokens': tokens, 'start': unit.get('start'), 'end': unit.get('end'), 'page': unit.get('page')}
+        else:
+            current['text'] += '\n' + text
+            current['tokens'] += tokens
+            current['end'] = unit.get('end', current['end'])
+    if current:
+        chunks.append(current)
+
+    for x, chunk in enumerate(chunks):
+        chunk['position'] = x
+    return chunks
+
+
+def _format_time(seconds):
+    seconds = int(seconds or 0)
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def format_chunk(chunk):
+    if chunk.get('page') is not None:
+        return '--- PAGE: %s ---\n%s' % (chunk['page'], chunk['text'])
+    if chunk.get('start') is not None:
+        return '[%s - %s]\n%s' % (_format_time(chunk['start']), _format_time(chunk.get('end')), chunk['text'])
+    return chunk['text']
+
+
+def _source_filter(record_id, slug, version=None):
+    from qdrant_client import models
+    must = [
+        models.FieldCondition(key='record_id', match=models.MatchValue(value=str(record_id))),
+        models.FieldCondition(key='slug', match=models.MatchValue(value=slug)),
+    ]
+    if version is not None:
+        must.append(models.FieldCondition(key='version', match=models.MatchValue(value=version)))
+    return models.Filter(must=must)
+
+
+# Guarda los fragmentos de un record y un procesamiento en la colección transcript_records, salvo que ya estén
+# para esa versión. Los fragmentos de versiones anteriores se borran
+def index_chunks(vector_handler, record_id, slug, version, get_chunks):
+    from app.utils.VectorDatabaseHandler import TRANSCRIPT_RECORDS
+    from qdrant_client import models
+
+    count = vector_handler.qdrant.count(TRANSCRIPT_RECORDS, count_filter=_source_filter(record_id, slug, version), exact=True).count
+    if count > 0:
+        return False
+
+    vector_handler.qdrant.delete(TRANSCRIPT_RECORDS, points_selector=models.FilterSelector(filter=_source_filter(record_id, slug)))
+    chunks = get_chunks()
+    vector_handler.insert_vectors(TRANSCRIPT_RECORDS, [{
+        'id': str(record_id) + ':' + slug + ':' + version + ':' + str(c['position']),
+        'text': c['text'],
+        'payload': {'record_id': str(record_id), 'slug': slug, 'version': version, **c}
+    } for c in chunks])
+    return True
+
+
+# Arma el contexto de un turno. Si el texto completo cabe en CONTEXT_TOKEN_BUDGET se envía entero; si no, se buscan
+# los fragmentos más parecidos a la pregunta y se agregan por relevancia hasta llenar el presupuesto, en el orden en
+# que aparecen en el texto. Sin base vectorial o sin resultados se usan los primeros fragmentos. Retorna el contexto y las métricas
+def build_context(record_id, slug, version, question, provider, get_chunks, full_text=None, page=None):
+    begin = time.perf_counter()
+    usage = {'mode': 'full', 'budget': CONTEXT_TOKEN_BUDGET}
+
+    if full_text is not None:
+        total_tokens = provider.calculate_tokens(full_text)
+        usage['source_tokens'] = total_tokens
+        if total_tokens <= CONTEXT_TOKEN_BUDGET:
+            usage['context_tokens'] = total_tokens
+            usage['selection_ms'] = round((time.perf_counter() - begin) * 1000, 2)
+            return full_text, usage
+
+    candidates = None
+    try:
+        from app.utils import VectorDatabaseHandler
+        from qdrant_client import models
+        vector_handler = VectorDatabaseHandler.VectorDatabaseHandler()
+        usage['indexed'] = index_chunks(vector_handler, record_id, slug, version, get_chunks)
+
+        query_filter = _source_filter(record_id, slug, version)
+        if page is not None:
+            query_filter.must.append(models.FieldCondition(key='page', match=models.MatchValue(value=page)))
+        # los fragmentos recién insertados aún no están en el índice HNSW, así que también se buscan los no indexados
+        results = vector_handler.search_vector(VectorDatabaseHandler.TRANSCRIPT_RECORDS, question, limit=CONTEXT_TOP_K,
+                                               query_filter=query_filter, indexed_only=False)
+        candidates = [r.payload for r in results]
+        usage['mode'] = 'retrieval'
+    except Exception as e:
+        print(str(e))
+
+    if not candidates:
+        candidates = [c for c in get_chunks() if page is None or c.get('page') == page]
+        usage['mode'] = 'truncated'
+
+    selected = []
+    used = 0
+    for chunk in candidates:
+        if used + chunk['tokens'] > CONTEXT_TOKEN_BUDGET:
+            continue
+        selected.append(chunk)
+        used += chunk['tokens']
+
+    selected.sort(key=lambda c: c['position'])
+    usage['chunks'] = len(selected)
+    usage['context_tokens'] = used
+    usage['selection_ms'] = round((time.perf_counter() - begin) * 1000, 2)
+    return '\n\n'.join(format_chunk(c) for c in selected), usage
+
+
+def get_transcription_units(record_id, slug):
+    from app.utils.functions import get_transcription_index, cache_get_record_transcription
+    index = get_transcription_index(record_id, slug)
+    units = []
+    for x in range(len(index.get('boundaries') or [[0, 0]])):
+        transcription = cache_get_record_transcription(record_id, slug, True, x)
+        for segment in transcription.get('segments', []):
+            text = segment.get('text', '')
+            if segment.get('speaker'):
+                text = str(segment['speaker']) + ': ' + text
+            units.append({'text': text, 'start': segment.get('start'), 'end': segment.get('end')})
+    return units
+
+
+# Contexto de una transcripción para la pregunta
+def build_transcription_context(record_id, slug, question, provider):
+    from app.utils.functions import get_transcription_index
+    index = get_transcription_index(record_id, slug)
+    return build_context(
+        record_id, slug, str(index['version']), question, provider,
+        lambda: split_chunks(get_transcription_units(record_id, slug), provider),
+        full_text=index.get('text', '')
+    )
+
+
+def get_document_units(record_id, slug, pages, get_page_text):
+    units = []
+    for page in pages:
+        for paragraph in get_page_text(page).split('\n\n'):
+            units.append({'text': paragraph, 'page': page})
+    return units
+
+
+# Versión del resultado de un procesamiento: el lote de los resultados por chunks o un hash del resultado guardado en
+# el record, así otras ediciones del record no obligan a reindexar
+def get_document_version(record_id, slug):
+    record = mongodb.get_record('records', {'_id': ObjectId(record_id)}, fields={
+        'processing.' + slug + '.result_storage': 1, 'processing.' + slug + '.result': 1
+    })
+    processing = ((record or {}).get('processing') or {}).get(slug) or {}
+    storage = processing.get('result_storage') or {}
+    if storage.get('batchId'):
+        return str(storage['batchId'])
+    return hashlib.md5(json_util.dumps(processing.get('result', [])).encode('utf-8')).hexdigest()
+
+
+# Contexto de un documento para la pregunta. Con page solo se usa el texto de esa página; sin page, todo el documento
+def build_document_context(record_id, slug, question, provider, get_page_text, page=None):
+    from app.utils.functions import cache_get_record_document_detail
+    version = get_document_version(record_id, slug)
+    pages = range(1, cache_get_record_document_detail(record_id)['pages'] + 1)
+
+    full_text = None
+    if page is not None:
+        full_text = format_chunk({'page': page, 'text': get_page_text(page)})
+
+    return build_context(
+        record_id, slug, version, question, provider,
+        lambda: split_chunks(get_document_units(record_id, slug, pages, get_page_text), provider),
+        full_text=full_text, page=page
+    )
+
+
+# Tokens de los mensajes de texto que se envían al modelo, calculados antes de llamarlo
+def count_message_tokens(messages, provider):
+    return sum(provider.calculate_tokens(m['content']) for m in messages if isinstance(m.get('content'), str))
+
+
+# Agrega las métricas del turno a la conversación
+def save_context_usage(conversation_id, usage):
+    mongodb.update_record_operator('conversations', {'_id': ObjectId(conversation_id)}, {
+        '$push': {'context_usage': usage}
+    })
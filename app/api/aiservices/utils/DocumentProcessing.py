@@ -10,6 +10,7 @@ from .StreamingUtils import (
     resolve_stream_flag,
     sse_data,
 )
+from .ContextRetrieval import build_document_context, count_message_tokens, save_context_usage
 mongodb = DatabaseHandler.DatabaseHandler()
 WEB_FILES_PATH = os.environ.get('WEB_FILES_PATH', '')
 
@@ -144,6 +145,14 @@ def extract_clean_text(ordered_data):
     
     return clean_text
 
+# Texto limpio de una página según los bloques del procesamiento
+def get_page_text(record_id, page, processing_slug):
+    from app.utils.functions import cache_get_block_by_page_id
+    processing, status = cache_get_block_by_page_id(record_id, page, processing_slug, 'blocks')
+    if not processing or not processing.get('blocks'):
+        return ''
+    return extract_clean_text(order_and_filter_blocks(processing))
+
 def create_document_conversation(body, provider, user):
     message = body['message']
     model = body['model']['id']
@@ -171,28 +180,19 @@ def create_document_conversation(body, provider, user):
     
     page_image_path = None
     clean_text = None
+    usage = None
 
     if opt == 'image':
         page_image_path = get_document_page_image_path(record_id, page)
     else:
-        from app.utils.functions import cache_get_block_by_page_id
+        # con scope document se buscan los fragmentos relevantes en todas las páginas, si no solo en la página pedida
+        context_page = None if opts.get('scope') == 'document' else page
         try:
-            processing, status = cache_get_block_by_page_id(record_id, page, processing_slug, 'blocks')
+            clean_text, usage = build_document_context(
+                record_id, processing_slug, message, provider,
+                lambda p: get_page_text(record_id, p, processing_slug), page=context_page)
         except Exception:
             raise Exception('Error al obtener el procesamiento del record')
-
-        ordered_data = order_and_filter_blocks(processing)
-
-        clean_text = extract_clean_text(ordered_data)
-
-        clean_text = """
-        ---
-        PAGE: {page}
-        ---
-        """.format(page=page) + clean_text
-
-        tokens = provider.calculate_tokens(clean_text)
-        print(f"Tokens: {tokens}")
     
     from . import prompts
     
@@ -227,15 +227,20 @@ def create_document_conversation(body, provider, user):
                 }
             ]
         }
+        messages.append(user_turn)
     else:
         # Combine document context and user question into a single user turn so that
         # providers which reject consecutive same-role messages work correctly.
-        user_turn = {
+        messages.append({
             'role': 'user',
             'content': f"Document content:\n\n{clean_text}\n\n---\n\n{message}"
+        })
+        # en el historial solo queda la pregunta, el contexto se vuelve a seleccionar en cada turno
+        user_turn = {
+            'role': 'user',
+            'content': message
         }
-
-    messages.append(user_turn)
+        usage['prompt_tokens'] = count_message_tokens(messages, provider)
 
     resp = provider.call(
         messages,
@@ -277,6 +282,8 @@ def create_document_conversation(body, provider, user):
                     )
 
                     mongodb.update_record('conversations', {'_id': ObjectId(conversation_id)}, payload)
+                    if usage:
+                        save_context_usage(conversation_id, usage)
                     final_conversation_id = conversation_id
                 else:
                     payload = {
@@ -286,6 +293,7 @@ def create_document_conversation(body, provider, user):
                         'processing_slug': processing_slug,
                         'record_id': record_id,
                         'applied_skills': applied_skills,
+                        'context_usage': [usage] if usage else [],
                         'created_at': datetime.datetime.now(),
                         'updated_at': datetime.datetime.now()
                     }
@@ -302,6 +310,7 @@ def create_document_conversation(body, provider, user):
                     'done': True,
                     'conversation_id': final_conversation_id,
                     'thinking_steps': thinking_tracker.summary(),
+                    'context': usage,
                 })
             except Exception as e:
                 yield sse_data({'type': 'error', 'error': str(e), 'done': True})
@@ -327,9 +336,12 @@ def create_document_conversation(body, provider, user):
         )
         
         mongodb.update_record('conversations', {'_id': ObjectId(conversation_id)}, payload)
+        if usage:
+            save_context_usage(conversation_id, usage)
         return {
             'response': resp['choices'][0]['message']['content'],
-            'conversation_id': conversation_id
+            'conversation_id': conversation_id,
+            'context': usage
         }
     else:
         payload = {
@@ -339,6 +351,7 @@ def create_document_conversation(body, provider, user):
             'processing_slug': processing_slug,
             'record_id': record_id,
             'applied_skills': applied_skills,
+            'context_usage': [usage] if usage else [],
             'created_at': datetime.datetime.now(),
             'updated_at': datetime.datetime.now()
         }
@@ -348,5 +361,6 @@ def create_document_conversation(body, provider, user):
         
         return {
             'response': resp['choices'][0]['message']['content'],
-            'conversation_id': str(inserted_doc.inserted_id)
+            'conversation_id': str(inserted_doc.inserted_id),
+            'context': usage
         }
\ No newline at end of file
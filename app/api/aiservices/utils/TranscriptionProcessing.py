@@ -9,6 +9,7 @@ from .StreamingUtils import (
     resolve_stream_flag,
     sse_data,
 )
+from .ContextRetrieval import build_transcription_context, count_message_tokens, save_context_usage
 mongodb = DatabaseHandler.DatabaseHandler()
 
 
@@ -27,22 +28,19 @@ def create_transcription_conversation(body, provider, user):
     if status != 200:
         raise Exception('Error al obtener el record')
     
+    # solo se envían los fragmentos de la transcripción relevantes para la pregunta, dentro del presupuesto de tokens
     try:
-        from app.utils.functions import cache_get_record_transcription
-        processing = cache_get_record_transcription(record_id, processing_slug, False)
+        context, usage = build_transcription_context(record_id, processing_slug, message, provider)
     except Exception as e:
         raise Exception('Error al obtener el procesamiento del record')
     
-    transcription_text = str(processing['text'])
-    tokens = provider.calculate_tokens(transcription_text)
-    print(f"Tokens: {tokens}")
-    
     from . import prompts
 
     # Build the message list:
     #  1. System prompt
-    #  2. Transcription as a user context message (so providers that reject
-    #     mid-conversation system messages work correctly)
+    #  2. Transcription (or its excerpts relevant to the question) as a user
+    #     context message (so providers that reject mid-conversation system
+    #     messages work correctly)
     #  3. Conversation history (if resuming)
     #  4. New user question
     messages = [
@@ -52,7 +50,7 @@ def create_transcription_conversation(body, provider, user):
         },
         {
             'role': 'user',
-            'content': "Transcription:\n\n" + processing['text']
+            'content': ("Transcription:\n\n" if usage['mode'] == 'full' else "Transcription excerpts:\n\n") + context
         },
         {
             'role': 'assistant',
@@ -67,6 +65,7 @@ def create_transcription_conversation(body, provider, user):
             messages.append({'role': msg['role'], 'content': msg['content']})
 
     messages.append({'role': 'user', 'content': message})
+    usage['prompt_tokens'] = count_message_tokens(messages, provider)
 
     resp = provider.call(
         messages,
@@ -114,6 +113,7 @@ def create_transcription_conversation(body, provider, user):
                         updated_at=datetime.datetime.now()
                     )
                     mongodb.update_record('conversations', {'_id': ObjectId(conversation_id)}, payload)
+                    save_context_usage(conversation_id, usage)
                     final_conversation_id = conversation_id
                 else:
                     payload = {
@@ -123,6 +123,7 @@ def create_transcription_conversation(body, provider, user):
                         'processing_slug': processing_slug,
                         'record_id': record_id,
                         'applied_skills': applied_skills,
+                        'context_usage': [usage],
                         'created_at': datetime.datetime.now(),
                         'updated_at': datetime.datetime.now()
                     }
@@ -139,6 +140,7 @@ def create_transcription_conversation(body, provider, user):
                     'done': True,
                     'conversation_id': final_conversation_id,
                     'thinking_steps': thinking_tracker.summary(),
+                    'context': usage,
                 })
             except Exception as e:
                 yield sse_data({'type': 'error', 'error': str(e), 'done': True})
@@ -171,9 +173,11 @@ def create_transcription_conversation(body, provider, user):
         )
         
         mongodb.update_record('conversations', {'_id': ObjectId(conversation_id)}, payload)
+        save_context_usage(conversation_id, usage)
         return {
             'response': resp['choices'][0]['message']['content'],
-            'conversation_id': conversation_id
+            'conversation_id': conversation_id,
+            'context': usage
         }
     else:
         payload = {
@@ -192,6 +196,7 @@ def create_transcription_conversation(body, provider, user):
             'processing_slug': processing_slug,
             'record_id': record_id,
             'applied_skills': applied_skills,
+            'context_usage': [usage],
             'created_at': datetime.datetime.now(),
             'updated_at': datetime.datetime.now()
         }
@@ -201,5 +206,6 @@ def create_transcription_conversation(body, provider, user):
         
         return {
             'response': resp['choices'][0]['message']['content'],
-            'conversation_id': str(inserted_doc.inserted_id)
+            'conversation_id': str(inserted_doc.inserted_id),
+            'context': usage
         }
\ No newline at end of file
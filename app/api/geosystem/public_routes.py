@@ -3,7 +3,7 @@ from flask_jwt_extended import jwt_required
 from flask_jwt_extended import get_jwt_identity
 from app.api.geosystem import services
 from app.api.users import services as user_services
-from flask import request
+from flask import request, jsonify
 
 @bp.route('/level', methods=['POST'])
 def get_level():
@@ -53,4 +53,59 @@ def get_level():
     if isinstance(resp, list):
         return tuple(resp)
     else:
-        return resp
\ No newline at end of file
+        return resp
+
+@bp.route('/tiles/<int:level>/<int:z>/<int:x>/<int:y>', methods=['GET'])
+def get_tile(level, z, x, y):
+    """
+    Get a GeoJSON tile with the shapes of an administrative level, simplified for the zoom of the tile
+    ---
+    tags:
+        - Levels
+    parameters:
+        - in: path
+          name: level
+          type: integer
+          required: true
+          description: Administrative level (properties.admin_level).
+        - in: path
+          name: z
+          type: integer
+          required: true
+          description: Zoom of the tile (web map tiling scheme).
+        - in: path
+          name: x
+          type: integer
+          required: true
+        - in: path
+          name: y
+          type: integer
+          required: true
+        - in: query
+          name: parent
+          type: string
+          required: false
+          description: Identifier of the parent shape (optional filter).
+    responses:
+        200:
+            description: FeatureCollection of the shapes that intersect the tile (geometry + properties.name/ident + centroid). Cacheable and supports ETag.
+        304:
+            description: The tile has not changed
+        400:
+            description: Invalid tile coordinates
+        404:
+            description: The parent shape does not exist in the level
+        500:
+            description: Error retrieving the tile
+        503:
+            description: The tiles of the level have not been generated yet (the generation is queued)
+    """
+    resp, status = services.get_tile(level, z, x, y, request.args.get('parent'))
+    if status != 200:
+        return resp, status
+
+    response = jsonify(resp)
+    response.cache_control.public = True
+    response.cache_control.max_age = services.SHAPES_TILES_MAX_AGE
+    response.add_etag()
+    return response.make_conditional(request)
@@ -1,10 +1,15 @@
 from app.utils import CacheHandler
 from app.utils import DatabaseHandler, IndexHandler
 from app.api.geosystem.models import Polygon
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, timedelta
 import os
 import json
+import math
+from concurrent.futures import ThreadPoolExecutor
 from shapely.geometry import shape, mapping, MultiPolygon, MultiLineString as ShapelyMultiLineString
-from shapely.ops import polygonize, linemerge, unary_union
+from shapely.ops import polygonize, linemerge, unary_union, clip_by_rect
 from flask_babel import _
 from celery import shared_task
 from .utils import simplify_geojson
@@ -13,6 +18,27 @@ mongodb = DatabaseHandler.DatabaseHandler()
 cacheHandler = CacheHandler.CacheHandler()
 index_handler = IndexHandler.IndexHandler()
 ELASTIC_INDEX_PREFIX = os.environ.get('ELASTIC_INDEX_PREFIX', '')
+ELASTIC_BULK_SIZE = int(os.environ.get('ELASTIC_BULK_SIZE', 500))
+ELASTIC_BULK_MAX_BYTES = int(os.environ.get('ELASTIC_BULK_MAX_BYTES', 10 * 1024 * 1024))
+ELASTIC_BULK_WORKERS = int(os.environ.get('ELASTIC_BULK_WORKERS', 4))
+SHAPES_PAGE_SIZE = 200
+SHAPES_INSERT_CHUNK = int(os.environ.get('SHAPES_INSERT_CHUNK', 500))
+SHAPES_TILES_MAX_AGE = int(os.environ.get('SHAPES_TILES_MAX_AGE', 3600))
+SHAPES_TILES_MAX_ZOOM = 22
+# tiempo que se guarda una tesela generada y máximo de teselas guardadas; por encima se generan sin guardarlas
+SHAPES_TILES_TTL = int(os.environ.get('SHAPES_TILES_TTL', 7 * 86400))
+SHAPES_TILES_CACHE_MAX = int(os.environ.get('SHAPES_TILES_CACHE_MAX', 200000))
+# margen alrededor de la tesela al recortar las geometrías, como fracción de su ancho, para que los bordes no se vean cortados
+SHAPES_TILES_BUFFER = float(os.environ.get('SHAPES_TILES_BUFFER', 1 / 64))
+# duración máxima de la generación de las bandas; también es el tiempo mínimo entre dos generaciones pedidas desde get_tile
+SHAPES_TILES_BUILD_TIMEOUT = int(os.environ.get('SHAPES_TILES_BUILD_TIMEOUT', 3600))
+SHAPES_TILES_LOCK = 'geosystem:tiles:lock'
+SHAPES_TILES_QUEUED = 'geosystem:tiles:queued'
+# Bandas de zoom de las teselas: zoom máximo de la banda y fracción de vértices que se conserva al simplificar
+SHAPES_TILE_BANDS = sorted(
+    (int(band.split(':')[0]), float(band.split(':')[1]))
+    for band in os.environ.get('SHAPES_TILE_BANDS', '4:0.05,7:0.15,10:0.4,22:1').split(',') if ':' in band
+)
 
 def ensure_polygon_feature(feature):
     geom_dict = feature.get('geometry')
@@ -71,6 +97,19 @@ def ensure_polygon_feature(feature):
         feature['geometry'] = mapping(geom.buffer(0.001))
     return feature
 
+# Inserta las formas en lotes de SHAPES_INSERT_CHUNK con insert_many
+def insert_shapes(features):
+    chunk = []
+    for feature in features:
+        # Clean up NaN/null values from properties if they were inserted
+        feature['properties'] = {k: v for k, v in feature['properties'].items() if v is not None}
+        chunk.append(Polygon(**feature).model_dump(exclude_unset=True))
+        if len(chunk) >= SHAPES_INSERT_CHUNK:
+            mongodb.insert_records('shapes', chunk)
+            chunk = []
+    if chunk:
+        mongodb.insert_records('shapes', chunk)
+
 def update_cache():
     get_level.invalidate_all()
     get_level_info.invalidate_all()
@@ -158,12 +197,10 @@ def upload_shapes():
                     # Export to dictionary
                     features_dict = json.loads(gdf_features.to_json())['features']
                     
-                    for feature in features_dict:
-                        # Clean up NaN/null values from properties if they were inserted
-                        feature['properties'] = {k: v for k, v in feature['properties'].items() if v is not None}
-                        mongodb.insert_record('shapes', Polygon(**feature))
+                    insert_shapes(features_dict)
 
                     get_level.invalidate_all()
+                    clear_tiles(level)
                         
 
         return {'msg': _('Shapes uploaded successfully')}, 200
@@ -212,42 +249,308 @@ def regenerate_index_shapes():
     
     return index_handler.regenerate_index('shapes', mapping)
     
+def build_shape_document(shape_):
+    document = {}
+    document['geometry'] = shape_['geometry']
+    document['properties'] = {}
+    document['properties']['admin_level'] = shape_['properties']['admin_level']
+    document['properties']['ident'] = shape_['properties']['ident']
+    document['properties']['name'] = shape_['properties']['name']
+    if 'parent' in shape_['properties']:
+        document['properties']['parent'] = shape_['properties']['parent']
+    if 'parent_name' in shape_['properties']:
+        document['properties']['parent_name'] = shape_['properties']['parent_name']
+    return document
+
+# Envía un lote NDJSON al endpoint _bulk y retorna los errores por documento
+def _send_shapes_bulk(lines):
+    errors = []
+    response = index_handler.bulk('\n'.join(lines) + '\n')
+    if 'items' not in response:
+        error = response.get('error', response) if isinstance(response, dict) else response
+        raise Exception('Error al indexar el lote de formas: ' + str(error))
+
+    if response.get('errors'):
+        for item in response['items']:
+            action = item.get('index', {})
+            if action.get('status', 500) >= 300:
+                error = action.get('error', {})
+                if isinstance(error, dict):
+                    error = error.get('reason', error.get('type', ''))
+                errors.append({'id': action.get('_id'), 'error': str(error)})
+    return errors
+
 @shared_task(ignore_result=False, name='geosystem.index_shapes')
 def index_shapes(body={}):
-    skip = 0
     shapes_count = 0
     filters = {}
-    loop = True
-
-    shapes = list(mongodb.get_all_records(
-        'shapes', filters, limit=100, skip=skip))
+    index_name = ELASTIC_INDEX_PREFIX + '-shapes'
+    errors = []
+    last_id = None
+    lines = []
+    lines_bytes = 0
+    lines_docs = 0
+    pending = []
 
     if body == {}:
         index_handler.delete_all_documents('shapes')
 
-    while len(shapes) > 0 and loop:
-        for shape_ in shapes:
-            document = {}
-            shapes_count += 1
-            document['geometry'] = shape_['geometry']
-            document['properties'] = {}
-            document['properties']['admin_level'] = shape_['properties']['admin_level']
-            document['properties']['ident'] = shape_['properties']['ident']
-            document['properties']['name'] = shape_['properties']['name']
-            if 'parent' in shape_['properties']:
-                document['properties']['parent'] = shape_['properties']['parent']
-            if 'parent_name' in shape_['properties']:
-                document['properties']['parent_name'] = shape_['properties']['parent_name']
-            index_handler.index_document(ELASTIC_INDEX_PREFIX + '-shapes', str(shape_['_id']), document)
-
-        skip += 100
-        shapes = list(mongodb.get_all_records(
-            'shapes', filters, limit=100, skip=skip))
+    # los lotes se envían en paralelo, con a lo sumo ELASTIC_BULK_WORKERS lotes en vuelo
+    with ThreadPoolExecutor(max_workers=ELASTIC_BULK_WORKERS) as executor:
+        while True:
+            # paginación por _id para no degradar el rendimiento con skip
+            page_filters = filters if last_id is None else {'$and': [filters, {'_id': {'$gt': last_id}}]}
+            shapes = list(mongodb.get_all_records(
+                'shapes', page_filters, sort=[('_id', 1)], limit=SHAPES_PAGE_SIZE, fields={'geometry': 1, 'properties': 1}))
+            if len(shapes) == 0:
+                break
+            last_id = shapes[-1]['_id']
+
+            for shape_ in shapes:
+                action = json.dumps({'index': {'_index': index_name, '_id': str(shape_['_id'])}})
+                source = json.dumps(build_shape_document(shape_), default=str)
+                size = len(action.encode('utf-8')) + len(source.encode('utf-8')) + 2
+
+                if lines_docs > 0 and (lines_docs >= ELASTIC_BULK_SIZE or lines_bytes + size > ELASTIC_BULK_MAX_BYTES):
+                    if len(pending) >= ELASTIC_BULK_WORKERS:
+                        errors += pending.pop(0).result()
+                    pending.append(executor.submit(_send_shapes_bulk, lines))
+                    lines, lines_bytes, lines_docs = [], 0, 0
+
+                lines += [action, source]
+                lines_bytes += size
+                lines_docs += 1
+                shapes_count += 1
 
+            if len(shapes) < SHAPES_PAGE_SIZE:
+                break
+
+        if lines_docs > 0:
+            pending.append(executor.submit(_send_shapes_bulk, lines))
+        for future in pending:
+            errors += future.result()
+
+    shapes_count -= len(errors)
     resp = _("Indexing finished for %(count)s resources", count=shapes_count)
+    if len(errors) > 0:
+        resp += '\n' + _('%(count)s resources could not be indexed', count=len(errors))
+        for e in errors[:50]:
+            resp += '\n' + str(e['id']) + ': ' + e['error']
     return resp
     
 
+# Banda de zoom a la que pertenece un nivel de zoom
+def get_tile_band(z):
+    for band, (max_zoom, retention) in enumerate(SHAPES_TILE_BANDS):
+        if z <= max_zoom:
+            return band
+    return len(SHAPES_TILE_BANDS) - 1
+
+# Límites (minLng, minLat, maxLng, maxLat) de una tesela z/x/y en el esquema de teselas web (EPSG:3857)
+def tile_bounds(z, x, y):
+    n = 2 ** z
+    def lat(y_):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y_ / n))))
+    return x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)
+
+# Elimina las geometrías precalculadas y las teselas de un nivel (o de todos) para que se vuelvan a generar
+def clear_tiles(level=None):
+    if level is None:
+        mongodb.delete_records('shape_tile_levels', {})
+        mongodb.delete_records('shape_bands', {})
+        mongodb.delete_records('shape_tiles', {})
+    else:
+        mongodb.delete_records('shape_tile_levels', {'_id': int(level)})
+        mongodb.delete_records('shape_bands', {'level': int(level)})
+        mongodb.delete_records('shape_tiles', {'level': int(level)})
+
+# Precalcula para un nivel administrativo las geometrías simplificadas de cada banda de zoom, con su centroide y su
+# rectángulo envolvente. Los polígonos más pequeños que unos pocos pixeles en el zoom mínimo de la banda se descartan.
+# Las bandas se guardan con una versión nueva que solo se publica en shape_tile_levels cuando están completas, así las
+# teselas se siguen sirviendo con la versión anterior mientras se generan
+def build_level_bands(level):
+    level = int(level)
+    records = list(mongodb.get_all_records('shapes', {'properties.admin_level': level}, fields={'geometry': 1, 'properties': 1}))
+    if not records:
+        clear_tiles(level)
+        return 0
+
+    mongodb.create_index('shape_bands', [('level', 1), ('version', 1), ('band', 1), ('parent', 1)])
+    mongodb.create_index('shape_tiles', [('level', 1)])
+    mongodb.create_index('shape_tiles', [('expiresAt', 1)], expireAfterSeconds=0)
+    version = str(ObjectId())
+
+    features = []
+    for r in records:
+        features.append(ensure_polygon_feature({
+            'type': 'Feature',
+            'geometry': r['geometry'],
+            'properties': {
+                'ident': r['properties'].get('ident'),
+                'name': r['properties'].get('name'),
+                'parent': r['properties'].get('parent'),
+            }
+        }))
+    fc = {'type': 'FeatureCollection', 'features': features}
+
+    total = 0
+    for band, (max_zoom, retention) in enumerate(SHAPES_TILE_BANDS):
+        min_zoom = SHAPES_TILE_BANDS[band - 1][0] + 1 if band > 0 else 0
+        threshold = (360.0 / (256 * 2 ** min_zoom)) ** 2 * 4
+        simplified = fc if retention >= 1 else simplify_geojson(fc, retention)
+
+        docs = []
+        for f in simplified.get('features', []):
+            if not f.get('geometry'):
+                continue
+            geom = shape(f['geometry'])
+            if not geom.is_valid:
+                geom = geom.buffer(0)
+
+            if geom.geom_type == 'Polygon':
+                if geom.area < threshold:
+                    continue
+            elif geom.geom_type == 'MultiPolygon':
+                valid_polygons = [poly for poly in geom.geoms if poly.area >= threshold]
+                if not valid_polygons:
+                    continue
+                geom = valid_polygons[0] if len(valid_polygons) == 1 else MultiPolygon(valid_polygons)
+            else:
+                continue
+
+            docs.append({
+                'level': level,
+                'version': version,
+                'band': band,
+                'ident': f['properties'].get('ident'),
+                'name': f['properties'].get('name'),
+                'parent': f['properties'].get('parent'),
+                'geometry': mapping(geom),
+                'centroid': mapping(geom.centroid),
+                'bbox': list(geom.bounds),
+            })
+            if len(docs) >= SHAPES_INSERT_CHUNK:
+                mongodb.insert_records('shape_bands', docs)
+                total += len(docs)
+                docs = []
+        if docs:
+            mongodb.insert_records('shape_bands', docs)
+            total += len(docs)
+
+    mongodb.update_record_operator('shape_tile_levels', {'_id': level}, {
+        '$set': {'version': version, 'builtAt': datetime.now()}
+    }, upsert=True)
+    mongodb.delete_records('shape_bands', {'level': level, 'version': {'$ne': version}})
+    mongodb.delete_records('shape_tiles', {'level': level})
+    return total
+
+# Genera las bandas de todos los niveles. Solo una generación a la vez
+@shared_task(ignore_result=False, name='geosystem.build_tiles')
+def build_tiles():
+    client = cacheHandler.cache.client
+    if not client.set(SHAPES_TILES_LOCK, os.getpid(), nx=True, ex=SHAPES_TILES_BUILD_TIMEOUT):
+        return _('Geometry tiles are already being generated')
+
+    total = 0
+    try:
+        levels = [int(level) for level in mongodb.distinct('shapes', 'properties.admin_level') if level is not None]
+        for level in sorted(levels):
+            total += build_level_bands(level)
+
+        # niveles que ya no tienen formas
+        mongodb.delete_records('shape_tile_levels', {'_id': {'$nin': levels}})
+        mongodb.delete_records('shape_bands', {'level': {'$nin': levels}})
+        mongodb.delete_records('shape_tiles', {'level': {'$nin': levels}})
+    finally:
+        client.delete(SHAPES_TILES_LOCK)
+
+    return _('Geometry tiles generated for %(count)s levels (%(shapes)s simplified shapes)', count=len(levels), shapes=total)
+
+# Encola la generación de las teselas si no se ha pedido en los últimos SHAPES_TILES_BUILD_TIMEOUT segundos
+def request_tiles_build():
+    try:
+        if cacheHandler.cache.client.set(SHAPES_TILES_QUEUED, os.getpid(), nx=True, ex=SHAPES_TILES_BUILD_TIMEOUT):
+            build_tiles.delay()
+    except Exception as e:
+        print(str(e))
+
+# Retorna la tesela z/x/y de un nivel administrativo como un FeatureCollection. La tesela se arma una sola vez a partir de
+# las geometrías precalculadas de su banda de zoom y se guarda en shape_tiles
+def get_tile(level, z, x, y, parent=None):
+    try:
+        if z < 0 or z > SHAPES_TILES_MAX_ZOOM or x < 0 or y < 0 or x >= 2 ** z or y >= 2 ** z:
+            return {'msg': _('Invalid tile')}, 400
+
+        # las bandas se generan solo en la tarea geosystem.build_tiles
+        level_info = mongodb.get_record('shape_tile_levels', {'_id': level})
+        if not level_info:
+            request_tiles_build()
+            return {'msg': _('Tiles are not available yet')}, 503
+        version = level_info['version']
+
+        key = '/'.join([str(level), version, parent or '-', str(z), str(x), str(y)])
+        tile = mongodb.get_record('shape_tiles', {'_id': key})
+        if tile:
+            return tile['data'], 200
+
+        if parent and not mongodb.get_record('shape_bands', {'level': level, 'version': version, 'parent': parent}, fields={'_id': 1}):
+            return {'msg': _('Invalid parent')}, 404
+
+        min_lng, min_lat, max_lng, max_lat = tile_bounds(z, x, y)
+        filters = {
+            'level': level,
+            'version': version,
+            'band': get_tile_band(z),
+            'bbox.0': {'$lte': max_lng},
+            'bbox.1': {'$lte': max_lat},
+            'bbox.2': {'$gte': min_lng},
+            'bbox.3': {'$gte': min_lat},
+        }
+        if parent:
+            filters['parent'] = parent
+
+        shapes = mongodb.get_all_records('shape_bands', filters, fields={'_id': 0, 'geometry': 1, 'centroid': 1, 'name': 1, 'ident': 1}, sort=[('name', 1)])
+
+        # cada geometría se recorta a la tesela (más un margen), así una tesela de zoom alto no lleva bordes completos
+        margin_lng = (max_lng - min_lng) * SHAPES_TILES_BUFFER
+        margin_lat = (max_lat - min_lat) * SHAPES_TILES_BUFFER
+        features = []
+        for s in shapes:
+            geom = clip_by_rect(shape(s['geometry']), min_lng - margin_lng, min_lat - margin_lat, max_lng + margin_lng, max_lat + margin_lat)
+            if geom.is_empty:
+                continue
+            features.append({
+                'type': 'Feature',
+                'geometry': mapping(geom),
+                'centroid': s['centroid'],
+                'properties': {
+                    'name': s.get('name'),
+                    'ident': s.get('ident'),
+                }
+            })
+        data = {
+            'type': 'FeatureCollection',
+            'features': features
+        }
+
+        if mongodb.estimated_count('shape_tiles') < SHAPES_TILES_CACHE_MAX:
+            try:
+                mongodb.insert_record('shape_tiles', {
+                    '_id': key,
+                    'level': level,
+                    'data': data,
+                    'expiresAt': datetime.now() + timedelta(seconds=SHAPES_TILES_TTL)
+                })
+            except DuplicateKeyError:
+                # otra petición guardó la misma tesela
+                pass
+            except Exception as e:
+                print('No se pudo guardar la tesela ' + key + ': ' + str(e))
+
+        return data, 200
+    except Exception as e:
+        return {'msg': str(e)}, 500
+
 @cacheHandler.cache.cache(limit=5000)
 def get_level(body):
     try:
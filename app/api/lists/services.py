@@ -20,9 +20,15 @@ cacheHandler = CacheHandler.CacheHandler()
 def parse_result(result):
     return json.loads(json_util.dumps(result))
 
-def update_cache():
-    get_by_id.invalidate_all()
+# Limpia la cache de listados. Con id solo se invalidan las entradas etiquetadas con el listado y con sus opciones
+def update_cache(id=None, options=[]):
     get_all.invalidate_all()
+    if id is not None:
+        cacheHandler.invalidate_tags('list:' + str(id), *['option:' + str(o) for o in options])
+        return
+    get_by_id.invalidate_all()
+    get_by_slug.invalidate_all()
+    get_option_by_id.invalidate_all()
 
 # Nuevo servicio para obtener todos los listados
 @cacheHandler.cache.cache()
@@ -59,19 +65,21 @@ def create(body, user):
             'id': str(new_list.inserted_id),
         }})
         # Limpiar la cache
-        update_cache()
+        update_cache(str(new_list.inserted_id))
         # Retornar el resultado
         return {'msg': _('List created successfully')}, 201
     
     except Exception as e:
         return {'msg': str(e)}, 500
     
-# Nuevo servicio para obtener un listado por su slug
-@cacheHandler.cache.cache()
+# Nuevo servicio para obtener un listado por su slug. La etiqueta del listado se conoce al leerlo, así que se agrega
+# durante el cálculo
+@cacheHandler.tagged(lambda slug: [])
 def get_by_slug(slug):
     try:
         # Buscar el listado en la base de datos
         lista = mongodb.get_record('lists', {'slug': slug})
+        cacheHandler.tag('list:' + str(lista['_id']))
         # a lista solo le dejamos los campos name, description, slug y options
         lista = { 'name': lista['name'], 'description': lista['description'], 'options': lista['options'] }
         # Si el listado no existe, retornar error
@@ -97,7 +105,7 @@ def get_by_slug(slug):
         return {'msg': str(e)}, 500
 
 # Nuevo servicio para devolver un listado por su id
-@cacheHandler.cache.cache()
+@cacheHandler.tagged('list')
 def get_by_id(id):
     try:
         # Buscar el listado en la base de datos
@@ -134,7 +142,7 @@ def get_by_id(id):
         return {'msg': str(e)}, 500
     
 # Nuevo servicio para obtener una opcion por su id
-@cacheHandler.cache.cache()
+@cacheHandler.tagged('option')
 def get_option_by_id(id):
     try:
         if not id or id == 'none':
@@ -168,6 +176,7 @@ def update_by_id(id, body, user):
         # Actualizar el listado en la base de datos
         # para cada opcion en el body, se convierte el id a ObjectId
         if('options' in body):
+            changed_options = [option['id'] for option in body['options'] if 'id' in option]
             to_delete = []
             to_save = []
             for x in range(0, len(body['options'])):
@@ -196,7 +205,7 @@ def update_by_id(id, body, user):
             # Registrar el log
             register_log(user, log_actions['list_update'], {'list': body})
             # Limpiar la cache
-            update_cache()
+            update_cache(id, changed_options)
             if(id == get_access_rights_id()):
                 get_access_rights.invalidate_all()
             if(id == get_roles_id()):
@@ -224,8 +233,7 @@ def delete_by_id(id, user):
             'id': lista['_id'],
         }})
         # Limpiar la cache
-        get_by_id.invalidate_all()
-        get_all.invalidate_all()
+        update_cache(id, lista['options'])
         # Retornar el resultado
         return {'msg': _('List deleted successfully')}, 200
     
@@ -57,9 +57,14 @@ def filter():
               page:
                 type: integer
                 description: Result page (20 per page, skip = page * 20).
+              cursor:
+                type: string
+                description: >
+                    Keyset pagination by (date, _id). Send null for the first page and then the "next" or "prev"
+                    token of the previous response; when present "page" is ignored and the response is an object
+                    {logs, total, next, prev}.
             required:
               - filters
-              - page
     responses:
         200:
             description: >
@@ -107,6 +112,11 @@ def get_logs(resource_id):
                     page:
                         type: integer
                         description: Result page (20 per page, skip = page * 20). Optional, defaults to skip=0.
+                    cursor:
+                        type: string
+                        description: >
+                            Keyset pagination by (date, _id). Send null for the first page and then the "next" or
+                            "prev" token of the previous response; the response is then an object {changes, next, prev}.
     responses:
         200:
             description: >
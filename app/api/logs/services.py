@@ -1,15 +1,22 @@
-from flask import jsonify
 from app.utils import DatabaseHandler
 from app.utils import CacheHandler
+from app.utils import LogHandler
+from app.utils.functions import get_keyset_page, count_total
 from bson import json_util
 import json
 from app.api.logs.models import Log
-from datetime import datetime
+from datetime import datetime, timedelta
 from app.utils import LogActions
 from flask_babel import _
+from celery import shared_task
+import os
 
 mongodb = DatabaseHandler.DatabaseHandler()
 cacheHandler = CacheHandler.CacheHandler()
+logHandler = LogHandler.LogHandler()
+
+# Días que se guardan los logs de búsqueda. 0 para guardarlos indefinidamente
+LOG_SEARCH_TTL_DAYS = int(os.environ.get('LOG_SEARCH_TTL_DAYS', 90))
 
 # Funcion para parsear el resultado de una consulta a la base de datos
 def parse_result(result):
@@ -119,10 +126,24 @@ def register_log(username, action, metadata=None):
     username = username if username else 'system'
     # Crear instancia de Log con el username, la acción y la fecha
     log = Log(username=username, action=action, date=date, metadata=metadata)
-    # Insertar log en la base de datos
-    mongodb.insert_record('logs', log)
-    # Retornar mensaje de éxito
-    return jsonify({'msg': _('Log created successfully')}), 201
+    log = log.model_dump(exclude_unset=True)
+    # Los logs de búsqueda son los más numerosos, así que expiran
+    if action == LogActions.log_actions['search'] and LOG_SEARCH_TTL_DAYS > 0:
+        log['expiresAt'] = date + timedelta(days=LOG_SEARCH_TTL_DAYS)
+    # Encolar el log, se inserta en la base de datos en lote fuera de la petición
+    logHandler.add(log)
+
+# Crea los índices de la colección logs. expiresAt solo lo tienen los logs que deben expirar
+def create_log_indexes():
+    mongodb.create_index('logs', [('date', -1), ('_id', -1)])
+    mongodb.create_index('logs', [('action', 1), ('date', -1), ('_id', -1)])
+    mongodb.create_index('logs', [('username', 1), ('date', -1), ('_id', -1)])
+    mongodb.create_index('logs', [('expiresAt', 1)], expireAfterSeconds=0)
+
+# Tarea que escribe en la base de datos los logs encolados en redis (LOG_SPOOL=redis)
+@shared_task(ignore_result=True, name='logs.drain_spool')
+def drain_log_spool():
+    return logHandler.drain_spool()
 
 _ALLOWED_LOG_FILTER_FIELDS = {'username', 'action'}
 
@@ -139,14 +160,25 @@ def _sanitize_log_filters(filters):
 def filter(body):
     try:
         filters = _sanitize_log_filters(body['filters'])
+        # Obtener el total de logs
+        total = count_total('logs', filters, LogHandler.LOG_COUNTED_FIELDS, get_total)
+
+        # Si se envía cursor (null para la primera página) se pagina por (date, _id)
+        if 'cursor' in body:
+            logs, next_cursor, prev_cursor = get_keyset_page('logs', filters, 'date', -1, 20, body['cursor'], fields={'_id': 0})
+            return {
+                'logs': _normalize_log_details(parse_result(logs)),
+                'total': total,
+                'next': next_cursor,
+                'prev': prev_cursor
+            }, 200
+
         # Obtener todos los logs de la coleccion logs
         logs = mongodb.get_all_records('logs', filters, limit=20, sort=[
                                         ('date', -1)], skip=body['page'] * 20, fields={'_id': 0})
         # Si no hay logs, retornar error
         if not logs:
             return {'msg': _('Logs not found')}, 404
-        # Obtener el total de logs
-        total = get_total(json.dumps(filters))
         # Parsear el resultado
         logs = parse_result(logs)
         # Normalizar metadata para details
@@ -249,13 +281,23 @@ def get_logs(body, resource_id):
     try:
         limit = 20
         skip = 0
+        filters = {'metadata.resource._id': resource_id,
+                   'action': {'$in': ["RESOURCE_CREATE", "RESOURCE_UPDATE"]}}
+
+        # Si se envía cursor (null para la primera página) se pagina por (date, _id)
+        if 'cursor' in body:
+            logs, next_cursor, prev_cursor = get_keyset_page('logs', filters, 'date', -1, limit, body['cursor'], fields={'_id': 0})
+            return {
+                'changes': extract_changes(parse_result(logs)),
+                'next': next_cursor,
+                'prev': prev_cursor
+            }, 200
 
         if 'page' in body:
             skip = body['page'] * limit
         # Obtener todos los logs de la coleccion logs
         logs = mongodb.get_all_records('logs',
-                                      {'metadata.resource._id': resource_id,
-                                       'action': {'$in': ["RESOURCE_CREATE", "RESOURCE_UPDATE"]}},
+                                      filters,
                                       limit=20,
                                       skip=skip,
                                       sort=[('date', -1)],
@@ -62,25 +62,65 @@ def stream_by_id_public(id):
           type: number
           required: false
           description: end of the fragment in seconds (video/audio only); requires start_ms
+        - in: query
+          name: format
+          type: string
+          required: false
+          description: >
+            hls to get an HLS playlist (application/vnd.apple.mpegurl) with the pregenerated segments of a
+            video, limited to the segments that overlap start_ms/end_ms when they are specified
     responses:
         200:
-            description: File (full stream, or a fragment generated with ffmpeg if start_ms/end_ms are specified)
+            description: >
+                File (full stream, or a fragment if start_ms/end_ms are specified). Fragments are cut with
+                ffmpeg once and served from a disk cache with Range support
         400:
             description: Invalid start_ms/end_ms (non-numeric, negative, or end_ms less than or equal to start_ms)
         401:
             description: The record has restricted accessRights (not publicly accessible)
         404:
-            description: Record does not exist
+            description: Record does not exist, or format=hls was requested but the record has no HLS segments
         500:
             description: Error generating the fragment or another unexpected error
     """
     size = request.args.get('size')
     start_ms = request.args.get('start_ms')
     end_ms = request.args.get('end_ms')
+    format = request.args.get('format')
     # Call the service to get a record by its id
-    resp = public_services.get_stream(id, size, start_ms, end_ms)
+    resp = public_services.get_stream(id, size, start_ms, end_ms, format)
     return resp
 
+@bp.route('/public/<id>/hls/<segment>', methods=['GET'])
+def get_hls_segment_by_id_public(id, segment):
+    """
+    Get a pregenerated HLS segment of a public video record, as listed in the playlist returned by the stream endpoint with format=hls
+    ---
+    tags:
+        - Records
+    parameters:
+        - in: path
+          name: id
+          type: string
+          required: true
+          description: id of the record
+        - in: path
+          name: segment
+          type: string
+          required: true
+          description: segment file name (e.g. 00001.ts)
+    responses:
+        200:
+            description: MPEG-TS segment with HTTP caching and Range support
+        401:
+            description: The record has restricted accessRights (not publicly accessible)
+        404:
+            description: Record does not exist or is not a video
+        500:
+            description: Segment not found or another unexpected error
+    """
+    return public_services.get_hls_segment(id, segment)
+
 @bp.route('/public/<id>/transcription', methods=['POST'])
 def get_transcription_by_id_public(id):
     """
@@ -146,12 +186,15 @@ def get_page_by_id_public(id):
                 gallery:
                     type: boolean
                     description: if true, id is interpreted as a resource and images are retrieved from its gallery instead of pages of a document
+                binary:
+                    type: boolean
+                    description: if true, returns the page manifest (filenames, dimensions and file URLs) instead of base64-encoded images; pages is ignored
             required:
                 - pages
                 - size
     responses:
         200:
-            description: Images of the requested pages
+            description: Images of the requested pages, or the page manifest if binary is true
         401:
             description: The record/resource has restricted accessRights (not publicly accessible)
         404:
@@ -163,9 +206,124 @@ def get_page_by_id_public(id):
 
     # Call the service to get a record by its id
     if 'gallery' in body and body['gallery'] == True:
-        return public_services.get_document_gallery(id, body.get('pages', []), body.get('size', 'small'), dzi=body.get('dzi', False), dzi_payload=body.get('dzi_payload'))
+        return public_services.get_document_gallery(id, body.get('pages', []), body.get('size', 'small'), dzi=body.get('dzi', False), dzi_payload=body.get('dzi_payload'), binary=body.get('binary', False))
     else:
-        return public_services.get_document_pages(id, body['pages'], body['size'])
+        return public_services.get_document_pages(id, body.get('pages', []), body['size'], binary=body.get('binary', False))
+
+@bp.route('/public/<id>/pages/<int:page>/file', methods=['GET'])
+def get_page_file_by_id_public(id, page):
+    """
+    Get the image file of a public document page, streamed as binary with HTTP caching
+    ---
+    tags:
+        - Records
+    parameters:
+        - in: path
+          name: id
+          type: string
+          required: true
+          description: record id
+        - in: path
+          name: page
+          type: integer
+          required: true
+          description: page index (0-based)
+        - in: query
+          name: size
+          type: string
+          required: false
+          description: size of the page (small/big for documents, small/medium/large for images)
+    responses:
+        200:
+            description: Image file (supports ETag/Last-Modified and Range requests)
+        304:
+            description: The image has not changed
+        401:
+            description: The record has restricted accessRights (not publicly accessible)
+        404:
+            description: Record does not exist
+        500:
+            description: Page out of range or another unexpected error
+    """
+    size = request.args.get('size', 'small')
+
+    return public_services.get_document_page_file(id, page, size)
+
+@bp.route('/public/<id>/gallery/<int:index>/file', methods=['GET'])
+def get_gallery_file_by_id_public(id, index):
+    """
+    Get an image of a public resource gallery, streamed as binary with HTTP caching
+    ---
+    tags:
+        - Records
+    parameters:
+        - in: path
+          name: id
+          type: string
+          required: true
+          description: resource id
+        - in: path
+          name: index
+          type: integer
+          required: true
+          description: position of the image in the gallery (0-based)
+        - in: query
+          name: size
+          type: string
+          required: false
+          description: size of the image (small/medium/large)
+    responses:
+        200:
+            description: Image file (supports ETag/Last-Modified and Range requests)
+        304:
+            description: The image has not changed
+        401:
+            description: The resource has restricted accessRights (not publicly accessible)
+        404:
+            description: Resource does not exist
+        500:
+            description: Index out of range or another unexpected error
+    """
+    size = request.args.get('size', 'small')
+
+    return public_services.get_gallery_file(id, index, size)
+
+@bp.route('/public/<id>/thumbnail', methods=['GET'])
+def get_thumbnail_by_id_public(id):
+    """
+    Get the thumbnail of a public record, streamed as binary with long lived HTTP caching
+    ---
+    tags:
+        - Records
+    parameters:
+        - in: path
+          name: id
+          type: string
+          required: true
+          description: record id
+        - in: query
+          name: size
+          type: string
+          required: false
+          description: size of the thumbnail (small/medium)
+        - in: query
+          name: v
+          type: string
+          required: false
+          description: version of the thumbnail, as returned by the search with thumbnails=url
+    responses:
+        200:
+            description: Image file (supports ETag and is cacheable as immutable)
+        304:
+            description: The image has not changed
+        404:
+            description: Record does not exist, is not publicly accessible or has no thumbnail
+        500:
+            description: Invalid size or another unexpected error
+    """
+    size = request.args.get('size', 'small')
+
+    return public_services.get_thumbnail(id, size)
 
 @bp.route('/public/galleryinfo', methods=['POST'])
 def get_by_gallery_index_public():
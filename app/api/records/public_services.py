@@ -1,5 +1,5 @@
 import datetime
-from flask import jsonify, send_file, Response
+from flask import jsonify, send_file, Response, url_for
 from app.utils import DatabaseHandler
 from app.utils import CacheHandler
 from bson import json_util
@@ -10,14 +10,13 @@ from app.utils.LogActions import log_actions
 from app.api.logs.services import register_log
 from app.api.users.services import has_right
 from app.api.records.models import RecordUpdate as FileRecordUpdate
-from app.utils.functions import cache_get_record_stream, cache_get_record_transcription, cache_get_record_document_detail, cache_get_pages_by_id, cache_get_block_by_page_id, cache_get_imgs_gallery_by_id, cache_get_processing_metadata, get_dzi_data
+from app.utils.functions import cache_get_record_stream, cache_get_record_transcription, cache_get_record_document_detail, cache_get_pages_by_id, cache_get_block_by_page_id, cache_get_imgs_gallery_by_id, cache_get_processing_metadata, get_dzi_data, cache_get_pages_manifest, cache_get_gallery_manifest, public_manifest, get_page_file, get_gallery_image_file, send_web_file, get_records_paths, get_thumbnail_file, send_thumbnail_file, get_media_fragment, send_media_fragment, get_hls_segments, get_hls_slice, get_hls_segment_file, FRAGMENTS_MAX_AGE
 from werkzeug.utils import secure_filename
 import os
 import shutil
 import hashlib
 import magic
 import uuid
-import ffmpeg
 from dotenv import load_dotenv
 from flask_babel import _
 load_dotenv()
@@ -83,13 +82,39 @@ def extract_important_exif(metadata):
     return cleaned
 
 
-def get_document_gallery(id, pages, size, dzi=False, dzi_payload=None):
+def get_document_pages(id, pages, size, binary=False):
+    try:
+        resp_, status = get_by_id(id)
+        if status != 200:
+            return resp_, status
+
+        if binary:
+            manifest = cache_get_pages_manifest(id, size)
+            entries = public_manifest(manifest['pages'])
+            for x, entry in enumerate(entries):
+                entry['url'] = url_for('records.get_page_file_by_id_public', id=id, page=x, size=size)
+            return {'type': manifest['type'], 'total': len(entries), 'pages': entries}, 200
+
+        pages = json.dumps(pages)
+        resp = cache_get_pages_by_id(id, pages, size)
+        response = Response(json.dumps(resp).encode('utf-8'), mimetype='application/json', direct_passthrough=False)
+        return response
+    except Exception as e:
+        return {'msg': str(e)}, 500
+
+def get_document_gallery(id, pages, size, dzi=False, dzi_payload=None, binary=False):
     try:
         from app.api.resources.public_services import get_by_id as get_resource_by_id
         resp_, status = get_resource_by_id(id)
         if status != 200:
             return resp_, status
 
+        if binary:
+            entries = public_manifest(cache_get_gallery_manifest(id, size))
+            for x, entry in enumerate(entries):
+                entry['url'] = url_for('records.get_gallery_file_by_id_public', id=id, index=x, size=size)
+            return {'total': len(entries), 'pages': entries}, 200
+
         if dzi and dzi_payload:
             resp = get_dzi_data(id, pages, dzi_payload)
             response = Response(json.dumps(resp).encode('utf-8'), mimetype='application/json', direct_passthrough=False)
@@ -103,6 +128,41 @@ def get_document_gallery(id, pages, size, dzi=False, dzi_payload=None):
         print(str(e))
         return {'msg': str(e)}, 500
 
+def get_document_page_file(id, page, size):
+    try:
+        resp_, status = get_by_id(id)
+        if status != 200:
+            return resp_, status
+
+        return send_web_file(get_page_file(id, page, size), private=False)
+    except Exception as e:
+        return {'msg': str(e)}, 500
+
+def get_gallery_file(id, index, size):
+    try:
+        from app.api.resources.public_services import get_by_id as get_resource_by_id
+        resp_, status = get_resource_by_id(id)
+        if status != 200:
+            return resp_, status
+
+        return send_web_file(get_gallery_image_file(id, index, size), private=False)
+    except Exception as e:
+        return {'msg': str(e)}, 500
+
+def get_thumbnail(id, size):
+    try:
+        path = get_records_paths([id], None).get(id)
+        if not path:
+            return {'msg': _('Record does not exist')}, 404
+
+        file = get_thumbnail_file(path, size)
+        if not os.path.exists(file):
+            return {'msg': _('File not found')}, 404
+
+        return send_thumbnail_file(file, private=False)
+    except Exception as e:
+        return {'msg': str(e)}, 500
+
 def get_by_index_gallery(body):
     try:
         if 'id' not in body:
@@ -131,7 +191,7 @@ def get_by_index_gallery(body):
     except Exception as e:
         return {'msg': str(e)}, 500
 
-@cacheHandler.cache.cache(limit=5000)
+@cacheHandler.tagged('record', limit=5000)
 def get_by_id(id, fullFields = False):
     try:
         # Buscar el record en la base de datos
@@ -201,102 +261,18 @@ def _parse_ms(value):
         return None
 
 
-def _stream_video_fragment(path, record_id, start_ms, end_ms):
-    start_sec = start_ms
-    duration_sec = (end_ms - start_ms)
-    if duration_sec <= 0:
+def _stream_fragment(path, record_id, start_ms, end_ms):
+    if end_ms - start_ms <= 0:
         return None
 
-    if not TEMPORAL_FILES_PATH:
-        return {'msg': _('Temporal path is not configured')}, 500
-    if not os.path.exists(TEMPORAL_FILES_PATH):
-        os.makedirs(TEMPORAL_FILES_PATH)
-
-    temp_filename = f"{record_id}_{start_ms}_{end_ms}_fragment.mp4"
-    temp_path = os.path.join(TEMPORAL_FILES_PATH, temp_filename)
-
-    if os.path.exists(temp_path) and os.path.getsize(temp_path) > 0:
-        response = send_file(temp_path, as_attachment=True)
-        response.call_on_close(lambda: os.path.exists(temp_path) and os.remove(temp_path))
-        return response
-    if os.path.exists(temp_path):
-        os.remove(temp_path)
-
     try:
-        (
-            ffmpeg
-            .input(path)
-            .output(
-                temp_path,
-                ss=start_sec,
-                t=duration_sec,
-                vcodec='libx264',
-                acodec='aac',
-                movflags='faststart',
-                avoid_negative_ts='make_zero',
-                **{'fflags': '+genpts'}
-            )
-            .overwrite_output()
-            .run(capture_stdout=True, capture_stderr=True)
-        )
-    except ffmpeg.Error as e:
-        error_output = e.stderr.decode('utf-8', errors='replace') if e.stderr else str(e)
-        return {'msg': error_output or 'ffmpeg failed to produce output'}, 500
-
-    if not os.path.exists(temp_path) or os.path.getsize(temp_path) == 0:
-        error_output = ''
-        return {'msg': error_output or 'ffmpeg failed to produce output'}, 500
-
-    response = send_file(temp_path, as_attachment=True)
-    response.call_on_close(lambda: os.path.exists(temp_path) and os.remove(temp_path))
-    return response
-
-def _stream_audio_fragment(path, record_id, start_ms, end_ms):
-    start_sec = start_ms
-    duration_sec = (end_ms - start_ms)
-    if duration_sec <= 0:
-        return None
-
-    if not TEMPORAL_FILES_PATH:
-        return {'msg': _('Temporal path is not configured')}, 500
-    if not os.path.exists(TEMPORAL_FILES_PATH):
-        os.makedirs(TEMPORAL_FILES_PATH)
-
-    temp_filename = f"{record_id}_{start_ms}_{end_ms}_fragment.mp3"
-    temp_path = os.path.join(TEMPORAL_FILES_PATH, temp_filename)
+        fragment = get_media_fragment(path, record_id, start_ms, end_ms)
+    except Exception as e:
+        return {'msg': str(e) or 'ffmpeg failed to produce output'}, 500
 
-    if os.path.exists(temp_path) and os.path.getsize(temp_path) > 0:
-        response = send_file(temp_path, as_attachment=True)
-        response.call_on_close(lambda: os.path.exists(temp_path) and os.remove(temp_path))
-        return response
-    if os.path.exists(temp_path):
-        os.remove(temp_path)
+    return send_media_fragment(fragment, private=False, as_attachment=True)
 
-    try:
-        (
-            ffmpeg
-            .input(path)
-            .output(
-                temp_path,
-                ss=start_sec,
-                t=duration_sec,
-                acodec='libmp3lame',
-            )
-            .run(capture_stdout=True, capture_stderr=True)
-        )
-    except ffmpeg.Error as e:
-        error_output = e.stderr.decode('utf-8', errors='replace') if e.stderr else str(e)
-        return {'msg': error_output or 'ffmpeg failed to produce output'}, 500
-
-    if not os.path.exists(temp_path) or os.path.getsize(temp_path) == 0:
-        error_output = ''
-        return {'msg': error_output or 'ffmpeg failed to produce output'}, 500
-
-    response = send_file(temp_path, as_attachment=True)
-    response.call_on_close(lambda: os.path.exists(temp_path) and os.remove(temp_path))
-    return response
-
-def get_stream(id, size='large', start_ms=None, end_ms=None):
+def get_stream(id, size='large', start_ms=None, end_ms=None, format=None):
     try:
         resp_, status = get_by_id(id, True)
         if status != 200:
@@ -320,13 +296,24 @@ def get_stream(id, size='large', start_ms=None, end_ms=None):
 
         start_val = _parse_ms(start_ms)
         end_val = _parse_ms(end_ms)
+        if format == 'hls':
+            if (start_ms is not None or end_ms is not None) and (start_val is None or end_val is None or start_val < 0 or end_val <= start_val):
+                return {'msg': _('Invalid start_ms or end_ms')}, 400
+            segments = get_hls_segments(os.path.splitext(path)[0]) if type == 'video' else None
+            if not segments:
+                return {'msg': _('File not found')}, 404
+            response = get_hls_slice(segments, start_val, end_val, lambda name: url_for('records.get_hls_segment_by_id_public', id=id, segment=name))
+            if response:
+                return response
+            return {'msg': _('Invalid start_ms or end_ms')}, 400
+
         if type == 'video' and (start_ms is not None or end_ms is not None):
             if start_val is None or end_val is None:
                 return {'msg': _('Invalid start_ms or end_ms')}, 400
             if start_val < 0 or end_val <= start_val:
                 return {'msg': _('Invalid start_ms or end_ms')}, 400
 
-            response = _stream_video_fragment(path, id, start_val, end_val)
+            response = _stream_fragment(path, id, start_val, end_val)
             if response:
                 return response
         elif type == 'audio' and (start_ms is not None or end_ms is not None):
@@ -335,7 +322,7 @@ def get_stream(id, size='large', start_ms=None, end_ms=None):
             if start_val < 0 or end_val <= start_val:
                 return {'msg': _('Invalid start_ms or end_ms')}, 400
 
-            response = _stream_audio_fragment(path, id, start_val, end_val)
+            response = _stream_fragment(path, id, start_val, end_val)
             if response:
                 return response
 
@@ -345,6 +332,22 @@ def get_stream(id, size='large', start_ms=None, end_ms=None):
         print(str(e))
         return {'msg': str(e)}, 500
 
+# Segmento HLS pregenerado de un video, con los mismos permisos que el stream
+def get_hls_segment(id, segment):
+    try:
+        resp_, status = get_by_id(id, True)
+        if status != 200:
+            return resp_, status
+
+        path, type = cache_get_record_stream(id)
+        if type != 'video':
+            return {'msg': _('File not found')}, 404
+
+        file = get_hls_segment_file(os.path.join(WEB_FILES_PATH, path), segment)
+        return send_web_file(file, private=False, max_age=FRAGMENTS_MAX_AGE)
+    except Exception as e:
+        return {'msg': str(e)}, 500
+
 def get_transcription(id, slug):
     try:
         resp_, status = get_by_id(id)
@@ -1,5 +1,5 @@
 from app.api.records import bp
-from flask_jwt_extended import jwt_required
+from flask_jwt_extended import jwt_required, verify_jwt_in_request
 from flask_jwt_extended import get_jwt_identity
 from app.api.records import services
 from app.api.users import services as user_services
@@ -175,11 +175,22 @@ def get_stream_by_id(id):
           type: number
           required: false
           description: fragment end in seconds (video/audio only); requires start_ms
+        - in: query
+          name: format
+          type: string
+          required: false
+          description: >
+            hls to get an HLS playlist (application/vnd.apple.mpegurl) with the pregenerated segments of a
+            video, limited to the segments that overlap start_ms/end_ms when they are specified
     responses:
         200:
-            description: File (full stream, or fragment generated with ffmpeg if start_ms/end_ms are specified)
+            description: >
+                File (full stream, or fragment if start_ms/end_ms are specified). Fragments are cut with
+                ffmpeg once and served from a disk cache with Range support
         400:
             description: Invalid start_ms/end_ms (non-numeric, negative, or end_ms less than or equal to start_ms)
+        404:
+            description: format=hls was requested but the record has no HLS segments
         500:
             description: Record does not exist or no access permission (both cases collapse to 500 on this endpoint), or error generating the fragment
     """
@@ -190,12 +201,46 @@ def get_stream_by_id(id):
     size = request.args.get('size')
     start_ms = request.args.get('start_ms')
     end_ms = request.args.get('end_ms')
+    format = request.args.get('format')
 
     # Llamar al servicio para obtener un record por su id
-    resp = services.get_stream(id, current_user, size, start_ms, end_ms)
+    resp = services.get_stream(id, current_user, size, start_ms, end_ms, format)
 
     return resp
 
+# Nuevo endpoint para obtener un segmento HLS de un video
+@bp.route('/<id>/hls/<segment>', methods=['GET'])
+@jwt_required()
+def get_hls_segment_by_id(id, segment):
+    """
+    Get a pregenerated HLS segment of a video record, as listed in the playlist returned by the stream endpoint with format=hls
+    ---
+    security:
+        - JWT: []
+    tags:
+        - Records
+    parameters:
+        - in: path
+          name: id
+          type: string
+          required: true
+          description: id of the record
+        - in: path
+          name: segment
+          type: string
+          required: true
+          description: segment file name (e.g. 00001.ts)
+    responses:
+        200:
+            description: MPEG-TS segment with HTTP caching and Range support
+        404:
+            description: The record is not a video
+        500:
+            description: Record does not exist, no access permission or segment not found
+    """
+    current_user = get_jwt_identity()
+    return services.get_hls_segment(id, current_user, segment)
+
 @bp.route('/download', methods=['POST'])
 @jwt_required()
 def download_records():
@@ -529,6 +574,9 @@ def get_result_by_id(id):
                 slug:
                     type: string
                     description: identifier of the processing (plugin) the result is wanted from
+                page:
+                    type: integer
+                    description: optional page index (0-based); when sent only that page of a paged result is returned
             required:
                 - slug
     responses:
@@ -543,7 +591,7 @@ def get_result_by_id(id):
     body = request.json
 
     # Llamar al servicio para obtener un record por su id
-    resp = services.get_processing_result(id, body['slug'], current_user)
+    resp = services.get_processing_result(id, body['slug'], current_user, body.get('page'))
 
     return resp
 
@@ -607,12 +655,15 @@ def get_page_by_id(id):
                 gallery:
                     type: boolean
                     description: if true, id is interpreted as a resource and images are retrieved from its gallery instead of a document's pages
+                binary:
+                    type: boolean
+                    description: if true, returns the page manifest (filenames, dimensions and file URLs) instead of base64-encoded images; pages is ignored
             required:
                 - pages
                 - size
     responses:
         200:
-            description: Images of the requested pages
+            description: Images of the requested pages, or the page manifest if binary is true
         500:
             description: Record/resource does not exist or no access permission, missing pages/size in the body, or another unexpected error
     """
@@ -623,9 +674,145 @@ def get_page_by_id(id):
 
     # Llamar al servicio para obtener un record por su id
     if 'gallery' in body and body['gallery'] == True:
-        return services.get_document_gallery(id, body.get('pages', []), body.get('size', 'small'), current_user, dzi=body.get('dzi', False), dzi_payload=body.get('dzi_payload'))
+        return services.get_document_gallery(id, body.get('pages', []), body.get('size', 'small'), current_user, dzi=body.get('dzi', False), dzi_payload=body.get('dzi_payload'), binary=body.get('binary', False))
+    else:
+        return services.get_document_pages(id, body.get('pages', []), body['size'], current_user, binary=body.get('binary', False))
+
+@bp.route('/<id>/pages/<int:page>/file', methods=['GET'])
+@jwt_required()
+def get_page_file_by_id(id, page):
+    """
+    Get the image file of a document page, streamed as binary with HTTP caching
+    ---
+    security:
+        - JWT: []
+    tags:
+        - Records
+    parameters:
+        - in: path
+          name: id
+          type: string
+          required: true
+          description: record id
+        - in: path
+          name: page
+          type: integer
+          required: true
+          description: page index (0-based)
+        - in: query
+          name: size
+          type: string
+          required: false
+          description: size of the page (small/big for documents, small/medium/large for images)
+    responses:
+        200:
+            description: Image file (supports ETag/Last-Modified and Range requests)
+        304:
+            description: The image has not changed
+        500:
+            description: Record does not exist, no access permission, page out of range or another unexpected error
+    """
+    # Obtener el usuario actual
+    current_user = get_jwt_identity()
+    size = request.args.get('size', 'small')
+
+    return services.get_document_page_file(id, page, size, current_user)
+
+@bp.route('/<id>/gallery/<int:index>/file', methods=['GET'])
+@jwt_required()
+def get_gallery_file_by_id(id, index):
+    """
+    Get an image of a resource gallery, streamed as binary with HTTP caching
+    ---
+    security:
+        - JWT: []
+    tags:
+        - Records
+    parameters:
+        - in: path
+          name: id
+          type: string
+          required: true
+          description: resource id
+        - in: path
+          name: index
+          type: integer
+          required: true
+          description: position of the image in the gallery (0-based)
+        - in: query
+          name: size
+          type: string
+          required: false
+          description: size of the image (small/medium/large)
+    responses:
+        200:
+            description: Image file (supports ETag/Last-Modified and Range requests)
+        304:
+            description: The image has not changed
+        500:
+            description: Resource does not exist, no access permission, index out of range or another unexpected error
+    """
+    # Obtener el usuario actual
+    current_user = get_jwt_identity()
+    size = request.args.get('size', 'small')
+
+    return services.get_gallery_file(id, index, size, current_user)
+
+@bp.route('/<id>/thumbnail', methods=['GET'])
+def get_thumbnail_by_id(id):
+    """
+    Get the thumbnail of a record, streamed as binary with long lived HTTP caching
+    ---
+    security:
+        - JWT: []
+    tags:
+        - Records
+    parameters:
+        - in: path
+          name: id
+          type: string
+          required: true
+          description: record id
+        - in: query
+          name: size
+          type: string
+          required: false
+          description: size of the thumbnail (small/medium)
+        - in: query
+          name: v
+          type: string
+          required: false
+          description: version of the thumbnail, as returned by the search with thumbnails=url
+        - in: query
+          name: token
+          type: string
+          required: false
+          description: signed token returned in the search url, used instead of the JWT header so the url works in <img>
+    responses:
+        200:
+            description: Image file (supports ETag and is cacheable as immutable)
+        304:
+            description: The image has not changed
+        401:
+            description: Invalid or expired token
+        404:
+            description: Record does not exist, no access permission or the record has no thumbnail
+        500:
+            description: Invalid size or another unexpected error
+    """
+    size = request.args.get('size', 'small')
+    token = request.args.get('token')
+    if token:
+        # el token identifica al usuario que hizo la búsqueda; el acceso al record se vuelve a comprobar
+        current_user = services.read_thumbnail_token(token, id, size)
+        if current_user is None:
+            return {'msg': _('Invalid or expired token')}, 401
     else:
-        return services.get_document_pages(id, body['pages'], body['size'], current_user)
+        verify_jwt_in_request()
+        # Obtener el usuario actual
+        current_user = get_jwt_identity()
+
+    return services.get_thumbnail(id, size, current_user)
 
 @bp.route('/<id>/blocks', methods=['POST'])
 @jwt_required()
@@ -1,5 +1,5 @@
 import datetime
-from flask import jsonify, send_file, Response
+from flask import jsonify, send_file, Response, url_for
 from app.utils import DatabaseHandler
 from app.utils import CacheHandler
 from app.utils import HookHandler
@@ -11,14 +11,13 @@ from app.utils.LogActions import log_actions
 from app.api.logs.services import register_log
 from app.api.users.services import has_right
 from app.api.records.models import RecordUpdate as FileRecordUpdate
-from app.utils.functions import cache_get_record_stream, cache_get_record_transcription, cache_get_record_document_detail, cache_get_pages_by_id, cache_get_block_by_page_id, cache_get_imgs_gallery_by_id, cache_get_processing_metadata, has_role, cache_get_processing_result, get_dzi_data
+from app.utils.functions import cache_get_record_stream, cache_get_record_transcription, build_transcription_index, update_transcription_index, cache_get_record_document_detail, cache_get_pages_by_id, cache_get_block_by_page_id, cache_get_imgs_gallery_by_id, cache_get_processing_metadata, has_role, cache_get_processing_result, get_dzi_data, cache_get_pages_manifest, cache_get_gallery_manifest, public_manifest, get_page_file, get_gallery_image_file, send_web_file, get_records_paths, get_thumbnail_file, send_thumbnail_file, read_thumbnail_token, get_media_fragment, send_media_fragment, get_hls_segments, get_hls_slice, get_hls_segment_file, FRAGMENTS_MAX_AGE, mark_stats_stale
 from werkzeug.utils import secure_filename
 import os
 import shutil
 import hashlib
 import magic
 import uuid
-import ffmpeg
 from dotenv import load_dotenv
 from flask_babel import _
 import re
@@ -198,9 +197,14 @@ def update_record_by_id(id, current_user, body):
 
         mongodb.update_record('records', {'_id': ObjectId(id)}, update)
 
+        # Precalcular las páginas de las transcripciones que llegan en la actualización
+        for slug, processing_entry in (body.get('processing') or {}).items():
+            if isinstance(processing_entry, dict) and processing_entry.get('type') == 'av_transcribe' and isinstance(processing_entry.get('result'), dict):
+                build_transcription_index(id, slug, processing_entry['result'], body['updatedAt'])
+
         register_log(current_user, log_actions['record_update'], {
             'record': id})
-        get_by_id.invalidate_all()
+        cacheHandler.invalidate_tags('record:' + str(id))
 
         payload = body
         payload['_id'] = id
@@ -228,6 +232,10 @@ def delete_parent(resource_id, parent_id, current_user):
         if not any(x['id'] == resource_id for x in record['parent']):
             return {'msg': _('Record does not have the resource as parent')}, 404
 
+        # estadísticas que dependen de los padres actuales del record
+        stale_post_types = [x.get('post_type') for x in record['parent'] + record.get('parents', []) if isinstance(x, dict)]
+        stale_parents = [x.get('id') for x in record['parent'] + record.get('parents', []) if isinstance(x, dict)]
+
         # Si el record tiene el recurso como parent, eliminarlo
         # el parent es de tipo dict y tiene los campos id y post_type
         record['parent'] = [x for x in record['parent']
@@ -271,6 +279,7 @@ def delete_parent(resource_id, parent_id, current_user):
         })
 
         mongodb.update_record('records', {'_id': ObjectId(parent_id)}, update)
+        mark_stats_stale(stale_post_types, stale_parents)
 
         # Registrar el log
         register_log(current_user, log_actions['record_update'], {
@@ -418,7 +427,7 @@ def create(resource_id, current_user, files, upload=True, filesTags=None, parent
                 payload['_id'] = str(record['_id'])
                 hookHandler.call('record_update_parent', payload)
                 # limpiar la cache
-                get_by_id.invalidate_all()
+                cacheHandler.invalidate_tags('record:' + str(record['_id']))
             else:
                 if upload:
                     # obtener el tamaño del archivo
@@ -510,6 +519,9 @@ def create(resource_id, current_user, files, upload=True, filesTags=None, parent
             raise Exception(_('File type not allowed'))
 
         index += 1
+
+    if resp:
+        mark_stats_stale([resource['post_type']], [resource_id, *[p['id'] for p in resource['parents']]])
     # retornar el resultado
     return resp
 
@@ -533,7 +545,7 @@ def get_hash(hash):
 # Nuevo servicio para obtener un record por su id verificando el usuario
 
 
-@cacheHandler.cache.cache(limit=5000)
+@cacheHandler.tagged('record', limit=5000)
 def get_by_id(id, current_user, fullFields=False):
     try:
         # Buscar el record en la base de datos
@@ -643,102 +655,18 @@ def _parse_ms(value):
         return None
 
 
-def _stream_video_fragment(path, record_id, start_ms, end_ms):
-    start_sec = start_ms
-    duration_sec = (end_ms - start_ms)
-    if duration_sec <= 0:
+def _stream_fragment(path, record_id, start_ms, end_ms):
+    if end_ms - start_ms <= 0:
         return None
 
-    if not TEMPORAL_FILES_PATH:
-        return {'msg': _('Temporal path is not configured')}, 500
-    if not os.path.exists(TEMPORAL_FILES_PATH):
-        os.makedirs(TEMPORAL_FILES_PATH)
-
-    temp_filename = f"{record_id}_{start_ms}_{end_ms}_fragment.mp4"
-    temp_path = os.path.join(TEMPORAL_FILES_PATH, temp_filename)
-
-    if os.path.exists(temp_path) and os.path.getsize(temp_path) > 0:
-        response = send_file(temp_path, as_attachment=False)
-        response.call_on_close(lambda: os.path.exists(temp_path) and os.remove(temp_path))
-        return response
-    if os.path.exists(temp_path):
-        os.remove(temp_path)
-
     try:
-        (
-            ffmpeg
-            .input(path)
-            .output(
-                temp_path,
-                ss=start_sec,
-                t=duration_sec,
-                vcodec='libx264',
-                acodec='aac',
-                movflags='faststart',
-                avoid_negative_ts='make_zero',
-                **{'fflags': '+genpts'}
-            )
-            .run(capture_stdout=True, capture_stderr=True)
-        )
-    except ffmpeg.Error as e:
-        error_output = e.stderr.decode('utf-8', errors='replace') if e.stderr else str(e)
-        return {'msg': error_output or 'ffmpeg failed to produce output'}, 500
-
-    if not os.path.exists(temp_path) or os.path.getsize(temp_path) == 0:
-        error_output = ''
-        return {'msg': error_output or 'ffmpeg failed to produce output'}, 500
-
-    response = send_file(temp_path, as_attachment=False)
-    response.call_on_close(lambda: os.path.exists(temp_path) and os.remove(temp_path))
-    return response
-
-def _stream_audio_fragment(path, record_id, start_ms, end_ms):
-    start_sec = start_ms
-    duration_sec = (end_ms - start_ms)
-    if duration_sec <= 0:
-        return None
-
-    if not TEMPORAL_FILES_PATH:
-        return {'msg': _('Temporal path is not configured')}, 500
-    if not os.path.exists(TEMPORAL_FILES_PATH):
-        os.makedirs(TEMPORAL_FILES_PATH)
+        fragment = get_media_fragment(path, record_id, start_ms, end_ms)
+    except Exception as e:
+        return {'msg': str(e) or 'ffmpeg failed to produce output'}, 500
 
-    temp_filename = f"{record_id}_{start_ms}_{end_ms}_fragment.mp3"
-    temp_path = os.path.join(TEMPORAL_FILES_PATH, temp_filename)
+    return send_media_fragment(fragment, private=True, as_attachment=False)
 
-    if os.path.exists(temp_path) and os.path.getsize(temp_path) > 0:
-        response = send_file(temp_path, as_attachment=False)
-        response.call_on_close(lambda: os.path.exists(temp_path) and os.remove(temp_path))
-        return response
-    if os.path.exists(temp_path):
-        os.remove(temp_path)
-
-    try:
-        (
-            ffmpeg
-            .input(path)
-            .output(
-                temp_path,
-                ss=start_sec,
-                t=duration_sec,
-                acodec='libmp3lame',
-            )
-            .run(capture_stdout=True, capture_stderr=True)
-        )
-    except ffmpeg.Error as e:
-        error_output = e.stderr.decode('utf-8', errors='replace') if e.stderr else str(e)
-        return {'msg': error_output or 'ffmpeg failed to produce output'}, 500
-
-    if not os.path.exists(temp_path) or os.path.getsize(temp_path) == 0:
-        error_output = ''
-        return {'msg': error_output or 'ffmpeg failed to produce output'}, 500
-
-    response = send_file(temp_path, as_attachment=False)
-    response.call_on_close(lambda: os.path.exists(temp_path) and os.remove(temp_path))
-    return response
-
-
-def get_stream(id, current_user, size='large', start_ms=None, end_ms=None):
+def get_stream(id, current_user, size='large', start_ms=None, end_ms=None, format=None):
     try:
         resp_, status = get_by_id(id, current_user, True)
         if status != 200:
@@ -761,13 +689,24 @@ def get_stream(id, current_user, size='large', start_ms=None, end_ms=None):
                 path = path + '_small.jpg'
         start_val = _parse_ms(start_ms)
         end_val = _parse_ms(end_ms)
+        if format == 'hls':
+            if (start_ms is not None or end_ms is not None) and (start_val is None or end_val is None or start_val < 0 or end_val <= start_val):
+                return {'msg': _('Invalid start_ms or end_ms')}, 400
+            segments = get_hls_segments(os.path.splitext(path)[0]) if type == 'video' else None
+            if not segments:
+                return {'msg': _('File not found')}, 404
+            response = get_hls_slice(segments, start_val, end_val, lambda name: url_for('records.get_hls_segment_by_id', id=id, segment=name))
+            if response:
+                return response
+            return {'msg': _('Invalid start_ms or end_ms')}, 400
+
         if type == 'video' and (start_ms is not None or end_ms is not None):
             if start_val is None or end_val is None:
                 return {'msg': _('Invalid start_ms or end_ms')}, 400
             if start_val < 0 or end_val <= start_val:
                 return {'msg': _('Invalid start_ms or end_ms')}, 400
 
-            response = _stream_video_fragment(path, id, start_val, end_val)
+            response = _stream_fragment(path, id, start_val, end_val)
             if response:
                 return response
         elif type == 'audio' and (start_ms is not None or end_ms is not None):
@@ -776,7 +715,7 @@ def get_stream(id, current_user, size='large', start_ms=None, end_ms=None):
             if start_val < 0 or end_val <= start_val:
                 return {'msg': _('Invalid start_ms or end_ms')}, 400
 
-            response = _stream_audio_fragment(path, id, start_val, end_val)
+            response = _stream_fragment(path, id, start_val, end_val)
             if response:
                 return response
 
@@ -800,13 +739,16 @@ def get_processing_metadata(id, slug, current_user):
         return {'msg': str(e)}, 500
 
 
-def get_processing_result(id, slug, current_user):
+def get_processing_result(id, slug, current_user, page=None):
     try:
         resp_, status = get_by_id(id, current_user)
         if status != 200:
             return {'msg': resp_['msg']}, 500
 
-        resp = cache_get_processing_result(id, slug)
+        if page is None:
+            resp = cache_get_processing_result(id, slug)
+        else:
+            resp = cache_get_processing_result(id, slug, page)
 
         return resp, 200
     except Exception as e:
@@ -815,6 +757,22 @@ def get_processing_result(id, slug, current_user):
 # Nuevo servicio para devolver la transcripcion de un plugin
 
 
+# Segmento HLS pregenerado de un video, con los mismos permisos que el stream
+def get_hls_segment(id, current_user, segment):
+    try:
+        resp_, status = get_by_id(id, current_user, True)
+        if status != 200:
+            return {'msg': resp_['msg']}, 500
+
+        path, type = cache_get_record_stream(id)
+        if type != 'video':
+            return {'msg': _('File not found')}, 404
+
+        file = get_hls_segment_file(os.path.join(WEB_FILES_PATH, path), segment)
+        return send_web_file(file, private=True, max_age=FRAGMENTS_MAX_AGE)
+    except Exception as e:
+        return {'msg': str(e)}, 500
+
 def get_transcription(id, slug, current_user, page):
     try:
         resp_, status = get_by_id(id, current_user)
@@ -842,11 +800,17 @@ def get_document(id, current_user):
         return {'msg': str(e)}, 500
 
 
-def get_document_pages(id, pages, size, current_user):
+def get_document_pages(id, pages, size, current_user, binary=False):
     try:
         resp_, status = get_by_id(id, current_user)
         if status != 200:
             return {'msg': resp_['msg']}, 500
+        if binary:
+            manifest = cache_get_pages_manifest(id, size)
+            entries = public_manifest(manifest['pages'])
+            for x, entry in enumerate(entries):
+                entry['url'] = url_for('records.get_page_file_by_id', id=id, page=x, size=size)
+            return {'type': manifest['type'], 'total': len(entries), 'pages': entries}, 200
         pages = json.dumps(pages)
         resp = cache_get_pages_by_id(id, pages, size)
         response = Response(json.dumps(resp).encode(
@@ -856,13 +820,19 @@ def get_document_pages(id, pages, size, current_user):
         return {'msg': str(e)}, 500
 
 
-def get_document_gallery(id, pages, size, current_user, dzi=False, dzi_payload=None):
+def get_document_gallery(id, pages, size, current_user, dzi=False, dzi_payload=None, binary=False):
     try:
         from app.api.resources.services import get_by_id as get_resource_by_id
         resp_, status = get_resource_by_id(id, current_user)
         if status != 200:
             return {'msg': resp_['msg']}, 500
 
+        if binary:
+            entries = public_manifest(cache_get_gallery_manifest(id, size))
+            for x, entry in enumerate(entries):
+                entry['url'] = url_for('records.get_gallery_file_by_id', id=id, index=x, size=size)
+            return {'total': len(entries), 'pages': entries}, 200
+
         if dzi and dzi_payload:
             resp = get_dzi_data(id, pages, dzi_payload)
             response = Response(json.dumps(resp).encode(
@@ -879,6 +849,45 @@ def get_document_gallery(id, pages, size, current_user, dzi=False, dzi_payload=N
         return {'msg': str(e)}, 500
 
 
+def get_document_page_file(id, page, size, current_user):
+    try:
+        resp_, status = get_by_id(id, current_user)
+        if status != 200:
+            return {'msg': resp_['msg']}, 500
+
+        return send_web_file(get_page_file(id, page, size), private=True)
+    except Exception as e:
+        return {'msg': str(e)}, 500
+
+
+def get_gallery_file(id, index, size, current_user):
+    try:
+        from app.api.resources.services import get_by_id as get_resource_by_id
+        resp_, status = get_resource_by_id(id, current_user)
+        if status != 200:
+            return {'msg': resp_['msg']}, 500
+
+        return send_web_file(get_gallery_image_file(id, index, size), private=True)
+    except Exception as e:
+        return {'msg': str(e)}, 500
+
+
+# Retorna la miniatura de un record. La url que arma el buscador lleva la versión del archivo, así que se puede cachear como inmutable
+def get_thumbnail(id, size, current_user):
+    try:
+        path = get_records_paths([id], current_user).get(id)
+        if not path:
+            return {'msg': _('Record does not exist')}, 404
+
+        file = get_thumbnail_file(path, size)
+        if not os.path.exists(file):
+            return {'msg': _('File not found')}, 404
+
+        return send_thumbnail_file(file, private=True)
+    except Exception as e:
+        return {'msg': str(e)}, 500
+
+
 def get_document_block_by_page(current_user, id, page, slug, block=None):
     try:
         resp_, status = get_by_id(id, current_user)
@@ -1133,8 +1142,7 @@ def delete_transcription_segment(id, body, user):
     payload['_id'] = id
     hookHandler.call('record_update', payload)
 
-    cache_get_record_transcription.invalidate(id, slug)
-    cache_get_record_transcription.invalidate(id, slug, False)
+    update_transcription_index(id, slug, update.processing[slug]['result'], [index], update.updatedAt)
 
     return {'msg': _('Transcription segment deleted')}, 200
 
@@ -1168,11 +1176,13 @@ def edit_transcription_speaker(id, body, user):
         updateSpeaker = body['speaker']
         oldSpeaker = body['oldSpeaker']
 
+    changed = []
     if updateSpeaker:
-        for segment in segments:
+        for i, segment in enumerate(segments):
             if 'speaker' in segment:
                 if segment['speaker'] == oldSpeaker:
                     segment['speaker'] = updateSpeaker
+                    changed.append(i)
 
     update = {
         'processing': record['processing'],
@@ -1191,8 +1201,7 @@ def edit_transcription_speaker(id, body, user):
     payload['_id'] = id
     hookHandler.call('record_update', payload)
 
-    cache_get_record_transcription.invalidate(id, slug)
-    cache_get_record_transcription.invalidate(id, slug, False)
+    update_transcription_index(id, slug, update.processing[slug]['result'], changed, update.updatedAt)
 
     return {'msg': _('Transcription speaker edited')}, 200
 
@@ -1245,8 +1254,7 @@ def edit_transcription(id, body, user):
     payload['_id'] = id
     hookHandler.call('record_update', payload)
 
-    cache_get_record_transcription.invalidate(id, slug)
-    cache_get_record_transcription.invalidate(id, slug, False)
+    update_transcription_index(id, slug, update.processing[slug]['result'], [body['index']], update.updatedAt)
 
     return {'msg': _('Transcription segment edited')}, 200
 
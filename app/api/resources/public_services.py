@@ -11,11 +11,12 @@ from app.api.system.services import get_value_by_path, set_value_in_dict
 from app.api.system.services import get_default_visible_type
 from app.api.lists.services import get_option_by_id
 from app.utils.functions import get_resource_records_public, cache_type_roles, clear_cache
+from app.utils.functions import get_zip_entries, get_zip_path, send_zip_stream
 import os
 from flask_babel import _
 from datetime import datetime
 from dateutil import parser
-from app.api.resources.services import get_total, get_accessRights, get_resource_type, get_children, get_children_cache
+from app.api.resources.services import get_total, get_accessRights, get_resource_type, get_children, get_children_cache, count_children
 
 mongodb = DatabaseHandler.DatabaseHandler()
 cacheHandler = CacheHandler.CacheHandler()
@@ -25,9 +26,12 @@ children_cache = {}
 ORIGINAL_FILES_PATH = os.environ.get('ORIGINAL_FILES_PATH', '')
 WEB_FILES_PATH = os.environ.get('WEB_FILES_PATH', '')
 
-def update_cache():
+# Si se pasan ids, las entradas de cada recurso se invalidan por etiqueta desde resources.services.update_cache
+def update_cache(ids=None):
     get_all.invalidate_all()
     get_tree.invalidate_all()
+    if ids is not None:
+        return
     get_resource.invalidate_all()
     get_resource_files.invalidate_all()
     get_resource_images.invalidate_all()
@@ -147,7 +151,7 @@ def get_by_id(id):
     except Exception as e:
         return {'msg': str(e)}, 500
 
-@cacheHandler.cache.cache(limit=5000)
+@cacheHandler.tagged('resource', limit=5000)
 def get_resource(id):
     # Buscar el recurso en la base de datos
     resource = mongodb.get_record('resources', {'_id': ObjectId(id), 'status': 'published'}, fields={'updatedAt': 0, 'updatedBy': 0})
@@ -483,7 +487,7 @@ def get_resource(id):
 
     return resource
 
-@cacheHandler.cache.cache(limit=1000)
+@cacheHandler.tagged('resource', limit=1000)
 def get_resource_files(id, page, groupImages = False):
     try:
         resource = mongodb.get_record('resources', {'_id': ObjectId(id), 'status': 'published'})
@@ -552,8 +556,11 @@ def get_tree(root, available, post_type=None, page=0):
         resources = [{'name': re['metadata']['firstLevel']['title'], 'post_type': re['post_type'], 'id': str(
             re['_id'])} for re in resources]
 
+        # Contar los hijos de todos los nodos en una sola agregación
+        counts, children = count_children([r['id'] for r in resources], available, post_type)
         for resource in resources:
-            resource['children'] = get_children(resource['id'], available, False, post_type)
+            resource['childrenCount'] = counts.get(resource['id'], 0)
+            resource['children'] = children[resource['id']]
             resource['icon'] = get_icon(resource['post_type'])
             
         # Retornar los recursos y los padres
@@ -561,7 +568,7 @@ def get_tree(root, available, post_type=None, page=0):
     except Exception as e:
         return {'msg': str(e)}, 500
 
-@cacheHandler.cache.cache()
+@cacheHandler.tagged('resource')
 def get_resource_images(id):
     resource = mongodb.get_record('resources', {'_id': ObjectId(id), 'status': 'published'}, fields={'filesObj': 1})
 
@@ -604,36 +611,17 @@ def download_resource_files(body):
                 
 
         r_ = get_resource_records_public(json.dumps(ids), 0, None, False)
-        zippath = os.path.join(WEB_FILES_PATH, 'zipfiles', 'public-' + body['id'] + '-' + body['type'] + '.zip')
-        
-        if not os.path.exists(zippath):
-            os.makedirs(os.path.dirname(zippath), exist_ok=True)
+        entries = get_zip_entries(r_, body['type'])
+        if len(entries) == 0:
+            return {'msg': _('File does not exist')}, 404
 
-            import zipfile
-            zipf = zipfile.ZipFile(zippath, 'w', zipfile.ZIP_DEFLATED)
-            
-            for _ in r_:
-                if _['filepath']:
-                    if body['type'] == 'original':
-                        path = os.path.join(ORIGINAL_FILES_PATH, _['filepath'])
-                        zipf.write(path, _['name'])
-                        
-                    elif body['type'] == 'small':
-                        path = os.path.join(WEB_FILES_PATH, _['processing']['fileProcessing']['path'])
-                        
-                        if _['processing']['fileProcessing']['type'] == 'image':
-                            path = path + '_large.jpg'
-                        elif _['processing']['fileProcessing']['type'] == 'audio':
-                            path = path + '.mp3'
-                        elif _['processing']['fileProcessing']['type'] == 'video':
-                            path = path + '.mp4'
-                        elif _['processing']['fileProcessing']['type'] == 'document':
-                            path = os.path.join(ORIGINAL_FILES_PATH, _['filepath'])
-                        zipf.write(path, _['name'])
-                    
-            zipf.close()
+        zippath = get_zip_path(entries)
+        filename = body['id'] + '-' + body['type'] + '.zip'
+
+        if not os.path.exists(zippath):
+            return send_zip_stream(entries, filename, zippath)
         
-        return send_file(zippath, as_attachment=True)
+        return send_file(zippath, as_attachment=True, download_name=filename)
                     
     except Exception as e:
         return {'msg': str(e)}, 500
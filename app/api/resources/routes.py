@@ -42,6 +42,12 @@ def get_all():
                 page:
                     type: integer
                     description: Page (internally multiplied by a fixed limit of 20)
+                cursor:
+                    type: string
+                    description: >
+                        Keyset pagination by (sortBy, _id). Send null for the first page and then the "next" or
+                        "prev" token of the previous response; when present "page" is ignored and the response
+                        also includes the next and prev tokens
                 parents:
                     type: object
                     properties:
@@ -67,7 +73,7 @@ def get_all():
                     default: asc
     responses:
         200:
-            description: "Object { total, resources } with the retrieved resources"
+            description: "Object { total, resources } with the retrieved resources ({ total, resources, next, prev } when cursor is sent)"
         401:
             description: Not authorized to view one of the requested content types, or requesting status=deleted without permission
         500:
@@ -899,11 +905,16 @@ def download_all_records():
                     type: string
                     enum: [original, small]
                     description: Required; which file variant to download
+                background:
+                    type: boolean
+                    description: If true and the resource has several files, the zip is generated by a background task whose result is an expiring download link
     produces:
         - application/octet-stream
     responses:
         200:
-            description: Binary file (attachment); a single file directly, or a .zip if the resource has more than one
+            description: Binary file (attachment); a single file directly, or a .zip streamed while it is generated if the resource has more than one
+        201:
+            description: The zip generation was queued as a background task
         400:
             description: The 'files_download' capability is not active in the system configuration
         401:
@@ -920,6 +931,32 @@ def download_all_records():
 
     return services.download_resource_files(body, current_user)
 
+@bp.route('/zip/<token>', methods=['GET'])
+def download_zip(token):
+    """
+    Download a zip generated by a background task using its signed, expiring link
+    ---
+    tags:
+        - Resources
+    parameters:
+        - in: path
+          name: token
+          type: string
+          required: true
+    produces:
+        - application/zip
+    responses:
+        200:
+            description: Zip file (attachment)
+        404:
+            description: Invalid link, or the zip file no longer exists
+        410:
+            description: The download link has expired
+        500:
+            description: Error sending the file
+    """
+    return services.download_zip_file(token)
+
    
 @bp.route('/<resource_id>/imgs', methods=['GET'])
 @jwt_required()
@@ -29,6 +29,11 @@ from app.api.records.models import RecordUpdate as FileRecordUpdate
 from app.api.system.services import get_access_rights
 from app.api.users.services import has_right, has_role
 from app.utils.functions import get_resource_records, cache_type_roles, clear_cache
+from app.utils.functions import get_download_path, get_zip_entries, get_zip_path, send_zip_stream, write_zip
+from app.utils.functions import get_zip_download_token, read_zip_download_token
+from app.utils.functions import get_keyset_page
+from app.utils.functions import mark_stats_stale
+from app.api.tasks.services import add_task
 from app.api.types.services import get_by_slug
 import os
 from datetime import datetime
@@ -38,6 +43,8 @@ import re
 import html
 from flask_babel import _
 from html.parser import HTMLParser
+from celery import shared_task
+from pymongo.errors import BulkWriteError
 
 class _HTMLStripper(HTMLParser):
     def __init__(self):
@@ -304,8 +311,13 @@ def get_all(body, user):
                 if metadata_field and metadata_field['type'] != 'text':
                     filters[col] = {'$exists': True, '$ne': None}
                     
-        resources = list(mongodb.get_all_records(
-            'resources', filters, limit=limit, skip=skip, fields=fields, sort=[(sortBy, sort_direction)]))
+        # Si se envía cursor (null para la primera página) se pagina por (sortBy, _id)
+        keyset = 'cursor' in body
+        if keyset:
+            resources, next_cursor, prev_cursor = get_keyset_page('resources', filters, sortBy, sort_direction, limit, body['cursor'], fields=fields)
+        else:
+            resources = list(mongodb.get_all_records(
+                'resources', filters, limit=limit, skip=skip, fields=fields, sort=[(sortBy, sort_direction)]))
         # Obtener el total de recursos dado un tipo de contenido
         total = get_total(json.dumps(filters))
         
@@ -346,6 +358,9 @@ def get_all(body, user):
             'total': total,
             'resources': resources
         }
+        if keyset:
+            response['next'] = next_cursor
+            response['prev'] = prev_cursor
         
         # Retornar los recursos
         return response, 200
@@ -420,12 +435,14 @@ def create(body, user, files, updateCache = True):
         # Insertar el recurso en la base de datos
         new_resource = mongodb.insert_record('resources', resource)
         body['_id'] = str(new_resource.inserted_id)
+        sync_resource_tree(body['_id'], body['parent'])
+        mark_stats_stale([body['post_type']])
         # Registrar el log
         register_log(user, log_actions['resource_create'], {'resource': body})
 
         # limpiar la cache
         if updateCache:
-            update_cache()
+            update_cache(get_cache_ids(body['_id'], body.get('parent')))
         
         hookHandler.call('resource_create', body)
 
@@ -459,7 +476,7 @@ def create(body, user, files, updateCache = True):
             
             # limpiar la cache
             if updateCache:
-                update_cache()
+                update_cache(get_cache_ids(body['_id'], body.get('parent')))
             
             hookHandler.call('resource_files_create', update)
 
@@ -541,8 +558,13 @@ def update_by_id(id, body, user, files, updateCache = True):
             'resources', {'_id': ObjectId(id)}, resource)
 
         if has_new_parent:
+            sync_resource_tree(id, body['parent'])
             update_parents(id, body['post_type'], user)
             update_records_parents(id, user)
+            # los records del recurso y de sus descendientes cambian de padres
+            mark_stats_stale()
+        else:
+            mark_stats_stale([body['post_type']])
 
         try:
             records = create_record(id, user, files, filesTags = temp_files_obj)
@@ -586,9 +608,9 @@ def update_by_id(id, body, user, files, updateCache = True):
 
         # Registrar el log
         register_log(user, log_actions['resource_update'], {'resource': body})
-        # limpiar la cache
+        # limpiar la cache, si cambió el padre cambia el árbol de todos los descendientes
         if updateCache:
-            update_cache()
+            update_cache(None if has_new_parent else get_cache_ids(id, body.get('parent')))
         # Retornar el resultado
         return {'msg': _('Resource updated successfully')}, 200
     except Exception as e:
@@ -649,7 +671,7 @@ def update_granular_by_id(id, metadata_path, value, user, concat=False, updateCa
 
         # Actualizamos caché una sola vez al final
         if updateCache:
-            update_cache()
+            update_cache([r['id'] for r in updated_resources])
 
         return {
             'msg': _('Resource updated successfully'),
@@ -748,7 +770,7 @@ def update_resource_granular(resource_id, metadata_path, value, user, concat=Fal
             })
 
         if updateCache:
-            update_cache()
+            update_cache([str(resource_id)])
 
         return {
             'msg': _('Resource updated successfully'),
@@ -1258,14 +1280,14 @@ def get_by_id(id, user, postQuery = False):
     except Exception as e:
         return {'msg': str(e)}, 500
 
-@cacheHandler.cache.cache(limit=5000)
+@cacheHandler.tagged('resource', limit=5000)
 def get_resource_type(id):
     resource = mongodb.get_record('resources', {'_id': ObjectId(id)}, fields={'post_type': 1})
     if not resource:
         raise Exception(_('Resource does not exist'))
     return resource['post_type']
 
-@cacheHandler.cache.cache(limit=5000)
+@cacheHandler.tagged('resource', limit=5000)
 def get_accessRights(id):
     # Buscar el recurso en la base de datos
     resource = mongodb.get_record('resources', {'_id': ObjectId(id)}, fields={'accessRights': 1, 'parents': 1})
@@ -1273,6 +1295,9 @@ def get_accessRights(id):
     if not resource:
         raise Exception(_('Resource does not exist'))
     
+    # el valor se hereda de los padres, así que la entrada también depende de ellos
+    cacheHandler.tag(*['resource:' + str(r['id']) for r in resource.get('parents', [])])
+    
     if 'accessRights' in resource:
         if resource['accessRights']:
             temp = get_option_by_id(resource['accessRights'])
@@ -1468,7 +1493,7 @@ def _build_resource_fields(temp, resource, user):
 
     return temp
 
-@cacheHandler.cache.cache(limit=5000)
+@cacheHandler.tagged('resource', limit=5000)
 def get_resource(id, user, postQuery = False):
     # Buscar el recurso en la base de datos
     resource = mongodb.get_record('resources', {'_id': ObjectId(id)}, fields={'updatedAt': 0, 'updatedBy': 0, 'articleBody': 0})
@@ -1493,6 +1518,7 @@ def get_resource(id, user, postQuery = False):
     
     if 'parents' in resource:
         if resource['parents']:
+            cacheHandler.tag(*['resource:' + str(r['id']) for r in resource['parents']])
             for r in resource['parents']:
                 print(r)
                 r_ = mongodb.get_record('resources', {'_id': ObjectId(r['id'])}, fields={'metadata.firstLevel.title': 1, 'post_type': 1})
@@ -1657,7 +1683,7 @@ def get_resource(id, user, postQuery = False):
 
     return resource
 
-@cacheHandler.cache.cache(limit=1000)
+@cacheHandler.tagged('resource', limit=1000)
 def get_resource_files(id, user, page, groupImages = False):
     try:
         resource = mongodb.get_record('resources', {'_id': ObjectId(id)}, fields={'filesObj': 1})
@@ -1709,7 +1735,7 @@ def get_resource_files(id, user, page, groupImages = False):
     except Exception as e:
         return {'msg': str(e)}, 500
 
-@cacheHandler.cache.cache(limit=1000)
+@cacheHandler.tagged('resource', limit=1000)
 def get_article_body(id, user):
     try:
         resource = mongodb.get_record('resources', {'_id': ObjectId(id)}, fields={'articleBody': 1})
@@ -1951,63 +1977,62 @@ def download_resource_files(body, user):
                 
         if len(ids) > 1:
             r_ = get_resource_records(json.dumps(ids), user, 0, None, False)
-            zippath = os.path.join(WEB_FILES_PATH, 'zipfiles', user + '-' + body['id'] + '-' + body['type'] + '.zip')
-            
-            if not os.path.exists(zippath):
-                os.makedirs(os.path.dirname(zippath), exist_ok=True)
+            entries = get_zip_entries(r_, body['type'])
+            if len(entries) == 0:
+                return {'msg': _('File does not exist')}, 404
 
-                import zipfile
-                zipf = zipfile.ZipFile(zippath, 'w', zipfile.ZIP_DEFLATED)
-                
-                for re in r_:
-                    if re['filepath']:
-                        if body['type'] == 'original':
-                            path = os.path.join(ORIGINAL_FILES_PATH, re['filepath'])
-                            zipf.write(path, re['name'])
-                            
-                        elif body['type'] == 'small':
-                            path = os.path.join(WEB_FILES_PATH, re['processing']['fileProcessing']['path'])
-                            
-                            if re['processing']['fileProcessing']['type'] == 'image':
-                                path = path + '_large.jpg'
-                            elif re['processing']['fileProcessing']['type'] == 'audio':
-                                path = path + '.mp3'
-                            elif re['processing']['fileProcessing']['type'] == 'video':
-                                path = path + '.mp4'
-                            elif re['processing']['fileProcessing']['type'] == 'document':
-                                path = os.path.join(ORIGINAL_FILES_PATH, re['filepath'])
-                            zipf.write(path, re['name'])
-                        
-                zipf.close()
-            
-            
-            return send_file(zippath, as_attachment=True)
+            # el zip se identifica por el contenido, así que un cambio en los archivos genera uno nuevo
+            zippath = get_zip_path(entries)
+            filename = body['id'] + '-' + body['type'] + '.zip'
+
+            if os.path.exists(zippath):
+                return send_file(zippath, as_attachment=True, download_name=filename)
+
+            if body.get('background', False):
+                task = build_zip_file.delay(entries, zippath, filename)
+                add_task(task.id, 'resources.build_zip', user, 'msg')
+                return {'msg': _('The zip file is being generated. The download link will be available in your tasks')}, 201
+
+            return send_zip_stream(entries, filename, zippath)
         elif len(ids) == 1:
             r_ = mongodb.get_record('records', {'_id': ObjectId(ids[0]['id'])})
             if not r_:
                 return {'msg': _('File does not exist')}, 404
             
-            if body['type'] == 'original':
-                path = os.path.join(ORIGINAL_FILES_PATH, r_['filepath'])
-                filename = r_['name']
-            elif body['type'] == 'small':
-                path = os.path.join(WEB_FILES_PATH, r_['processing']['fileProcessing']['path'])
-                
-                if r_['processing']['fileProcessing']['type'] == 'image':
-                    path = path + '_large.jpg'
-                elif r_['processing']['fileProcessing']['type'] == 'audio':
-                    path = path + '.mp3'
-                elif r_['processing']['fileProcessing']['type'] == 'video':
-                    path = path + '.mp4'
-                elif r_['processing']['fileProcessing']['type'] == 'document':
-                    path = os.path.join(ORIGINAL_FILES_PATH, r_['filepath'])
-                    
-                filename = r_['name']
+            path = get_download_path(r_, body['type'])
+            filename = r_['name']
                 
             return send_file(path, as_attachment=True, download_name=filename)
                     
     except Exception as e:
         return {'msg': str(e)}, 500
+
+# Tarea para generar en segundo plano el zip de los archivos de un recurso. Retorna un enlace de descarga que expira
+@shared_task(ignore_result=False, name='resources.build_zip')
+def build_zip_file(entries, zippath, filename):
+    if not os.path.exists(zippath):
+        write_zip([tuple(e) for e in entries], zippath)
+
+    token = get_zip_download_token(zippath, filename)
+    return '/resources/zip/' + token
+
+# Servicio para descargar un zip generado en segundo plano a partir de su token
+def download_zip_file(token):
+    try:
+        from itsdangerous import BadSignature, SignatureExpired
+        try:
+            zippath, filename = read_zip_download_token(token)
+        except SignatureExpired:
+            return {'msg': _('The download link has expired')}, 410
+        except BadSignature:
+            return {'msg': _('Invalid download link')}, 404
+
+        if not os.path.exists(zippath):
+            return {'msg': _('File does not exist')}, 404
+
+        return send_file(zippath, as_attachment=True, download_name=filename, conditional=True)
+    except Exception as e:
+        return {'msg': str(e)}, 500
     
 def delete_zip_files():
     try:
@@ -2111,6 +2136,8 @@ def _restore_resource(resource_id, user):
         'updatedBy': user if user else 'system'
     })
     mongodb.update_record('resources', {'_id': ObjectId(resource_id)}, update)
+    # los records restaurados vuelven a contar en las estadísticas del recurso y de sus ancestros
+    mark_stats_stale([resource.get('post_type')], [resource_id, *[p['id'] for p in resource.get('parents', [])]])
 
     register_log(user, log_actions['resource_restore'], {'resource': resource_id, 'status': 'draft'})
     return None
@@ -2186,6 +2213,7 @@ def delete_by_id(ids, user):
                 'updatedBy': user if user else 'system'
             })
             mongodb.update_record('resources', {'_id': ObjectId(id)}, update)
+            mark_stats_stale([post_type], [id])
 
             hookHandler.call('resource_delete', {'_id': id})
             register_log(user, log_actions['resource_delete'], {'resource': id})
@@ -2244,7 +2272,7 @@ def restore_by_id(ids, user, recursive=False):
         return {'msg': str(e)}, 500
 
     
-@cacheHandler.cache.cache()
+@cacheHandler.tagged('resource')
 def get_resource_images(id, user):
     resource = mongodb.get_record('resources', {'_id': ObjectId(id)}, fields={'filesObj': 1})
 
@@ -2321,8 +2349,9 @@ def get_children_cache(root, available, post_type=None):
         resources = [{'name': re['metadata']['firstLevel']['title'], 'post_type': re['post_type'], 'id': str(
             re['_id'])} for re in resources]
 
+        counts, children = count_children([r['id'] for r in resources], available, post_type)
         for resource in resources:
-            resource['children'] = get_children(resource['id'], available, False, post_type)
+            resource['children'] = children[resource['id']]
             if resource['children']:
                 resource['icon'] = get_icon(resource['post_type'])
                 resp.append(resource)
@@ -2365,13 +2394,16 @@ def get_tree(root, available, user, post_type=None, page=None, status='published
 
         resources = [{'name': re['metadata']['firstLevel']['title'], 'post_type': re['post_type'], 'id': str(
             re['_id'])} for re in resources]
-        
+
+        # Contar los hijos de todos los nodos en una sola agregación
+        counts, children = count_children([r['id'] for r in resources], available, post_type, status)
+        types = {}
         for resource in resources:
-            resource['children'] = get_children(resource['id'], available, False, post_type, status=status, user=user)
-            resource['icon'] = get_icon(resource['post_type'])
-            resource['type'] = get_by_slug(resource['post_type'])
-            name = resource['type']['name']
-            resource['type'] = name
+            resource['childrenCount'] = counts.get(resource['id'], 0)
+            resource['children'] = children[resource['id']]
+            if resource['post_type'] not in types:
+                types[resource['post_type']] = (get_icon(resource['post_type']), get_by_slug(resource['post_type'])['name'])
+            resource['icon'], resource['type'] = types[resource['post_type']]
 
         # Retornar los recursos y los padres
         return resources, 200
@@ -2380,7 +2412,7 @@ def get_tree(root, available, user, post_type=None, page=None, status='published
         return {'msg': str(e)}, 500
 
 # Funcion para validar que el tipo del padre sea uno admitido por el hijo
-@cacheHandler.cache.cache(limit=1000)
+@cacheHandler.tagged(lambda post_type, compare: ['type:' + post_type, 'type:' + compare], limit=1000)
 def has_parent_postType(post_type, compare):
     try:
         # Obtener el tipo de post
@@ -2403,50 +2435,150 @@ def has_parent_postType(post_type, compare):
     except Exception as e:
         return {'msg': str(e)}, 500
 
+# Crea los índices de la colección resources_tree, el índice de ancestros (tabla de clausura) de los recursos
+def create_tree_indexes():
+    mongodb.create_index('resources_tree', [('descendant', 1), ('depth', 1)])
+    mongodb.create_index('resources_tree', [('ancestor', 1), ('depth', 1)])
+    mongodb.create_index('resources_tree', [('descendant', 1), ('ancestor', 1)], unique=True)
+
+def _direct_parents(id, parent):
+    if isinstance(parent, dict):
+        parent = [parent]
+    return [p for p in (parent or []) if isinstance(p, dict) and 'id' in p and p['id'] != id]
+
+# Funcion para calcular las filas de la tabla de clausura de un recurso a partir de sus padres directos y los ancestros de estos
+def _merge_tree_rows(id, parent, parent_ancestors):
+    rows = {}
+    for p in parent:
+        rows[p['id']] = {'descendant': id, 'ancestor': p['id'], 'depth': 1, 'post_type': p.get('post_type'), 'parentOf': [id]}
+
+    for a in parent_ancestors:
+        if a['ancestor'] == id:
+            continue
+        current = rows.get(a['ancestor'])
+        depth = a['depth'] + 1
+        # si un padre directo es a la vez ancestro de otro padre se conserva el nivel más profundo, como en get_parents
+        if current is None or current['depth'] < depth:
+            rows[a['ancestor']] = {'descendant': id, 'ancestor': a['ancestor'], 'depth': depth, 'post_type': a.get('post_type'), 'parentOf': list(a.get('parentOf', []))}
+        elif current['depth'] == depth:
+            current['parentOf'] = list(set(current['parentOf'] + a.get('parentOf', [])))
+
+    return list(rows.values())
+
+# Funcion para actualizar las filas de la tabla de clausura de un recurso
+def sync_resource_tree(id, parent):
+    parent = _direct_parents(id, parent)
+    rows = []
+    if parent:
+        # los ancestros de todos los padres se obtienen en una sola consulta
+        parent_ancestors = mongodb.get_all_records('resources_tree', {'descendant': {'$in': [p['id'] for p in parent]}}, fields={'_id': 0})
+        rows = _merge_tree_rows(id, parent, parent_ancestors)
+
+    _replace_tree_rows(id, rows)
+    return rows
+
+def _replace_tree_rows(id, rows):
+    mongodb.delete_records('resources_tree', {'descendant': id})
+    if rows:
+        try:
+            mongodb.insert_records('resources_tree', rows)
+        except BulkWriteError:
+            # otro proceso escribió las mismas filas en paralelo
+            pass
+
+# Tarea para reconstruir la tabla de clausura de todos los recursos
+@shared_task(ignore_result=False, name='resources.rebuild_tree')
+def rebuild_resources_tree():
+    create_tree_indexes()
+    resources = mongodb.get_all_records('resources', {}, fields={'_id': 1, 'parent': 1})
+    parents_map = {str(r['_id']): _direct_parents(str(r['_id']), r.get('parent')) for r in resources}
+    closure = {}
+
+    def ancestors_of(id, visiting):
+        if id in closure:
+            return closure[id]
+        visiting.add(id)
+        parent = [p for p in parents_map.get(id, []) if p['id'] not in visiting]
+        parent_ancestors = [a for p in parent for a in ancestors_of(p['id'], visiting)]
+        visiting.discard(id)
+        closure[id] = _merge_tree_rows(id, parent, parent_ancestors)
+        return closure[id]
+
+    mongodb.delete_records('resources_tree', {})
+    batch = []
+    total = 0
+    for id in parents_map:
+        batch.extend(ancestors_of(id, set()))
+        if len(batch) >= 5000:
+            mongodb.insert_records('resources_tree', batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        mongodb.insert_records('resources_tree', batch)
+        total += len(batch)
+
+    get_parents.invalidate_all()
+    return _('Resource tree rebuilt with %(count)s relations', count=total)
+
+# Funcion para contar en una sola agregación los hijos directos de varios recursos. Retorna el número de hijos de cada
+# recurso y si tiene descendientes de los tipos pedidos: los que no tienen hijos directos se revisan en una segunda
+# agregación, porque pueden tener descendientes de esos tipos más abajo en el árbol
+def count_children(ids, available, post_type=None, status='published'):
+    if not ids:
+        return {}, {}
+
+    list_available = available.split('|')
+    if post_type:
+        list_available = [post_type]
+
+    pipeline = [
+        {'$match': {'post_type': {'$in': list_available}, 'parent.id': {'$in': ids}, 'status': status}},
+        {'$project': {'_id': 0, 'parent.id': 1}},
+        {'$unwind': '$parent'},
+        {'$match': {'parent.id': {'$in': ids}}},
+        {'$group': {'_id': '$parent.id', 'count': {'$sum': 1}}}
+    ]
+    counts = {c['_id']: c['count'] for c in mongodb.aggregate('resources', pipeline)}
+
+    has_children = {id: id in counts for id in ids}
+    rest = [id for id in ids if id not in counts]
+    if rest:
+        pipeline = [
+            {'$match': {'post_type': {'$in': list_available}, 'parents.post_type': {'$in': available.split('|')}, 'parents.id': {'$in': rest}, 'status': status}},
+            {'$project': {'_id': 0, 'parents.id': 1}},
+            {'$unwind': '$parents'},
+            {'$match': {'parents.id': {'$in': rest}}},
+            {'$group': {'_id': '$parents.id'}}
+        ]
+        for c in mongodb.aggregate('resources', pipeline):
+            has_children[c['_id']] = True
+
+    return counts, has_children
+
 # Funcion para obtener los padres de un recurso
 @cacheHandler.cache.cache(limit=1000)
 def get_parents(id, level=1):
     try:
-        # Buscar el recurso en la base de datos
-        resource = mongodb.get_record('resources', {'_id': ObjectId(id)}, fields={'parent': 1})
-        # Si el recurso no existe, retornar error
-        if not resource:
-            return []
-        # Si el recurso no tiene padre, retornar una lista vacia
-        if 'parent' not in resource:
-            return []
-        else:
-            if resource['parent']:
-                parent = resource['parent']
-                if isinstance(parent, dict):
-                    parent = [parent]
-                
-                all_ancestors = []
+        # Buscar los ancestros del recurso en la tabla de clausura
+        rows = list(mongodb.get_all_records('resources_tree', {'descendant': id}, sort=[('depth', 1)], fields={'_id': 0}))
+
+        if not rows:
+            # Si el recurso no está en la tabla de clausura, calcular sus ancestros a partir de los padres y guardarlos
+            resource = mongodb.get_record('resources', {'_id': ObjectId(id)}, fields={'parent': 1})
+            # Si el recurso no existe o no tiene padre, retornar una lista vacia
+            if not resource or not resource.get('parent'):
+                return []
 
-                for p in parent:
-                    p['level'] = level
-                    p['parentOf'] = [id]
-                    all_ancestors.extend(get_parents(p['id'], level + 1))
-                
-                ancestor_ids = {ancestor['id'] for ancestor in all_ancestors}
-                final_direct_parents = [p for p in parent if p['id'] not in ancestor_ids]
-                
-                
-                parents = []
-                for p in final_direct_parents:
-                    parents.append(p)
-                    parents = [*parents, *get_parents(p['id'], level + 1)]
-                    
-                unique_parents = []
-                seen_ids = set()
-                for p in parents:
-                    if p['id'] not in seen_ids:
-                        unique_parents.append(p)
-                        seen_ids.add(p['id'])
+            parent = _direct_parents(id, resource['parent'])
+            parent_ancestors = []
+            for p in parent:
+                parent_ancestors.extend([{'ancestor': a['id'], 'depth': a['level'], 'post_type': a['post_type'], 'parentOf': a['parentOf']} for a in get_parents(p['id'])])
 
-                return unique_parents
-            else:
-                return []
+            rows = _merge_tree_rows(id, parent, parent_ancestors)
+            _replace_tree_rows(id, rows)
+            rows = sorted(rows, key=lambda r: r['depth'])
+
+        return [{'id': r['ancestor'], 'post_type': r['post_type'], 'level': r['depth'] + level - 1, 'parentOf': r['parentOf']} for r in rows]
     except Exception as e:
         raise Exception(str(e))
 
@@ -2546,6 +2678,7 @@ def update_parents(id, post_type, user):
                 update = ResourceUpdate(**{'parents': unique_parents, 'updatedBy': user, 'updatedAt': datetime.now()})
                 mongodb.update_record(
                     'resources', {'_id': ObjectId(child['id'])}, update)
+                sync_resource_tree(child['id'], parent)
                 update_parents(child['id'], child['post_type'], user)
 
     except Exception as e:
@@ -2604,6 +2737,7 @@ def delete_children(id, user=None):
                 })
                 mongodb.update_record(
                     'resources', {'_id': ObjectId(child['id'])}, update)
+                mark_stats_stale([child['post_type']], [child['id']])
                 
                 hookHandler.call('resource_delete', {'_id': child['id']})
 
@@ -2696,20 +2830,34 @@ def change_post_type(body, user):
     except Exception as e:
         return {'msg': str(e)}, 500
 
-def update_cache():
-    get_access_rights.invalidate_all()
-    get_resource.invalidate_all()
+# Limpia la cache de recursos. Si se pasan los ids de los recursos modificados solo se invalidan las entradas etiquetadas con
+# esos recursos; los listados y árboles dependen de todo el conjunto de recursos y siempre se invalidan completos
+def update_cache(ids=None):
+    from app.api.resources.public_services import update_cache as update_cache_public
+
     get_children.invalidate_all()
     get_tree.invalidate_all()
-    has_parent_postType.invalidate_all()
     get_parents.invalidate_all()
     get_parent.invalidate_all()
     get_total.invalidate_all()
+    get_all.invalidate_all()
+    get_children_cache.invalidate_all()
+    update_cache_public(ids)
+
+    if ids is not None:
+        cacheHandler.invalidate_tags(*['resource:' + str(id) for id in ids])
+        return
+
+    get_access_rights.invalidate_all()
+    get_resource.invalidate_all()
+    has_parent_postType.invalidate_all()
     get_accessRights.invalidate_all()
     get_resource_type.invalidate_all()
     get_resource_files.invalidate_all()
-    get_all.invalidate_all()
     get_resource_images.invalidate_all()
-    get_children_cache.invalidate_all()
     get_article_body.invalidate_all()
-    clear_cache()
\ No newline at end of file
+    clear_cache()
+
+# Ids de los recursos cuya cache cambia al escribir un recurso: el recurso y sus padres directos, que listan los tipos de sus hijos
+def get_cache_ids(id, parent=None):
+    return [str(id)] + [str(p['id']) for p in (parent or []) if isinstance(p, dict) and 'id' in p]
\ No newline at end of file
@@ -57,6 +57,10 @@ def get_all():
                 viewType:
                     type: string
                     default: list
+                thumbnails:
+                    type: string
+                    default: base64
+                    description: "'base64' inlines the gallery/blog thumbnails, 'url' returns links to the cacheable thumbnail endpoint"
                 size:
                     type: integer
                     default: 20
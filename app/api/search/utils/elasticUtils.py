@@ -1,9 +1,10 @@
 from app.api.users.services import has_right, has_role, get_user_rights
-from app.utils.functions import get_resource_records, cache_type_roles, clear_cache
+from app.utils.functions import get_resource_records, cache_type_roles, clear_cache, get_records_paths, get_thumbnail_file, get_thumbnail_version, get_thumbnail_token
 from app.utils import IndexHandler, HookHandler
 from app.utils.LogActions import log_actions
 from app.api.logs.services import register_log
 from flask_babel import _
+from flask import url_for
 import os
 import base64
 
@@ -30,6 +31,25 @@ def _get_record_types_filter(body):
     valid_record_types = {'image', 'document', 'video', 'audio'}
     return [record_type for record_type in record_types if record_type in valid_record_types]
 
+# Miniatura de un record para las vistas de galería y blog. En modo url se retorna la dirección del endpoint de miniaturas,
+# versionada con la fecha del archivo para que el navegador la pueda cachear, en lugar de incrustar la imagen en base64
+def get_record_thumbnail(record_id, path, size, mode, user):
+    file_path = get_thumbnail_file(path, size)
+    if mode == 'url':
+        version = get_thumbnail_version(file_path)
+        if version is None:
+            return None
+        if user is not None:
+            # la url se usa en <img>, así que lleva un token firmado en lugar del jwt
+            return url_for('records.get_thumbnail_by_id', id=record_id, size=size, v=version,
+                           token=get_thumbnail_token(record_id, size, user))
+        return url_for('records.get_thumbnail_by_id_public', id=record_id, size=size, v=version)
+
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, 'rb') as f:
+        return 'data:image/jpeg;base64,' + base64.b64encode(f.read()).decode('utf-8')
+
 def get_resources_by_filters(body, user):
     post_types = body['post_type']
     sort_direction = 1 if body.get('sortOrder', 'asc') == 'asc' else -1
@@ -38,6 +58,7 @@ def get_resources_by_filters(body, user):
         'destiny': 'metadata.firstLevel.title'
     }])
     viewType = body.get('viewType', 'list')
+    thumbnails_mode = body.get('thumbnails', 'base64')
     size = body.get('size', 20)
     operator = body.get('operator', 'AND')
     activeColumns = [col['destiny'] for col in activeColumns if col['destiny'] != '' and col['destiny'] != 'createdAt' and col['destiny'] != 'ident' and col['destiny'] != 'files' and col['destiny'] != 'accessRights']
@@ -291,22 +312,22 @@ def get_resources_by_filters(body, user):
                 images = [r for r in records if r['type'] == 'image']
                 resource['files'] = len(images)
                 resource['records'] = images[:3]
-                from app.api.records.services import get_by_id
-                for record in resource['records']:
-                    r, status = get_by_id(record['id'], user, True)
-                    if status == 200:
-                        path = r.get('processing', {}).get('fileProcessing', {}).get('path')
-                        path = path + '_small.jpg'
-                        if path:
-                            file_path = os.path.join(WEB_FILES_PATH, path)
-                            if file_path and os.path.exists(file_path):
-                                with open(file_path, 'rb') as f:
-                                    record['file'] = 'data:image/jpeg;base64,' + base64.b64encode(f.read()).decode('utf-8')
             else:
                 resource['records'] = []
+
+        # las miniaturas de todos los recursos de la página se consultan juntas
+        paths = get_records_paths([record['id'] for resource in response['resources'] for record in resource['records']], user)
+        for resource in response['resources']:
+            for record in resource['records']:
+                path = paths.get(record['id'])
+                if path:
+                    thumbnail = get_record_thumbnail(record['id'], path, 'small', thumbnails_mode, user)
+                    if thumbnail:
+                        record['file'] = thumbnail
                 
     elif viewType == 'blog':
         full_article = body.get('full_article', False)
+        thumbnails = []
         for resource in response['resources']:
             article_content = resource.get('article', '')
             if not full_article and article_content and len(article_content) > 300:
@@ -315,16 +336,15 @@ def get_resources_by_filters(body, user):
             records = resource.get('records', [])
             thumbnail_record = next((r for r in records if r.get('tag') == 'thumbnail'), None)
             if thumbnail_record:
-                from app.api.records.services import get_by_id
-                r, status = get_by_id(thumbnail_record['id'], user, True)
-                if status == 200:
-                    path = r.get('processing', {}).get('fileProcessing', {}).get('path')
-                    path = path + '_medium.jpg'
-                    if path:
-                        file_path = os.path.join(WEB_FILES_PATH, path)
-                        if file_path and os.path.exists(file_path):
-                            with open(file_path, 'rb') as f:
-                                resource['thumbnail'] = 'data:image/jpeg;base64,' + base64.b64encode(f.read()).decode('utf-8')
+                thumbnails.append((thumbnail_record['id'], resource))
+
+        paths = get_records_paths([record_id for record_id, resource in thumbnails], user)
+        for record_id, resource in thumbnails:
+            path = paths.get(record_id)
+            if path:
+                thumbnail = get_record_thumbnail(record_id, path, 'medium', thumbnails_mode, user)
+                if thumbnail:
+                    resource['thumbnail'] = thumbnail
 
     register_log(user if user is not None else 'public', log_actions['search'], {'filters': body})
     
@@ -20,7 +20,8 @@ def get_public_snap(id):
         200:
             description: >
                 For type=document/image/video: a cropped JPEG image (image/jpeg). For type=audio: a
-                stream of the audio fragment. For any other type: the snap's JSON document.
+                stream of the audio fragment. For any other type: the snap's JSON document. Crops are
+                rendered once and served from a disk cache with ETag and public Cache-Control headers.
         404:
             description: Snap not found
         500:
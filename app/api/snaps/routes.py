@@ -101,7 +101,8 @@ def get_snap(id):
             description: >
                 For type=document/image/video: a cropped JPEG image (image/jpeg) generated from the
                 bbox stored in the snap. For type=audio: a stream of the audio fragment. For
-                any other type: the snap's JSON document (record_id, type, data).
+                any other type: the snap's JSON document (record_id, type, data). Crops are
+                rendered once and served from a disk cache with ETag and private Cache-Control headers.
         401:
             description: The snap exists but belongs to another user
         404:
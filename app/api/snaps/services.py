@@ -8,11 +8,9 @@ from app.api.snaps.models import SnapUpdate
 from app.utils.LogActions import log_actions
 from app.api.logs.services import register_log
 from bson.objectid import ObjectId
-from app.utils.functions import get_roles, get_access_rights, get_roles_id, get_access_rights_id
+from app.utils.functions import get_roles, get_access_rights, get_roles_id, get_access_rights_id, send_web_file
+from app.api.snaps.utils import get_crop, SNAPS_MAX_AGE
 from datetime import datetime
-from io import BytesIO
-from PIL import Image
-import base64
 import os
 from flask_babel import _
 
@@ -202,27 +200,13 @@ def get_document_snap(user, record_id, data):
         if status != 200:
             return {'msg': _(u'Error while getting the file: {error}', error = record['msg'])} , 500
     
-    pages = json.dumps([data['page'] - 1])
-    from app.utils.functions import cache_get_pages_by_id
-    resp = cache_get_pages_by_id(record_id, pages, 'big')
-    img_data = resp[0]['data']
-    img_data = base64.b64decode(img_data)
-
-    image = Image.open(BytesIO(img_data))
-    width, height = image.size
-    aspect_ratio = width / height
-
-    left = width * data['bbox']['x']
-    top = height * data['bbox']['y']
-    right = width * (data['bbox']['x'] + data['bbox']['width'])
-    bottom = height * (data['bbox']['y'] + data['bbox']['height'])
-    image = image.crop((left, top, right, bottom))
-
-    img_io = BytesIO()
-    image.save(img_io, 'JPEG', quality=70)
-    img_io.seek(0)
+    from app.utils.functions import get_page_file
+    source = get_page_file(record_id, data['page'] - 1, 'big')
+    if not os.path.exists(source):
+        return {'msg': _('File not found')}, 404
 
-    return send_file(img_io, mimetype='image/jpeg')
+    path = get_crop(record_id, data['page'], data['bbox'], source)
+    return send_web_file(path, private=user is not None, max_age=SNAPS_MAX_AGE)
 
 def get_image_snap(user, record_id, data):
     if user:
@@ -255,19 +239,9 @@ def get_image_snap(user, record_id, data):
     if not os.path.exists(path_img):
         return {'msg': _('File not found')}, 404
 
-    image = Image.open(path_img)
-    width, height = image.size
-    aspect_ratio = width / height
+    tiles_base = None
+    if file['processing']['fileProcessing'].get('dzi'):
+        tiles_base = os.path.join(WEB_FILES_PATH, path + '_tiles')
 
-    left = width * data['bbox']['x']
-    top = height * data['bbox']['y']
-    right = width * (data['bbox']['x'] + data['bbox']['width'])
-    bottom = height * (data['bbox']['y'] + data['bbox']['height'])
-    image = image.crop((left, top, right, bottom))
-
-    img_io = BytesIO()
-    image.save(img_io, 'JPEG', quality=70)
-    img_io.seek(0)
-
-    return send_file(img_io, mimetype='image/jpeg')
-    
+    path = get_crop(record_id, 0, data['bbox'], path_img, tiles_base)
+    return send_web_file(path, private=user is not None, max_age=SNAPS_MAX_AGE)
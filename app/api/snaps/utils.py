@@ -0,0 +1,168 @@
+from app.utils import CacheHandler
+import xml.etree.ElementTree as ET
+import hashlib
+import json
+import math
+import os
+import tempfile
+import pyvips
+
+WEB_FILES_PATH = os.environ.get('WEB_FILES_PATH', '')
+# carpeta dentro de WEB_FILES_PATH donde se guardan los recortes, para que se puedan servir igual que los demás archivos web
+SNAPS_CACHE_DIR = os.environ.get('SNAPS_CACHE_DIR', 'snaps_cache')
+SNAPS_QUALITY = int(os.environ.get('SNAPS_QUALITY', 70))
+SNAPS_MAX_AGE = int(os.environ.get('SNAPS_MAX_AGE', 86400))
+# tamaño máximo en bytes de la cache de recortes y segundos mínimos entre dos limpiezas, compartidos entre procesos
+SNAPS_CACHE_SIZE = int(os.environ.get('SNAPS_CACHE_SIZE', 2 * 1024 ** 3))
+SNAPS_TRIM_INTERVAL = int(os.environ.get('SNAPS_TRIM_INTERVAL', 300))
+SNAPS_TRIM_LOCK = 'snaps_cache:trim'
+
+cacheHandler = CacheHandler.CacheHandler()
+
+
+# Limita el bbox relativo (x, y, width, height entre 0 y 1) a la imagen y lo convierte a píxeles
+def bbox_to_region(bbox, width, height):
+    x = min(max(float(bbox['x']), 0), 1)
+    y = min(max(float(bbox['y']), 0), 1)
+    right = min(max(x + float(bbox['width']), x), 1)
+    bottom = min(max(y + float(bbox['height']), y), 1)
+
+    left = min(int(width * x), width - 1)
+    top = min(int(height * y), height - 1)
+    region_width = max(int(width * right) - left, 1)
+    region_height = max(int(height * bottom) - top, 1)
+    return left, top, min(region_width, width - left), min(region_height, height - top)
+
+
+# Clave del recorte: depende del record, la página, el bbox y la versión del archivo de origen, así un archivo
+# reprocesado genera recortes nuevos
+def get_crop_key(record_id, page, bbox, source):
+    version = str(int(os.stat(source).st_mtime))
+    bbox = {k: round(float(bbox[k]), 6) for k in ('x', 'y', 'width', 'height')}
+    payload = json.dumps([str(record_id), page, bbox, version], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def get_crop_path(key):
+    return os.path.join(WEB_FILES_PATH, SNAPS_CACHE_DIR, key[:2], key + '.jpg')
+
+
+# Lee el descriptor .dzi generado por dzsave
+def read_dzi(tiles_base):
+    root = ET.parse(tiles_base + '.dzi').getroot()
+    size = next(child for child in root if child.tag.endswith('Size'))
+    return {
+        'width': int(size.get('Width')),
+        'height': int(size.get('Height')),
+        'tile_size': int(root.get('TileSize')),
+        'overlap': int(root.get('Overlap')),
+        'format': root.get('Format', 'jpeg'),
+    }
+
+
+# Recorta la región leyendo solo los tiles del nivel de la pirámide DZI más cercano (por encima) al ancho pedido,
+# y la escala a ese ancho
+def crop_from_dzi(tiles_base, bbox, target_width):
+    dzi = read_dzi(tiles_base)
+    max_level = math.ceil(math.log2(max(dzi['width'], dzi['height'])))
+
+    level = max_level
+    while level > 0 and math.ceil(dzi['width'] / 2 ** (max_level - level + 1)) >= target_width:
+        level -= 1
+    scale = 2 ** (max_level - level)
+    level_width = math.ceil(dzi['width'] / scale)
+    level_height = math.ceil(dzi['height'] / scale)
+
+    left, top, width, height = bbox_to_region(bbox, level_width, level_height)
+    tile_size = dzi['tile_size']
+    overlap = dzi['overlap']
+    first_col, last_col = left // tile_size, (left + width - 1) // tile_size
+    first_row, last_row = top // tile_size, (top + height - 1) // tile_size
+
+    tiles = []
+    for row in range(first_row, last_row + 1):
+        for col in range(first_col, last_col + 1):
+            tile = pyvips.Image.new_from_file(
+                os.path.join(tiles_base + '_files', str(level), f'{col}_{row}.' + dzi['format']))
+            # se quita el solapamiento para que los tiles encajen uno al lado del otro
+            offset_x = overlap if col > 0 else 0
+            offset_y = overlap if row > 0 else 0
+            core_width = min(tile_size, level_width - col * tile_size)
+            core_height = min(tile_size, level_height - row * tile_size)
+            tiles.append(tile.crop(offset_x, offset_y, core_width, core_height))
+
+    mosaic = pyvips.Image.arrayjoin(tiles, across=last_col - first_col + 1)
+    image = mosaic.crop(left - first_col * tile_size, top - first_row * tile_size, width, height)
+    if level_width > target_width:
+        image = image.resize(target_width / level_width)
+    return image
+
+
+# Recorta la región de la imagen. En modo secuencial libvips decodifica solo hasta la última fila del recorte y no
+# guarda en memoria las columnas que quedan fuera
+def crop_from_file(source, bbox):
+    image = pyvips.Image.new_from_file(source, access='sequential')
+    return image.crop(*bbox_to_region(bbox, image.width, image.height))
+
+
+# Retorna la ruta del recorte en la cache de disco, generándolo si no existe. Si la imagen tiene tiles DZI el recorte
+# se arma con ellos, con el mismo tamaño que tendría recortando la imagen de origen. Los recortes servidos se tocan
+# para que la limpieza descarte primero los menos usados
+def get_crop(record_id, page, bbox, source, tiles_base=None):
+    path = get_crop_path(get_crop_key(record_id, page, bbox, source))
+    if os.path.exists(path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    if tiles_base and os.path.exists(tiles_base + '.dzi'):
+        target_width = pyvips.Image.new_from_file(source).width
+        image = crop_from_dzi(tiles_base, bbox, target_width)
+    else:
+        image = crop_from_file(source, bbox)
+
+    # se escribe en un temporal y se mueve, para que otra petición no sirva un archivo a medio escribir
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp.jpg', dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        if image.hasalpha():
+            image = image.flatten(background=[255, 255, 255])
+        image.write_to_file(tmp, Q=SNAPS_QUALITY, optimize_coding=True)
+        # mkstemp crea el archivo solo legible por el dueño; el servidor web lo sirve con otro usuario
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    if cacheHandler.cache.client.set(SNAPS_TRIM_LOCK, os.getpid(), nx=True, ex=SNAPS_TRIM_INTERVAL):
+        trim_crops_cache()
+    return path
+
+
+# Borra los recortes menos usados hasta que la cache quede bajo SNAPS_CACHE_SIZE bytes
+def trim_crops_cache():
+    files = []
+    total = 0
+    for root, dirs, names in os.walk(os.path.join(WEB_FILES_PATH, SNAPS_CACHE_DIR)):
+        for name in names:
+            if '.tmp' in name:
+                continue
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+            total += stat.st_size
+
+    for mtime, size, file in sorted(files):
+        if total <= SNAPS_CACHE_SIZE:
+            break
+        try:
+            os.remove(file)
+            total -= size
+        except OSError:
+            pass
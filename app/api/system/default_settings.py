@@ -117,6 +117,14 @@ settings = [
                 'instructions': 'Esta acción vuelve a indexar todos los polígonos geográficos sobreescribiendo las versiones anteriores y creando las que no están.',
                 'btn_label': 'Volver a indexar polígonos',
                 'value': 'index-geometries'
+            },
+            {
+                'type': 'button_single',
+                'label': 'Reconstruir el árbol de recursos',
+                'id': 'rebuild_resources_tree',
+                'instructions': 'Esta acción reconstruye el índice de ancestros de los recursos que se usa para el árbol y las rutas de navegación. Realizar esta acción después de migrar o importar recursos directamente en la base de datos.',
+                'btn_label': 'Reconstruir árbol',
+                'value': 'rebuild-resources-tree'
             }
         ]
     },
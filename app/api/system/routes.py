@@ -400,6 +400,112 @@ def regenerate_index_geometries():
     # Llamar al servicio para iniciar la indexación de geometrías
     return services.regenerate_index_geometries(current_user)
 
+@bp.route('/build-geometry-tiles', methods=['GET'])
+@jwt_required()
+def build_geometry_tiles():
+    """
+    Start precomputing the simplified geometries used by the geometry tiles (GET /geosystem/tiles/<level>/<z>/<x>/<y>)
+    ---
+    security:
+        - JWT: []
+    tags:
+       - System settings
+    responses:
+        200:
+            description: Geometry tiles generation started successfully (queued in Celery)
+        401:
+            description: You don't have permission to start the geometry tiles generation
+        500:
+            description: Error starting the geometry tiles generation
+    """
+    # Obtener el usuario actual
+    current_user = get_jwt_identity()
+    # Verificar si el usuario tiene el rol de administrador
+    if not user_services.has_role(current_user, 'admin'):
+        return {'msg': _('You don\'t have the required authorization')}, 401
+    # Llamar al servicio para generar las teselas de geometrías
+    return services.build_geometry_tiles(current_user)
+
+@bp.route('/rebuild-resources-tree', methods=['GET'])
+@jwt_required()
+def rebuild_resources_tree():
+    """
+    Start rebuilding the resources ancestry index (closure table used by the tree and the parents lookups)
+    ---
+    security:
+        - JWT: []
+    tags:
+       - System settings
+    responses:
+        200:
+            description: Resource tree rebuild started successfully (queued in Celery)
+        401:
+            description: You don't have permission to rebuild the resource tree
+        500:
+            description: Error starting the resource tree rebuild
+    """
+    # Obtener el usuario actual
+    current_user = get_jwt_identity()
+    # Verificar si el usuario tiene el rol de administrador
+    if not user_services.has_role(current_user, 'admin'):
+        return {'msg': _('You don\'t have the required authorization')}, 401
+    # Llamar al servicio para reconstruir el árbol de recursos
+    return services.rebuild_resources_tree(current_user)
+
+@bp.route('/index-stats', methods=['GET'])
+@jwt_required()
+def index_stats():
+    """
+    Get the Elasticsearch connection pool usage and latency per endpoint
+    ---
+    security:
+        - JWT: []
+    tags:
+        - System settings
+    responses:
+        200:
+            description: Connection pool usage and latency per endpoint of the process that served the request
+        400:
+            description: Indexing is not enabled in index_management
+        401:
+            description: You don't have permission to retrieve the index statistics
+        500:
+            description: Error retrieving the index statistics
+    """
+    # Obtener el usuario actual
+    current_user = get_jwt_identity()
+    # Verificar si el usuario tiene el rol de administrador
+    if not user_services.has_role(current_user, 'admin'):
+        return {'msg': _('You don\'t have the required authorization')}, 401
+    # Llamar al servicio para obtener las estadísticas del índice
+    return services.get_index_stats()
+
+@bp.route('/cache-stats', methods=['GET'])
+@jwt_required()
+def cache_stats():
+    """
+    Get the hit, miss and invalidation counters of the tagged cached functions
+    ---
+    security:
+        - JWT: []
+    tags:
+        - System settings
+    responses:
+        200:
+            description: Hits, misses, hit ratio and invalidations per cached function, summed over all processes
+        401:
+            description: You don't have permission to retrieve the cache statistics
+        500:
+            description: Error retrieving the cache statistics
+    """
+    # Obtener el usuario actual
+    current_user = get_jwt_identity()
+    # Verificar si el usuario tiene el rol de administrador
+    if not user_services.has_role(current_user, 'admin'):
+        return {'msg': _('You don\'t have the required authorization')}, 401
+    # Llamar al servicio para obtener las estadísticas de la cache
+    return services.get_cache_stats()
+
 @bp.route('/clear-cache', methods=['GET'])
 @jwt_required()
 def clear_cache():
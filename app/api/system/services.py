@@ -15,6 +15,7 @@ from app.api.lists.services import get_by_id
 from app.utils.functions import get_access_rights_id, get_roles_id, get_access_rights, get_roles
 import os
 from app.utils import IndexHandler
+from app.utils import PluginRegistry
 from celery import shared_task
 from app.api.tasks.services import add_task
 from app.api.types.services import get_metadata
@@ -575,6 +576,9 @@ def activate_plugin(body, current_user):
             'system', {'name': 'active_plugins'}, update_schema)
 
         get_plugins.invalidate_all()
+        PluginRegistry.PluginRegistry().load(temp)
+        get_system_settings.invalidate_all()
+        get_system_actions.invalidate_all()
         request_runtime_restart('plugins_updated', mongodb)
         schedule_local_restart()
 
@@ -609,6 +613,9 @@ def change_plugin_status(plugin, user):
             'system', {'name': 'active_plugins'}, update_schema)
 
         get_plugins.invalidate_all()
+        PluginRegistry.PluginRegistry().load(active_plugins['data'])
+        get_system_settings.invalidate_all()
+        get_system_actions.invalidate_all()
         request_runtime_restart('plugin_status_updated', mongodb)
         schedule_local_restart()
 
@@ -904,6 +911,46 @@ def index_geometries(user):
     return {'msg': gettext('Geometry indexing started')}, 200
 
 
+def build_geometry_tiles(user):
+    from app.api.geosystem.services import build_tiles
+    task = build_tiles.delay()
+    add_task(task.id, 'geosystem.build_tiles', user, 'msg')
+    return {'msg': gettext('Geometry tiles generation started')}, 200
+
+
+def rebuild_resources_tree(user):
+    from app.api.resources.services import rebuild_resources_tree as rebuild_resources_tree_task
+    task = rebuild_resources_tree_task.delay()
+    add_task(task.id, 'resources.rebuild_tree', user, 'msg')
+    return {'msg': gettext('Resource tree rebuild started')}, 200
+
+
+def get_index_stats():
+    try:
+        index_management = mongodb.get_record(
+            'system', {'name': 'index_management'})
+        if not index_management:
+            return {'msg': gettext('The index_management record does not exist')}, 404
+
+        if not index_management['data'][0]['value']:
+            return {'msg': gettext('Indexing is not enabled')}, 400
+
+        # Las estadísticas corresponden al pool de conexiones del proceso que atiende la petición
+        index_handler = IndexHandler.IndexHandler()
+        return index_handler.get_stats(), 200
+
+    except Exception as e:
+        return {'msg': str(e)}, 500
+
+
+# Retorna los aciertos, fallos e invalidaciones de las funciones cacheadas con etiquetas
+def get_cache_stats():
+    try:
+        return cacheHandler.get_stats(), 200
+    except Exception as e:
+        return {'msg': str(e)}, 500
+
+
 def set_system_setting():
     try:
         from app.api.system.default_settings import settings
@@ -1052,6 +1099,7 @@ def set_first_time(body):
 
     return {'msg': gettext('System configured successfully, you can now log in')}, 200
 
+@cacheHandler.local()
 @cacheHandler.cache.cache()
 def get_system_settings():
     collections = mongodb.get_collections()
@@ -1065,22 +1113,7 @@ def get_system_settings():
     from app.version import __version__
     version = __version__
 
-    plugins = mongodb.get_record('system', {'name': 'active_plugins'})
-    capabilities = []
-    for p in plugins['data']:
-        plugin_module = __import__(f'app.plugins.{p}', fromlist=[
-            'ExtendedPluginClass', 'plugin_info'])
-
-        plugin_info = plugin_module.plugin_info.copy()
-
-        print(p, plugin_info)
-
-        plugin_bp = plugin_module.ExtendedPluginClass(
-            p, __name__, **plugin_info, isTask=True)
-
-        c = plugin_bp.get_capabilities()
-        if c:
-            capabilities = [*capabilities, *c]
+    capabilities = PluginRegistry.PluginRegistry().get_capabilities()
 
     indexing = False
     vector_db = False
@@ -1121,23 +1154,7 @@ def get_system_settings():
 @cacheHandler.cache.cache()
 def get_system_actions(placement):
     try:
-        plugins = mongodb.get_record('system', {'name': 'active_plugins'})
-        actions = []
-        for p in plugins['data']:
-            plugin_module = __import__(f'app.plugins.{p}', fromlist=[
-                                       'ExtendedPluginClass', 'plugin_info'])
-
-            plugin_info = plugin_module.plugin_info.copy()
-
-            plugin_bp = plugin_module.ExtendedPluginClass(
-                p, __name__, **plugin_info, isTask=True)
-
-            a = plugin_bp.get_actions()
-            if a:
-                for _a in a:
-                    if _a['placement'] == placement:
-                        _a['plugin'] = p
-                        actions.append(_a)
+        actions = PluginRegistry.PluginRegistry().get_actions(placement)
 
         return {
             'actions': actions
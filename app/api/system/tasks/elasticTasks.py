@@ -1,4 +1,6 @@
-from celery import shared_task
+from celery import shared_task, current_task
+from flask import current_app, has_app_context
+from concurrent.futures import ThreadPoolExecutor
 from app.utils import DatabaseHandler
 from app.utils import IndexHandler
 from app.utils import HookHandler
@@ -9,12 +11,18 @@ from app.api.types.services import get_by_slug, get_metadata
 from flask_babel import _
 from html.parser import HTMLParser
 import re
+import json
 from datetime import datetime, timezone
 
 index_handler = IndexHandler.IndexHandler()
 mongodb = DatabaseHandler.DatabaseHandler()
 hookHandler = HookHandler.HookHandler()
 ELASTIC_INDEX_PREFIX = os.environ.get('ELASTIC_INDEX_PREFIX', '')
+ELASTIC_BULK_SIZE = int(os.environ.get('ELASTIC_BULK_SIZE', 500))
+ELASTIC_BULK_MAX_BYTES = int(os.environ.get('ELASTIC_BULK_MAX_BYTES', 10 * 1024 * 1024))
+ELASTIC_BULK_WORKERS = int(os.environ.get('ELASTIC_BULK_WORKERS', 4))
+ELASTIC_BULK_PAGE_SIZE = 1000
+ELASTIC_BULK_MAX_REPORTED_ERRORS = 50
 
 class _HTMLStripper(HTMLParser):
     def __init__(self):
@@ -85,195 +93,274 @@ def change_value(body, path, value):
 def regenerate_index_task(mapping, user):
     return index_handler.regenerate_index('resources', mapping)
 
+def _get_file_order(file_obj):
+    try:
+        return int(file_obj.get('order', 0))
+    except (TypeError, ValueError):
+        return 0
+
+# Construye el documento que se envía al índice a partir de un recurso. Retorna None si el recurso no se debe indexar
+def build_resource_document(resource):
+    document = {}
+    post_type = resource['post_type']
+    post_type_ = get_by_slug(post_type)
+    fields = get_metadata(post_type)['fields']
+    isArticle = post_type_ and 'isArticle' in post_type_ and post_type_['isArticle']
+    
+    for f in fields:
+        if f['type'] != 'file' and f['type'] != 'simple-date' and f['type'] != 'repeater':
+            destiny = f['destiny']
+            if destiny != '':
+                value = get_value_by_path(resource, destiny)
+                if value != None:
+                    document = change_value(
+                        document, f['destiny'], value)
+        elif f['type'] == 'simple-date':
+            destiny = f['destiny']
+            if destiny != '':
+                value = get_value_by_path(resource, destiny)
+                if value != None:
+                    if isinstance(value, datetime):
+                        value = to_utc_iso(value)
+                        change_value(document, f['destiny'], value)
+                        
+        if f['type'] == 'select-multiple2':
+            destiny = f['destiny']
+            if destiny != '':
+                value = get_value_by_path(resource, destiny)
+                if value != None and isinstance(value, list):
+                    value = [str(v['term']) for v in value if 'term' in v]
+                    value = list(set(value))
+                    change_value(document, f['destiny'], value)
+        
+        if f['type'] == 'repeater':
+            value = get_value_by_path(resource, f['destiny'])
+            if value:
+                for v in value:
+                    for s in f['subfields']:
+                        if s['type'] == 'simple-date':
+                            date = get_value_by_path(v, s['destiny'])
+                            if date:
+                                date = to_utc_iso(date)
+                                change_value(v, s['destiny'], date)
+        if f['type'] == 'location':
+            value = get_value_by_path(document, f['destiny'])
+            temp = []
+            if value:
+                for v in value:
+                    if 'coordinates' in v:
+                        coordinates = v['coordinates']
+                        if coordinates:
+                            if len(coordinates) == 2:
+                                newObj = {
+                                    'type': 'Point',
+                                    'coordinates': [coordinates[0], coordinates[1]]
+                                }
+                                temp.append(newObj)
+                            else:
+                                raise Exception(
+                                    'Error al indexar el recurso ' + str(resource['_id']))
+                    else:
+                        if isinstance(v, dict):
+                            for i in range(2, -1, -1):
+                                if v['level_' + str(i)]:
+                                    level = v['level_' + str(i)]['ident']
+                                    if level:
+                                        if i == 0:
+                                            parent = None
+                                        else:
+                                            parent = v['level_' + str(i - 1)]['ident']
+                                        from app.api.geosystem.services import get_shape_centroid
+                                        centroid = get_shape_centroid(level, parent, i)
+                                        if centroid:
+                                            temp = temp + centroid
+                                            break
+                change_value(document, f['destiny'], temp)
+                                    
+    document['post_type'] = post_type
+    document['article'] = None
+    
+    if isArticle:
+        articleBody = resource['articleBody'] if 'articleBody' in resource else []
+        for p in articleBody:
+            if 'type' in p and p['type'] == 'paragraph':
+                if 'content' in p:
+                    if document['article'] is None:
+                        document['article'] = ''
+                    
+                    content = strip_html(p['content'])
+                    if document['article'] == '':
+                        document['article'] += content
+                    else:
+                        document['article'] += ' ' + content
+    
+    if 'createdAt' in resource:
+        created_at = resource['createdAt']
+        created_at = to_utc_iso(created_at)
+        document['createdAt'] = created_at
+    
+    if 'parents' in resource:
+        document['parents'] = resource['parents']
+    if 'parent' in resource:
+        document['parent'] = resource['parent']
+    if 'ident' in resource:
+        document['ident'] = resource['ident']
+    if 'status' not in resource:
+        return None
+    document['status'] = resource['status']
+    document['accessRights'] = 'public'
+    document['files'] = len(
+        resource['filesObj']) if 'filesObj' in resource else 0
+    
+    records_ids = []
+    records_labels_map = {}
+    if 'filesObj' in resource:
+        sorted_files = sorted(resource['filesObj'], key=_get_file_order)
+        records_ids = [r['id'] for r in sorted_files if 'id' in r]
+        records_labels_map = {r['id']: r.get('tag') for r in sorted_files if 'id' in r}
+    document['records'] = []
+    records_ids = [ObjectId(r) for r in records_ids]
+    if records_ids:
+        records_list = list(mongodb.get_all_records(
+            'records', {'_id': {'$in': records_ids}}, fields={'_id': 1, 'processing.fileProcessing.type': 1}))
+        records_map = {record['_id']: record for record in records_list}
+        records = [records_map[id] for id in records_ids if id in records_map]
+    else:
+        records = []
+        
+    records = [
+        {
+            'id': str(record['_id']),
+            'type': record['processing']['fileProcessing']['type'],
+            'tag': records_labels_map.get(str(record['_id']))
+        }
+        for record in records
+        if 'processing' in record and 'fileProcessing' in record['processing']
+    ]
+    document['records'] = records
+
+    document_tmp = hookHandler.call('resource_index', document, resource)
+    if document_tmp:
+        document = document_tmp
+
+    if 'accessRights' in resource:
+        if resource['accessRights']:
+            document['accessRights'] = resource['accessRights']
+
+    return document
+
+# Construye el documento de un recurso dentro del contexto de la aplicación para poder usarlo desde el pool de hilos
+def _build_document_entry(app, resource):
+    resource_id = str(resource['_id'])
+    try:
+        if app is not None:
+            with app.app_context():
+                document = build_resource_document(resource)
+        else:
+            document = build_resource_document(resource)
+        return resource_id, document, None
+    except Exception as e:
+        return resource_id, None, str(e)
+
+# Envía un lote NDJSON al endpoint _bulk y retorna los errores por documento
+def _send_bulk(lines, index_name):
+    errors = []
+    response = index_handler.bulk('\n'.join(lines) + '\n')
+    if 'items' not in response:
+        error = response.get('error', response) if isinstance(response, dict) else response
+        raise Exception('Error al indexar el lote de recursos: ' + str(error))
+
+    if response.get('errors'):
+        for item in response['items']:
+            action = item.get('index', {})
+            if action.get('status', 500) >= 300:
+                error = action.get('error', {})
+                if isinstance(error, dict):
+                    error = error.get('reason', error.get('type', ''))
+                errors.append({'id': action.get('_id'), 'error': str(error)})
+    return errors
+
+def _update_progress(indexed, total, errors):
+    if not current_task or not current_task.request.id:
+        return
+    current_task.update_state(state='PROGRESS', meta={
+        'status': _('Indexing resources. %(indexed)s of %(total)s', indexed=indexed, total=total),
+        'progress': indexed / total * 100 if total else 100,
+        'errors': len(errors),
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    })
+
 @shared_task(ignore_result=False, name='system.index_resources')
 def index_resources_task(body={}):
-    skip = 0
-    resouces_count = 0
     filters = {}
-    loop = True
     if '_id' in body:
         filters['_id'] = ObjectId(body['_id'])
     else:
         filters = body
 
-    resources = list(mongodb.get_all_records(
-        'resources', filters, limit=1000, skip=skip))
-
+    index_name = ELASTIC_INDEX_PREFIX + '-resources'
     if body == {}:
-        index_handler.delete_all_documents(ELASTIC_INDEX_PREFIX + '-resources')
+        index_handler.delete_all_documents(index_name)
 
-    while len(resources) > 0 and loop:
-        for resource in resources:
-            try:
-                document = {}
-                resouces_count += 1
-                post_type = resource['post_type']
-                post_type_ = get_by_slug(post_type)
-                fields = get_metadata(post_type)['fields']
-                isArticle = post_type_ and 'isArticle' in post_type_ and post_type_['isArticle']
-                
-                for f in fields:
-                    if f['type'] != 'file' and f['type'] != 'simple-date' and f['type'] != 'repeater':
-                        destiny = f['destiny']
-                        if destiny != '':
-                            value = get_value_by_path(resource, destiny)
-                            if value != None:
-                                document = change_value(
-                                    document, f['destiny'], value)
-                    elif f['type'] == 'simple-date':
-                        destiny = f['destiny']
-                        if destiny != '':
-                            value = get_value_by_path(resource, destiny)
-                            if value != None:
-                                if isinstance(value, datetime):
-                                    value = to_utc_iso(value)
-                                    change_value(document, f['destiny'], value)
-                                    
-                    if f['type'] == 'select-multiple2':
-                        destiny = f['destiny']
-                        if destiny != '':
-                            value = get_value_by_path(resource, destiny)
-                            if value != None and isinstance(value, list):
-                                value = [str(v['term']) for v in value if 'term' in v]
-                                value = list(set(value))
-                                change_value(document, f['destiny'], value)
-                    
-                    if f['type'] == 'repeater':
-                        value = get_value_by_path(resource, f['destiny'])
-                        if value:
-                            for v in value:
-                                for s in f['subfields']:
-                                    if s['type'] == 'simple-date':
-                                        date = get_value_by_path(v, s['destiny'])
-                                        if date:
-                                            date = to_utc_iso(date)
-                                            change_value(v, s['destiny'], date)
-                    if f['type'] == 'location':
-                        value = get_value_by_path(document, f['destiny'])
-                        temp = []
-                        if value:
-                            for v in value:
-                                if 'coordinates' in v:
-                                    coordinates = v['coordinates']
-                                    if coordinates:
-                                        if len(coordinates) == 2:
-                                            newObj = {
-                                                'type': 'Point',
-                                                'coordinates': [coordinates[0], coordinates[1]]
-                                            }
-                                            temp.append(newObj)
-                                        else:
-                                            raise Exception(
-                                                'Error al indexar el recurso ' + str(resource['_id']))
-                                else:
-                                    if isinstance(v, dict):
-                                        for i in range(2, -1, -1):
-                                            if v['level_' + str(i)]:
-                                                level = v['level_' + str(i)]['ident']
-                                                if level:
-                                                    if i == 0:
-                                                        parent = None
-                                                    else:
-                                                        parent = v['level_' + str(i - 1)]['ident']
-                                                    from app.api.geosystem.services import get_shape_centroid
-                                                    centroid = get_shape_centroid(level, parent, i)
-                                                    if centroid:
-                                                        temp = temp + centroid
-                                                        break
-                            change_value(document, f['destiny'], temp)
-                                                
-                document['post_type'] = post_type
-                document['article'] = None
-                
-                if isArticle:
-                    articleBody = resource['articleBody'] if 'articleBody' in resource else []
-                    for p in articleBody:
-                        if 'type' in p and p['type'] == 'paragraph':
-                            if 'content' in p:
-                                if document['article'] is None:
-                                    document['article'] = ''
-                                
-                                content = strip_html(p['content'])
-                                if document['article'] == '':
-                                    document['article'] += content
-                                else:
-                                    document['article'] += ' ' + content
-                
-                if 'createdAt' in resource:
-                    created_at = resource['createdAt']
-                    created_at = to_utc_iso(created_at)
-                    document['createdAt'] = created_at
-                
-                if 'parents' in resource:
-                    document['parents'] = resource['parents']
-                if 'parent' in resource:
-                    document['parent'] = resource['parent']
-                if 'ident' in resource:
-                    document['ident'] = resource['ident']
-                if 'status' not in resource:
+    app = current_app._get_current_object() if has_app_context() else None
+    total = mongodb.count('resources', filters)
+    resouces_count = 0
+    processed = 0
+    errors = []
+    last_id = None
+    lines = []
+    lines_bytes = 0
+    lines_docs = 0
+
+    with ThreadPoolExecutor(max_workers=ELASTIC_BULK_WORKERS) as executor:
+        while True:
+            # paginación por _id para no degradar el rendimiento con skip
+            page_filters = filters if last_id is None else {'$and': [filters, {'_id': {'$gt': last_id}}]}
+            resources = list(mongodb.get_all_records(
+                'resources', page_filters, sort=[('_id', 1)], limit=ELASTIC_BULK_PAGE_SIZE))
+            if len(resources) == 0:
+                break
+            last_id = resources[-1]['_id']
+
+            # los documentos se construyen en el pool mientras se envían los lotes anteriores
+            for resource_id, document, error in executor.map(lambda r: _build_document_entry(app, r), resources):
+                processed += 1
+                if error:
+                    errors.append({'id': resource_id, 'error': error})
                     continue
-                document['status'] = resource['status']
-                document['accessRights'] = 'public'
-                document['files'] = len(
-                    resource['filesObj']) if 'filesObj' in resource else 0
-                
-                records_ids = []
-                records_labels_map = {}
-                if 'filesObj' in resource:
-                    def _get_order(file_obj):
-                        try:
-                            return int(file_obj.get('order', 0))
-                        except (TypeError, ValueError):
-                            return 0
-                            
-                    sorted_files = sorted(resource['filesObj'], key=_get_order)
-                    records_ids = [r['id'] for r in sorted_files if 'id' in r]
-                    records_labels_map = {r['id']: r.get('tag') for r in sorted_files if 'id' in r}
-                document['records'] = []
-                records_ids = [ObjectId(r) for r in records_ids]
-                if records_ids:
-                    records_list = list(mongodb.get_all_records(
-                        'records', {'_id': {'$in': records_ids}}, {'_id': 1, 'processing.fileProcessing.type': 1}))
-                    records_map = {record['_id']: record for record in records_list}
-                    records = [records_map[id] for id in records_ids if id in records_map]
-                else:
-                    records = []
-                    
-                records = [
-                    {
-                        'id': str(record['_id']),
-                        'type': record['processing']['fileProcessing']['type'],
-                        'tag': records_labels_map.get(str(record['_id']))
-                    }
-                    for record in records
-                    if 'processing' in record and 'fileProcessing' in record['processing']
-                ]
-                document['records'] = records
-
-                document_tmp = hookHandler.call('resource_index', document, resource)
-                if document_tmp:
-                    document = document_tmp
-
-                if 'accessRights' in resource:
-                    if resource['accessRights']:
-                        document['accessRights'] = resource['accessRights']
-
-                r = index_handler.index_document(
-                    ELASTIC_INDEX_PREFIX + '-resources', str(resource['_id']), document)
-                if r.status_code != 201 and r.status_code != 200:
-                    print(r.text)
-                    raise Exception(
-                        'Error al indexar el recurso ' + str(resource['_id']))
-            except Exception as e:
-                continue
-
-        if len(resources) < 1000:
-            loop = False
-
-        skip += 1000
-        resources = list(mongodb.get_all_records(
-            'resources', {}, limit=1000, skip=skip))
+                if document is None:
+                    continue
+
+                action = json.dumps({'index': {'_index': index_name, '_id': resource_id}})
+                source = json.dumps(document, default=str)
+                size = len(action.encode('utf-8')) + len(source.encode('utf-8')) + 2
+
+                if lines_docs > 0 and (lines_docs >= ELASTIC_BULK_SIZE or lines_bytes + size > ELASTIC_BULK_MAX_BYTES):
+                    bulk_errors = _send_bulk(lines, index_name)
+                    resouces_count -= len(bulk_errors)
+                    errors += bulk_errors
+                    lines, lines_bytes, lines_docs = [], 0, 0
+                    _update_progress(processed, total, errors)
+
+                lines += [action, source]
+                lines_bytes += size
+                lines_docs += 1
+                resouces_count += 1
+
+            if len(resources) < ELASTIC_BULK_PAGE_SIZE:
+                break
+
+    if lines_docs > 0:
+        bulk_errors = _send_bulk(lines, index_name)
+        resouces_count -= len(bulk_errors)
+        errors += bulk_errors
+    _update_progress(processed, total, errors)
+
     resp = _("Indexing finished for %(count)s resources", count=resouces_count)
+    if len(errors) > 0:
+        resp += '\n' + _('%(count)s resources could not be indexed', count=len(errors))
+        for e in errors[:ELASTIC_BULK_MAX_REPORTED_ERRORS]:
+            resp += '\n' + str(e['id']) + ': ' + e['error']
     return resp
 
 @shared_task(ignore_result=False, name='system.index_resources_delete')
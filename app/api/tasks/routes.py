@@ -1,5 +1,5 @@
 from app.api.tasks import bp
-from flask_jwt_extended import jwt_required
+from flask_jwt_extended import jwt_required, verify_jwt_in_request
 from flask_jwt_extended import get_jwt_identity
 from app.api.tasks import services
 from app.api.users import services as user_services
@@ -44,6 +44,13 @@ def get_tasks(user):
                 page:
                     type: integer
                     description: 'Result page, 0-indexed (10 tasks per page); defaults to 0 if omitted'
+                cursor:
+                    type: string
+                    description: >-
+                        Keyset pagination by (date, _id). Send null for the
+                        first page and then the "next" or "prev" token of the
+                        previous response; when present "page" is ignored and
+                        the response is an object {tasks, total, next, prev}
                 automatic:
                     description: >-
                         If this key is present (any value), the "automatic"
@@ -67,6 +74,104 @@ def get_tasks(user):
 
     return services.get_tasks(user, body)
 
+@bp.route('/events/token', methods=['GET'])
+@jwt_required()
+def get_task_events_token():
+    """
+    Get a short-lived token to open the task events stream from a browser EventSource
+    ---
+    security:
+        - JWT: []
+    tags:
+        - Processing Tasks
+    parameters:
+        - in: query
+          name: user
+          required: false
+          type: string
+          description: >-
+              Username whose tasks are streamed; defaults to the
+              authenticated user. Other users (including "automatic")
+              require the admin role
+    responses:
+        200:
+            description: >-
+                {token, expires}. The token is passed as the token query
+                parameter of /tasks/events and is valid for expires seconds;
+                request a new one when the stream can no longer reconnect
+        401:
+            description: Not authorized to get the task events
+    """
+    # Obtener el usuario actual
+    current_user = get_jwt_identity()
+    user = request.args.get('user', current_user)
+    # Verificar si el usuario tiene el rol de administrador
+    if user != current_user and not user_services.has_role(current_user, 'admin'):
+        return {'msg': _('You don\'t have the required authorization')}, 401
+
+    return {'token': services.get_task_events_token(user), 'expires': services.TASK_EVENTS_TOKEN_EXPIRATION}, 200
+
+@bp.route('/events', methods=['GET'])
+def get_task_events():
+    """
+    Stream the status changes of a user's tasks as server-sent events
+    ---
+    security:
+        - JWT: []
+    tags:
+        - Processing Tasks
+    parameters:
+        - in: query
+          name: token
+          required: false
+          type: string
+          description: >-
+              Token from /tasks/events/token. Required for browser
+              EventSource, which cannot send the Authorization header
+        - in: query
+          name: user
+          required: false
+          type: string
+          description: >-
+              Username whose tasks are streamed when authenticating with
+              the Authorization header; defaults to the authenticated user.
+              Other users (including "automatic") require the admin role
+    responses:
+        200:
+            description: >-
+                text/event-stream with a "task" event ({taskId, status,
+                result}) every time a task starts, reports progress,
+                completes or fails. The stream closes after
+                TASK_EVENTS_TIMEOUT seconds and the client reconnects
+        401:
+            description: Not authorized to get the task events
+        503:
+            description: >-
+                The server runs sync workers (set GUNICORN_WORKER_CLASS to
+                gthread, gevent or eventlet, and TASK_EVENTS_ASYNC_WORKERS
+                for the last two); poll the task list instead
+    """
+    token = request.args.get('token')
+    if token:
+        try:
+            user = services.read_task_events_token(token)
+        except Exception:
+            return {'msg': _('Invalid or expired token')}, 401
+    else:
+        verify_jwt_in_request()
+        # Obtener el usuario actual
+        current_user = get_jwt_identity()
+        user = request.args.get('user', current_user)
+        # Verificar si el usuario tiene el rol de administrador
+        if user != current_user and not user_services.has_role(current_user, 'admin'):
+            return {'msg': _('You don\'t have the required authorization')}, 401
+
+    # un worker sync quedaría bloqueado durante todo el stream
+    if not services.can_stream_task_events():
+        return {'msg': _('Task events are not available, poll the task list instead')}, 503
+
+    return services.stream_task_events(user)
+
 @bp.route('/total/<user>', methods=['GET'])
 @jwt_required()
 def get_tasks_total(user):
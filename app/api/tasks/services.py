@@ -1,18 +1,40 @@
-from flask import jsonify, request, send_file
+from flask import jsonify, request, send_file, Response, stream_with_context
 from app.utils import DatabaseHandler
 from app.utils import CacheHandler
+from app.utils.functions import get_keyset_page, count_total, update_counters
 from bson import json_util
 import json
 from app.api.tasks.models import Task
 from app.api.tasks.models import TaskUpdate
 from datetime import datetime, timedelta
 from celery.result import AsyncResult
+from celery.signals import task_prerun, task_success, task_failure
+from itsdangerous import URLSafeTimedSerializer
+import threading
+import time
 import os
 from flask_babel import _
 
 mongodb = DatabaseHandler.DatabaseHandler()
 cacheHandler = CacheHandler.CacheHandler()
 USER_FILES_PATH = os.environ.get('USER_FILES_PATH', '')
+# campos de las tareas que tienen un contador incremental
+TASK_COUNTED_FIELDS = ('user',)
+TASK_EVENTS_CHANNEL = 'tasks:events:'
+TASK_PROGRESS_INTERVAL = float(os.environ.get('TASK_PROGRESS_INTERVAL', 2))
+TASK_EVENTS_KEEPALIVE = int(os.environ.get('TASK_EVENTS_KEEPALIVE', 15))
+TASK_EVENTS_TIMEOUT = int(os.environ.get('TASK_EVENTS_TIMEOUT', 300))
+# vigencia del token con el que EventSource (que no puede enviar cabeceras) abre el stream
+TASK_EVENTS_TOKEN_EXPIRATION = int(os.environ.get('TASK_EVENTS_TOKEN_EXPIRATION', 600))
+# el stream ocupa un hilo mientras está abierto; con workers sync de gunicorn solo se permite si se indica que el
+# servidor usa workers asíncronos (gevent, eventlet)
+TASK_EVENTS_ASYNC_WORKERS = os.environ.get('TASK_EVENTS_ASYNC_WORKERS', '').lower() in ('1', 'true', 'yes')
+# segundos sin cambios tras los que una tarea pendiente con eventos se vuelve a revisar en celery, por si el worker murió
+TASK_EVENTS_STALE = int(os.environ.get('TASK_EVENTS_STALE', 1800))
+
+# última vez que se guardó el progreso de cada tarea que corre en este proceso
+_progress_lock = threading.Lock()
+_progress_times = {}
 
 # Funcion para parsear el resultado de una consulta a la base de datos
 
@@ -20,6 +42,20 @@ USER_FILES_PATH = os.environ.get('USER_FILES_PATH', '')
 def parse_result(result):
     return json.loads(json_util.dumps(result))
 
+# Segundos desde una fecha guardada con datetime.now() y parseada con parse_result ({'$date': ...}). None si no se puede leer
+def _seconds_since(value):
+    from datetime import timezone
+    if isinstance(value, dict):
+        value = value.get('$date')
+    if isinstance(value, (int, float)):
+        date = datetime.fromtimestamp(value / 1000.0, tz=timezone.utc)
+    elif isinstance(value, str):
+        date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    else:
+        return None
+    # bson guarda las fechas sin zona horaria, así que se compara con la hora local igual que al guardarla
+    return (datetime.now() - date.replace(tzinfo=None)).total_seconds()
+
 # Nuevo servicio para recuperar las tasks de un usuario
 
 
@@ -35,14 +71,26 @@ def get_tasks(user, body):
         if 'automatic' in body:
             user_array = ['automatic']
 
-        # Obtener las tasks de un usuario
-        tasks = mongodb.get_all_records('tasks', {'user': {'$in': user_array}}, sort=[
-                                        ('date', -1)], limit=limit, skip=skip)
+        # Obtener las tasks de un usuario. Si se envía cursor (null para la primera página) se pagina por (date, _id)
+        keyset = 'cursor' in body
+        if keyset:
+            tasks, next_cursor, prev_cursor = get_keyset_page('tasks', {'user': {'$in': user_array}}, 'date', -1, limit, body['cursor'])
+        else:
+            tasks = mongodb.get_all_records('tasks', {'user': {'$in': user_array}}, sort=[
+                                            ('date', -1)], limit=limit, skip=skip)
         # Parsear el resultado
         tasks = parse_result(tasks)
 
         for t in tasks:
             t['user'] = t['user'] if t['user'] != 'automatic' else 'system'
+            # el worker ya guarda los cambios de estado de la tarea, no hace falta consultar celery salvo que siga
+            # pendiente sin cambios hace más de TASK_EVENTS_STALE segundos (un worker que muere no avisa)
+            events = t.pop('events', False)
+            updated_at = t.pop('updatedAt', None)
+            if events:
+                age = _seconds_since(updated_at)
+                if t['status'] != 'pending' or age is None or age < TASK_EVENTS_STALE:
+                    continue
             if t['status'] == 'pending' or t['status'] == 'failed':
                 result = AsyncResult(t['taskId'])
 
@@ -150,6 +198,13 @@ def get_tasks(user, body):
                             t['result'] = update['result']
 
         # Retornar las tasks
+        if keyset:
+            return jsonify({
+                'tasks': tasks,
+                'total': get_tasks_total(user_array[0]),
+                'next': next_cursor,
+                'prev': prev_cursor
+            }), 200
         return jsonify(tasks), 200
     except Exception as e:
         return {'msg': str(e)}, 500
@@ -243,6 +298,7 @@ def add_task(taskId, taskName, username, resultType, params={}):
 
     # Guardar la tarea en la base de datos
     mongodb.insert_record('tasks', task)
+    update_counters('tasks', [new_task], TASK_COUNTED_FIELDS)
     get_tasks_total.invalidate_all()
 
 
@@ -250,12 +306,130 @@ def add_task(taskId, taskName, username, resultType, params={}):
 def get_tasks_total(user):
     try:
         # Obtener el total de tasks de un usuario
-        total = mongodb.count('tasks', {'user': user})
+        total = count_total('tasks', {'user': user}, TASK_COUNTED_FIELDS)
         # Retornar el total
         return total
     except Exception as e:
         return {'msg': str(e)}, 500
 
+# Guarda el estado de una tarea cuando cambia en el worker y lo publica en el canal del usuario. Las tareas que
+# no se registraron con add_task se ignoran
+def set_task_state(task_id, status, result=None):
+    task = mongodb.get_record('tasks', {'taskId': task_id}, fields={'user': 1})
+    if not task:
+        return
+
+    mongodb.update_record_operator('tasks', {'taskId': task_id}, {'$set': {
+        'status': status,
+        'result': result,
+        'events': True,
+        'updatedAt': datetime.now(),
+    }})
+    publish_task_event(task['user'], {
+        'taskId': task_id,
+        'status': status,
+        'result': result,
+    })
+
+
+def publish_task_event(user, event):
+    try:
+        cacheHandler.cache.client.publish(TASK_EVENTS_CHANNEL + user, json_util.dumps(event))
+    except Exception as e:
+        print(str(e))
+
+
+# El progreso se guarda como máximo una vez cada TASK_PROGRESS_INTERVAL segundos por tarea
+def task_progress(task_id, meta):
+    now = time.monotonic()
+    with _progress_lock:
+        if now - _progress_times.get(task_id, 0) < TASK_PROGRESS_INTERVAL:
+            return
+        _progress_times[task_id] = now
+    set_task_state(task_id, 'pending', meta)
+
+
+def _task_finished(task_id):
+    with _progress_lock:
+        _progress_times.pop(task_id, None)
+
+
+@task_prerun.connect
+def on_task_prerun(task_id=None, **kwargs):
+    try:
+        set_task_state(task_id, 'pending')
+    except Exception as e:
+        print(str(e))
+
+
+@task_success.connect
+def on_task_success(sender=None, result=None, **kwargs):
+    try:
+        task_id = sender.request.id
+        _task_finished(task_id)
+        # Permite str, dict, y list. Otro tipo de resultado se guarda como string
+        set_task_state(task_id, 'completed', result if isinstance(result, (str, dict, list)) else str(result))
+    except Exception as e:
+        print(str(e))
+
+
+@task_failure.connect
+def on_task_failure(task_id=None, **kwargs):
+    try:
+        _task_finished(task_id)
+        set_task_state(task_id, 'failed', '')
+    except Exception as e:
+        print(str(e))
+
+
+def _events_serializer():
+    from flask import current_app
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='task-events')
+
+# Token firmado para abrir el stream de eventos de las tareas de un usuario
+def get_task_events_token(user):
+    return _events_serializer().dumps({'user': user})
+
+def read_task_events_token(token):
+    return _events_serializer().loads(token, max_age=TASK_EVENTS_TOKEN_EXPIRATION)['user']
+
+# Solo se abren streams si el servidor atiende varias peticiones por worker
+def can_stream_task_events():
+    return TASK_EVENTS_ASYNC_WORKERS or bool(request.environ.get('wsgi.multithread'))
+
+# Stream SSE con los cambios de estado de las tareas de un usuario. Se cierra después de TASK_EVENTS_TIMEOUT segundos
+# para no ocupar un worker indefinidamente; el navegador se reconecta solo
+def stream_task_events(user):
+    pubsub = cacheHandler.cache.client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(TASK_EVENTS_CHANNEL + user)
+
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            end = time.monotonic() + TASK_EVENTS_TIMEOUT
+            while time.monotonic() < end:
+                message = pubsub.get_message(timeout=TASK_EVENTS_KEEPALIVE)
+                if message is None:
+                    yield ': keepalive\n\n'
+                    continue
+                yield 'event: task\ndata: ' + message['data'] + '\n\n'
+        finally:
+            pubsub.close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        }
+    )
+
+# Crea los índices de la colección tasks para el listado por usuario
+def create_task_indexes():
+    mongodb.create_index('tasks', [('user', 1), ('date', -1), ('_id', -1)])
+    mongodb.create_index('tasks', [('taskId', 1)])
+
 # funcion para detener una tarea dado su id
 
 
@@ -276,6 +450,7 @@ def stop_task(taskId, user):
             
             # eliminar la tarea de la base de datos
             mongodb.delete_record('tasks', {'taskId': taskId})
+            update_counters('tasks', [task], TASK_COUNTED_FIELDS, -1)
             # eliminar la tarea de la cache
             get_tasks_total.invalidate_all()
 
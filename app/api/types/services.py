@@ -12,6 +12,7 @@ from app.api.logs.services import register_log
 from app.api.system.services import get_access_rights_id
 from app.utils.functions import verify_role_exists
 from app.utils.functions import clear_cache
+from app.utils.functions import get_materialized_stats
 from flask_babel import _
 from datetime import datetime
 
@@ -26,12 +27,22 @@ def parse_result(result):
     return json.loads(json_util.dumps(result))
 
 
-def update_cache():
+# Limpia la cache de tipos. Con slug solo se invalidan las entradas etiquetadas con ese tipo (tipo, recursos que lo muestran,
+# roles del tipo) y los listados, que dependen de todos los tipos
+def update_cache(slug=None):
+    from app.api.resources.services import update_cache as update_cache_resources
+
     get_all.invalidate_all()
-    get_by_slug.invalidate_all()
-    get_metadata.invalidate_all()
     get_types_info.invalidate_all()
     get_count.invalidate_all()
+
+    if slug is not None:
+        update_cache_resources([])
+        cacheHandler.invalidate_tags('type:' + slug)
+        return
+
+    get_by_slug.invalidate_all()
+    get_metadata.invalidate_all()
     get_icon.invalidate_all()
     get_form_by_slug.invalidate_all()
     get_type_viz.invalidate_all()
@@ -70,7 +81,7 @@ def create(body, user):
             'slug': post_type.slug,
         }})
         # Limpiar la cache
-        update_cache()
+        update_cache(post_type.slug)
         # Retornar el resultado
         return {'msg': _('Post type created successfully')}, 201
     except Exception as e:
@@ -79,7 +90,7 @@ def create(body, user):
 # Nuevo servicio para obtener un tipo de post por su slug
 
 
-@cacheHandler.cache.cache()
+@cacheHandler.tagged('type')
 def get_by_slug(slug):
     try:
         # Buscar el tipo de post en la base de datos
@@ -98,6 +109,7 @@ def get_by_slug(slug):
         if post_type['hierarchical']:
             parents = [{'name': post_type['name'], 'slug': post_type['slug'],
                         'icon': post_type['icon'], 'direct': True}] + parents
+        cacheHandler.tag(*['type:' + p['slug'] for p in parents])
         # Agregar los padres al tipo de post
         post_type['parentsTypes'] = parents
         # Si el campo metadata es un string y es distinto a '', recuperar el formulario con ese slug
@@ -146,7 +158,7 @@ def update_by_slug(slug, body, user):
         # Registrar el log
         register_log(user, log_actions['type_update'], {'post_type': body})
         # Limpiar la cache
-        update_cache()
+        update_cache(slug)
         # Retornar el resultado
         return {'msg': _('Post type updated successfully')}, 200
     except Exception as e:
@@ -177,7 +189,7 @@ def delete_by_slug(slug, user):
         'slug': slug
     })
     # Limpiar la cache
-    update_cache()
+    update_cache(slug)
     # Retornar el resultado
     return {'msg': _('Post type deleted successfully')}, 200
 
@@ -289,7 +301,7 @@ def is_hierarchical(post_type_slug):
 # Funcion para devolver el icono de un tipo de post
 
 
-@cacheHandler.cache.cache()
+@cacheHandler.tagged('type')
 def get_icon(post_type_slug):
     # Buscar el tipo de post en la base de datos
     post_type = mongodb.get_record('post_types', {'slug': post_type_slug})
@@ -302,7 +314,7 @@ def get_icon(post_type_slug):
 # Funcion para devolver los campos del metadato de un tipo de post
 
 
-@cacheHandler.cache.cache()
+@cacheHandler.tagged('type')
 def get_metadata(post_type_slug):
     # Buscar el tipo de post en la base de datos
     post_type = mongodb.get_record('post_types', {'slug': post_type_slug})
@@ -323,7 +335,7 @@ def get_metadata(post_type_slug):
     return post_type['metadata']
 
 
-@cacheHandler.cache.cache()
+@cacheHandler.tagged('form')
 def get_form_by_slug(slug):
     try:
         # Buscar el formulario en la base de datos
@@ -406,8 +418,9 @@ def get_types_info(body):
                 'is_last': True
             })
 
+            counts = get_types_counts(post_type, [p['slug'] for p in post_types])
             for p in post_types:
-                p['count'] = get_count(p['slug'])
+                p['count'] = counts.get(p['slug'], 0)
 
             post_types = sorted(post_types, key=lambda k: k['count'], reverse=False)
             last = post_types[-1]
@@ -438,8 +451,9 @@ def get_types_info(body):
 
             post_types = remove_duplicates_by_slug(post_types)
 
+            counts = get_types_counts(post_type, [p['slug'] for p in post_types])
             for p in post_types:
-                p['count'] = get_count(p['slug'])
+                p['count'] = counts.get(p['slug'], 0)
 
             post_types = sorted(post_types, key=lambda k: k['count'], reverse=False)
             last = post_types[-1]
@@ -452,22 +466,15 @@ def get_types_info(body):
                     p['percent'] = round((p['count'] / total) * 100)
 
 
-        filter_condition = {'parent.post_type': {'$in': [p['slug'] for p in post_types]}}
-        records_count = mongodb.count(
-            'records', filter_condition)
-
-        records_types = list(mongodb.aggregate('records', [
-            {'$match': filter_condition},
-            {'$group': {'_id': '$processing.fileProcessing.type', 'count': {'$sum': 1}}},
-            {'$sort': {'count': -1}}
-        ]))
+        slugs = sorted(p['slug'] for p in post_types)
+        filter_condition = {'parent.post_type': {'$in': slugs}}
+        files = get_materialized_stats('types:' + post_type + ':records', 'records', {
+            'filters': json_util.dumps(filter_condition)
+        }, post_types=slugs)
 
         resp = {
             'types': post_types,
-            'files': {
-                'total': records_count,
-                'data': records_types
-            }
+            'files': files
         }
         return resp, 200
     except Exception as e:
@@ -475,6 +482,15 @@ def get_types_info(body):
         return {'msg': str(e)}, 500
 
 
+# Número de recursos publicados de cada tipo relacionado con post_type, leído de las estadísticas materializadas
+def get_types_counts(post_type, slugs):
+    slugs = sorted(set(slugs))
+    stats = get_materialized_stats('types:' + post_type + ':resources', 'resources', {
+        'post_types': slugs
+    }, post_types=slugs)
+    return stats['counts']
+
+
 @cacheHandler.cache.cache()
 def get_count(type, filters = {}):
     try:
@@ -487,7 +503,7 @@ def get_count(type, filters = {}):
     except Exception as e:
         raise Exception(str(e))
 
-@cacheHandler.cache.cache(limit=1000)
+@cacheHandler.tagged('type', limit=1000)
 def get_type_viz(slug, type, filters=None):
     try:
         if type == 'timeCreated':
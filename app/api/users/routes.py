@@ -634,6 +634,12 @@ def get_all():
                 page:
                     type: integer
                     description: Results page (20 per page). Defaults to 0
+                cursor:
+                    type: string
+                    description: >
+                        Keyset pagination by (name, _id). Send null for the first page and then the "next" or "prev"
+                        token of the previous response; when present "page" is ignored and the response is an object
+                        {users, total, next, prev}.
     responses:
         200:
             description: Users retrieved successfully (includes the total in each result)
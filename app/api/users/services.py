@@ -13,7 +13,7 @@ import re
 from config import config
 import os
 import datetime
-from app.utils.functions import get_access_rights, get_roles, verify_accessright_exists, verify_role_exists
+from app.utils.functions import get_access_rights, get_roles, verify_accessright_exists, verify_role_exists, get_keyset_page, count_total
 from flask_babel import _
 
 fernet_key = config[os.environ['FLASK_ENV']].FERNET_KEY
@@ -28,8 +28,12 @@ def parse_result(result):
     return json.loads(json_util.dumps(result))
 
 def update_cache():
+    from app.utils.functions import has_right as functions_has_right, has_role as functions_has_role, get_user_access
     has_right.invalidate_all()
     has_role.invalidate_all()
+    functions_has_right.invalidate_all()
+    functions_has_role.invalidate_all()
+    get_user_access.invalidate_all()
     get_total.invalidate_all()
     get_user_favorites.invalidate_all()
 
@@ -119,10 +123,16 @@ def get_all(body, current_user):
     try:
         page = body['page'] if 'page' in body else 0
         filters = _sanitize_user_filters(body['filters'] if 'filters' in body else {})
-        users = list(mongodb.get_all_records(
-            'users', filters, limit=20, skip=page * 20, fields={'password': 0, 'status': 0, 'photo': 0, 'compromise': 0, 'token': 0, 'adminToken': 0, 'nodeToken': 0, 'vizToken': 0, 'requests': 0, 'lastRequest': 0, 'favorites': 0}, sort=[('name', 1)]))
+        fields = {'password': 0, 'status': 0, 'photo': 0, 'compromise': 0, 'token': 0, 'adminToken': 0, 'nodeToken': 0, 'vizToken': 0, 'requests': 0, 'lastRequest': 0, 'favorites': 0}
+        # Si se envía cursor (null para la primera página) se pagina por (name, _id)
+        keyset = 'cursor' in body
+        if keyset:
+            users, next_cursor, prev_cursor = get_keyset_page('users', filters, 'name', 1, 20, body['cursor'], fields=fields)
+        else:
+            users = list(mongodb.get_all_records(
+                'users', filters, limit=20, skip=page * 20, fields=fields, sort=[('name', 1)]))
         
-        total = get_total(json.dumps(filters))
+        total = count_total('users', filters, fallback=get_total)
 
         rights = get_access_rights()
         if rights:
@@ -153,6 +163,13 @@ def get_all(body, current_user):
             r['roles'] = roles_temp
 
         # Retornar el resultado
+        if keyset:
+            return {
+                'users': parse_result(users),
+                'total': total,
+                'next': next_cursor,
+                'prev': prev_cursor
+            }, 200
         return parse_result(users), 200
     
     except Exception as e:
@@ -466,6 +483,7 @@ def _is_valid_system_user(username):
     return False
 
 # Nuevo servicio para verificar si el usuario tiene un rol específico
+@cacheHandler.local()
 @cacheHandler.cache.cache()
 def has_role(username, role):
     if _is_valid_system_user(username):
@@ -482,6 +500,7 @@ def has_role(username, role):
     # Si el usuario no tiene el rol, retornar False
     return False
 
+@cacheHandler.local()
 @cacheHandler.cache.cache()
 def has_right(username, right):
     if _is_valid_system_user(username):
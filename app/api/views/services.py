@@ -4,15 +4,19 @@ from app.api.views.models import View, ViewUpdate
 from app.utils.LogActions import log_actions
 from app.api.logs.services import register_log
 from bson.objectid import ObjectId
+from bson import json_util
+from celery import shared_task
 from flask_babel import _
 from app.api.records.services import create as create_record
 from app.api.records.services import delete_parent
+from app.utils.functions import get_materialized_stats, refresh_stats
 import os
 import base64
 
 mongodb = DatabaseHandler.DatabaseHandler()
 cacheHandler = CacheHandler.CacheHandler()
 WEB_FILES_PATH = os.environ.get('WEB_FILES_PATH', '')
+VIEW_FILE_TYPES = ['video', 'audio', 'document', 'image', 'database']
 
 def update_cache():
     get.invalidate_all()
@@ -20,6 +24,17 @@ def update_cache():
     get_all.invalidate_all()
 
 
+# Recalcula las estadísticas materializadas desactualizadas y limpia las respuestas cacheadas que las incluyen
+@shared_task(ignore_result=True, name='views.refresh_stats')
+def refresh_stats_task():
+    refreshed = refresh_stats()
+    if refreshed:
+        from app.api.types.services import get_types_info
+        get_view_info.invalidate_all()
+        get_types_info.invalidate_all()
+    return refreshed
+
+
 def _is_image_upload(file):
     mime = getattr(file, 'mimetype', None)
     if mime and 'image' in mime:
@@ -166,25 +181,12 @@ def get_view_info(view_slug):
             ]
         }
 
-    records_count = mongodb.count(
-            'records', filter_condition)
-    
-    distinct_types = ['video', 'audio', 'document', 'image', 'database']
-    records_types = []
-    
-    for file_type in distinct_types:
-        type_filter = {**filter_condition, 'processing.fileProcessing.type': file_type}
-        count = mongodb.count('records', type_filter)
-        records_types.append({'_id': file_type, 'count': count})
+    parents = [view['parent']] if view['parent'] != '' else []
+    view['files'] = get_materialized_stats('view:' + view_slug, 'records', {
+        'filters': json_util.dumps(filter_condition),
+        'file_types': VIEW_FILE_TYPES
+    }, post_types=[p['slug'] for p in types], parents=parents)
 
-    records_types.sort(key=lambda x: x['count'], reverse=True)
-    
-    
-    view['files'] = {
-        'total': records_count,
-        'data': records_types
-    }
-    
     return view, 200
 
 def update(id, body, user, files):
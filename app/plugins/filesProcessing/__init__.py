@@ -13,8 +13,12 @@ from .utils import PDFprocessing
 from .utils import DocumentProcessing
 from .utils import DatabaseProcessing
 from bson.objectid import ObjectId
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, as_completed
 from app.api.types.services import get_all as get_all_types
+from app.utils.functions import mark_records_stats_stale
 import json
+import hashlib
+import multiprocessing
 from flask_babel import _
 import datetime
 
@@ -26,6 +30,9 @@ hookHandler = HookHandler.HookHandler()
 USER_FILES_PATH = os.environ.get('USER_FILES_PATH', '')
 WEB_FILES_PATH = os.environ.get('WEB_FILES_PATH', '')
 ORIGINAL_FILES_PATH = os.environ.get('ORIGINAL_FILES_PATH', '')
+FILES_PROCESSING_WORKERS = int(os.environ.get('FILES_PROCESSING_WORKERS', os.cpu_count() or 2))
+FILES_PROCESSING_PDF_RANGE = int(os.environ.get('FILES_PROCESSING_PDF_RANGE', 20))
+CHECKPOINTS_COLLECTION = 'files_processing_checkpoints'
 
 def get_filename_extension(filename):
     if '.' not in filename:
@@ -36,127 +43,183 @@ def get_filename_extension(filename):
     ext = ext.lower()
     return ext
 
-def process_file(file, instance=None):
+# Arma el plan de derivados de un archivo. Cada etapa es una lista de trabajos (nombre, función, argumentos)
+# independientes entre sí; una etapa solo inicia cuando terminó la anterior. Una etapa puede ser una función
+# que retorna sus trabajos cuando depende del resultado de la etapa previa (p.ej. el número de páginas)
+def get_derivatives(file):
     path = os.path.join(ORIGINAL_FILES_PATH, file['filepath'])
     # quitar el nombre del archivo de la ruta
     path_dir = os.path.dirname(file['filepath'])
     # obtener el nombre del archivo sin la extensión
     filename = os.path.splitext(os.path.basename(file['filepath']))[0]
-    
-    if not os.path.exists(os.path.join(WEB_FILES_PATH, path_dir)):
-        os.makedirs(os.path.join(WEB_FILES_PATH, path_dir))
+    output = os.path.join(WEB_FILES_PATH, path_dir, filename)
+    extension = get_filename_extension(file['filepath'])
 
     if 'audio' in file['mime']:
-        result = AudioProcessing.main(path, os.path.join(WEB_FILES_PATH, path_dir, filename))
-        if result:
-            metadata = AudioProcessing.get_metadata(path)
-            update = {
-                'processing': {
-                    'fileProcessing': {
-                        'type': 'audio',
-                        'path': os.path.join(path_dir, filename),
-                    }
-                }
-            }
-            if metadata:
-                update['processing']['fileProcessing']['metadata'] = metadata
-            instance.update_data('records', str(file['_id']), update)
-
+        return 'audio', os.path.join(path_dir, filename), [[
+            ('audio', AudioProcessing.main, (path, output)),
+            ('metadata', AudioProcessing.get_metadata, (path,)),
+        ]]
     elif 'video' in file['mime']:
-        result_audio, result_video = VideoProcessing.main(path, os.path.join(WEB_FILES_PATH, path_dir, filename))
-        if result_video or result_audio:
-            type = 'video' if result_video else 'audio' if result_audio else None
-            metadata = VideoProcessing.get_metadata(path)
-            update = {
-                'processing': {
-                    'fileProcessing': {
-                        'type': type,
-                        'path': os.path.join(path_dir, filename),
-                    }
-                }
-            }
-            if metadata:
-                update['processing']['fileProcessing']['metadata'] = metadata
-            
-            instance.update_data('records', str(file['_id']), update)
+        return 'video', os.path.join(path_dir, filename), [[
+            ('video', VideoProcessing.main, (path, output)),
+            ('metadata', VideoProcessing.get_metadata, (path,)),
+        ]]
     elif 'image' in file['mime']:
-        result, metadata, is_dzi = ImageProcessing.main(path, os.path.join(WEB_FILES_PATH, path_dir, filename))
-        if result:
-            update = {
-                'processing': {
-                    'fileProcessing': {
-                        'type': 'image',
-                        'path': os.path.join(path_dir, filename),
-                    }
-                }
-            }
-            if is_dzi:
-                update['processing']['fileProcessing']['dzi'] = True
-                
-            if metadata:
-                update['processing']['fileProcessing']['metadata'] = metadata
-            
-            instance.update_data('records', str(file['_id']), update)
-    elif 'word' in file['mime'] or ('text' in file['mime'] and get_filename_extension(file['filepath']) != '.csv'):
-        result = DocumentProcessing.main(path, os.path.join(ORIGINAL_FILES_PATH, path_dir, filename), os.path.join(WEB_FILES_PATH, path_dir, filename))
-
-        if result:
-            update = {
-                'processing': {
-                    'fileProcessing': {
-                        'type': 'document',
-                        'path': os.path.join(path_dir, filename),
-                    }
-                }
-            }
-            
-            instance.update_data('records', str(file['_id']), update)
+        return 'image', os.path.join(path_dir, filename), [[
+            ('flat', ImageProcessing.flat_versions, (path, output)),
+            ('dzi', ImageProcessing.deep_zoom, (path, output)),
+            ('metadata', ImageProcessing.get_metadata, (path,)),
+        ]]
+    elif 'word' in file['mime'] or ('text' in file['mime'] and extension != '.csv'):
+        output_pdf = os.path.join(ORIGINAL_FILES_PATH, path_dir, filename)
+        return 'document', os.path.join(path_dir, filename), [
+            [('convert', DocumentProcessing.convert_to_pdf_with_libreoffice, (path, output_pdf))],
+            lambda: get_pages_jobs(output_pdf + '.pdf', output),
+        ]
     elif 'application/pdf' in file['mime']:
-        PDFprocessing.clean_pdf(path)
-        result = PDFprocessing.main(path, os.path.join(WEB_FILES_PATH, path_dir, filename))
-        folder_path = os.path.join(path_dir, filename).split('.')[0]
-
-        if result:
-            update = {
-                'processing': {
-                    'fileProcessing': {
-                        'type': 'document',
-                        'path': folder_path,
-                    }
-                }
-            }
-            
-            instance.update_data('records', str(file['_id']), update)
-    
-    elif 'text' in file['mime'] and get_filename_extension(file['filepath']) == '.csv':
-        result = DatabaseProcessing.main_csv(path, os.path.join(WEB_FILES_PATH, path_dir, filename))
-
-        if result:
-            update = {
-                'processing': {
-                    'fileProcessing': {
-                        'type': 'database',
-                        'path': os.path.join(path_dir, filename),
-                    }
-                }
-            }
-            
-            instance.update_data('records', str(file['_id']), update)
-
+        return 'document', os.path.join(path_dir, filename).split('.')[0], [
+            [('clean', PDFprocessing.clean_pdf, (path,))],
+            lambda: get_pages_jobs(path, output),
+        ]
+    elif 'text' in file['mime'] and extension == '.csv':
+        return 'database', os.path.join(path_dir, filename), [[
+            ('database', DatabaseProcessing.main_csv, (path, output)),
+        ]]
     elif 'sheet' in file['mime']:
-        result = DatabaseProcessing.main_excel(path, os.path.join(WEB_FILES_PATH, path_dir, filename))
-
-        if result:
-            update = {
-                'processing': {
-                    'fileProcessing': {
-                        'type': 'database',
-                        'path': os.path.join(path_dir, filename),
-                    }
-                }
+        return 'database', os.path.join(path_dir, filename), [[
+            ('database', DatabaseProcessing.main_excel, (path, output)),
+        ]]
+
+    return None, None, []
+
+# Divide la rasterización de un pdf en rangos de páginas que se procesan de forma independiente
+def get_pages_jobs(path, output):
+    total = PDFprocessing.get_page_count(path)
+    return [
+        ('pages_' + str(first) + '_' + str(last), PDFprocessing.rasterize_pages, (path, output, first, last))
+        for first, last in PDFprocessing.page_ranges(total, FILES_PROCESSING_PDF_RANGE)
+    ]
+
+def get_update(type, path, results):
+    if type == 'video':
+        audio, video = results['video']
+        if not audio and not video:
+            return None
+        type = 'video' if video else 'audio'
+
+    update = {
+        'processing': {
+            'fileProcessing': {
+                'type': type,
+                'path': path,
             }
-            
-            instance.update_data('records', str(file['_id']), update)
+        }
+    }
+    if results.get('dzi'):
+        update['processing']['fileProcessing']['dzi'] = True
+    if results.get('metadata'):
+        update['processing']['fileProcessing']['metadata'] = results['metadata']
+
+    return update
+
+# Los procesos de celery (prefork) son daemon y no pueden tener procesos hijos, en ese caso los
+# trabajos se reparten en hilos, que igual corren en paralelo porque ffmpeg, libreoffice, pdftoppm
+# y libvips hacen el trabajo pesado fuera del GIL
+def get_pool():
+    if multiprocessing.current_process().daemon:
+        return ThreadPoolExecutor(max_workers=FILES_PROCESSING_WORKERS)
+    return ProcessPoolExecutor(max_workers=FILES_PROCESSING_WORKERS)
+
+def submit(pool, function, *args):
+    if pool is not None:
+        return pool.submit(function, *args)
+
+    future = Future()
+    try:
+        future.set_result(function(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def get_checkpoint(run, id):
+    if not run:
+        return {}
+    checkpoint = mongodb.get_record(CHECKPOINTS_COLLECTION, {'run': run, 'record': str(id)})
+    return checkpoint or {}
+
+def save_checkpoint(run, id, update):
+    if not run:
+        return
+    mongodb.update_record_operator(CHECKPOINTS_COLLECTION, {'run': run, 'record': str(id)}, {
+        '$set': {**update, 'updatedAt': datetime.datetime.now()}
+    }, upsert=True)
+
+def clear_checkpoints(run):
+    mongodb.delete_records(CHECKPOINTS_COLLECTION, {'run': run})
+
+# Genera los derivados de un archivo. Los trabajos de cada etapa se envían al pool y cada derivado
+# terminado queda registrado en el checkpoint de la ejecución (run), de modo que si la tarea se
+# interrumpe, una nueva ejecución con el mismo run solo rehace lo que faltaba
+def process_file(file, instance=None, pool=None, run=None):
+    type, path, stages = get_derivatives(file)
+    if type is None:
+        return False
+
+    checkpoint = get_checkpoint(run, file['_id'])
+    if checkpoint.get('completed'):
+        return True
+
+    results = checkpoint.get('derivatives', {})
+    if not os.path.exists(os.path.join(WEB_FILES_PATH, os.path.dirname(file['filepath']))):
+        os.makedirs(os.path.join(WEB_FILES_PATH, os.path.dirname(file['filepath'])), exist_ok=True)
+
+    for stage in stages:
+        if callable(stage):
+            stage = stage()
+
+        futures = {
+            submit(pool, function, *args): name
+            for name, function, args in stage
+            if name not in results
+        }
+
+        errors = []
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+                save_checkpoint(run, file['_id'], {'derivatives.' + name: results[name]})
+            except Exception as e:
+                errors.append(e)
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    update = get_update(type, path, results)
+    if update:
+        instance.update_data('records', str(file['_id']), update)
+        mark_records_stats_stale([file['_id']])
+    save_checkpoint(run, file['_id'], {'completed': True})
+
+    return update is not None
+
+# Procesa un lote de archivos: hasta FILES_PROCESSING_WORKERS archivos a la vez, cuyos derivados
+# comparten el mismo pool acotado
+def process_files(files, instance, pool, run=None, errors=None):
+    processed = 0
+    with ThreadPoolExecutor(max_workers=FILES_PROCESSING_WORKERS) as executor:
+        futures = {executor.submit(process_file, file, instance, pool, run): file for file in files}
+        for future in as_completed(futures):
+            try:
+                if future.result():
+                    processed += 1
+            except Exception as e:
+                print(str(e))
+                if errors is not None:
+                    errors.append(str(futures[future]['_id']) + ': ' + str(e))
+
+    return processed
 
 class ExtendedPluginClass(PluginClass):
     def __init__(self, path, import_name, name, description, version, author, type, settings, actions, capabilities=None, **kwargs):
@@ -176,11 +239,16 @@ class ExtendedPluginClass(PluginClass):
         }
         
         records = list(mongodb.get_all_records('records', records_filters, fields={'_id': 1, 'mime': 1, 'filepath': 1}))
-        size = len(records)
-        for file in records:
-            process_file(file, instance)
+        run = 'auto-' + str(body['_id'])
+        errors = []
+        with get_pool() as pool:
+            size = process_files(records, instance, pool, run, errors)
 
         instance.clear_cache()
+        # la tarea falla si algún archivo no se pudo procesar; los derivados ya generados quedan para el reintento
+        if errors:
+            raise Exception('No se pudieron procesar ' + str(len(errors)) + ' archivos: ' + '; '.join(errors[:10]))
+        clear_checkpoints(run)
         return 'Se procesaron ' + str(size) + ' archivos'
 
     def activate_settings(self):
@@ -235,40 +303,40 @@ class ExtendedPluginClass(PluginClass):
         size = 0
         loop = True
         instance = ExtendedPluginClass('filesProcessing','', isTask=True, **plugin_info)
-        # obtenemos los recursos
-        while loop:
-            status_template = _(u'Processing files. Step {step} of {total}')
-            formatted_status = status_template.format(step=int(step + 1), total=int((total / 100) + 1))
-
-            current_task.update_state(state='PROGRESS', meta={
-                'status': formatted_status,
-                'progress': step / total * 100,
-                'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            })
-            resources = list(mongodb.get_all_records('resources', filters, fields={'_id': 1}).limit(100).skip(step))
-            resources = [str(resource['_id']) for resource in resources]
-
-            records_filters = {
-                'parent.id': {'$in': resources}
-            }
-            if body['overwrite']:
-                records_filters = {"$or": [{"processing.fileProcessing": {"$exists": False}, **records_filters}, {"processing.fileProcessing": {"$exists": True}, **records_filters}]}
-            else:
-                records_filters['processing.fileProcessing'] = {'$exists': False}
+        # la misma solicitud retoma los derivados que ya se habían generado si la tarea se interrumpió
+        run = 'bulk-' + hashlib.sha1(json.dumps(body, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        # el pool se cierra aunque el procesamiento falle
+        with get_pool() as pool:
+            # obtenemos los recursos
+            while loop:
+                status_template = _(u'Processing files. Step {step} of {total}')
+                formatted_status = status_template.format(step=int(step + 1), total=int((total / 100) + 1))
+
+                current_task.update_state(state='PROGRESS', meta={
+                    'status': formatted_status,
+                    'progress': step / total * 100,
+                    'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                })
+                resources = list(mongodb.get_all_records('resources', filters, fields={'_id': 1}).limit(100).skip(step))
+                resources = [str(resource['_id']) for resource in resources]
+
+                records_filters = {
+                    'parent.id': {'$in': resources}
+                }
+                if body['overwrite']:
+                    records_filters = {"$or": [{"processing.fileProcessing": {"$exists": False}, **records_filters}, {"processing.fileProcessing": {"$exists": True}, **records_filters}]}
+                else:
+                    records_filters['processing.fileProcessing'] = {'$exists': False}
             
-            records = list(mongodb.get_all_records('records', records_filters, fields={'_id': 1, 'mime': 1, 'filepath': 1}))
+                records = list(mongodb.get_all_records('records', records_filters, fields={'_id': 1, 'mime': 1, 'filepath': 1}))
 
-            size += len(records)
-            for file in records:
-                try:
-                    process_file(file, instance)
-                except Exception as e:
-                    print(str(e))
+                size += process_files(records, instance, pool, run)
 
-            step += 100
-            if len(resources) < 100:
-                loop = False
+                step += 100
+                if len(resources) < 100:
+                    loop = False
 
+        clear_checkpoints(run)
         instance.clear_cache()
         resp_template = _(u'Processed {size} files of a total of {total} resources.')
         formatted_resp = resp_template.format(size=int(size), total=int(total))
@@ -25,23 +25,11 @@ def get_metadata(filepath):
 
 def main(filepath, output):
     try:
-        output_mp3 = output + '.mp3'
-        (
-            ffmpeg
-            .input(filepath)
-            .output(output_mp3, acodec='libmp3lame', ab='128k')
-            .overwrite_output()
-            .run()
-        )
-
-        output_ogg = output + '.ogg'
-        (
-            ffmpeg
-            .input(filepath)
-            .output(output_ogg, acodec='libvorbis', **{'q:a': 4})
-            .overwrite_output()
-            .run()
-        )
+        # una sola decodificación del original alimenta las dos salidas
+        source = ffmpeg.input(filepath)
+        output_mp3 = source.output(output + '.mp3', acodec='libmp3lame', ab='128k')
+        output_ogg = source.output(output + '.ogg', acodec='libvorbis', **{'q:a': 4})
+        ffmpeg.merge_outputs(output_mp3, output_ogg).overwrite_output().run()
 
         return True
     except Exception as e:
@@ -1,9 +1,22 @@
 from . import PDFprocessing
 import subprocess
+import tempfile
+import shutil
 import os
 
+# Cada conversión usa su propio perfil de libreoffice: con un perfil compartido las conversiones en paralelo fallan o se
+# quedan bloqueadas esperando el bloqueo del perfil
 def convert_to_pdf_with_libreoffice(input_file, output_dir):
-    subprocess.run(['libreoffice', '--headless', '--convert-to', 'pdf', '--outdir', os.path.dirname(input_file), input_file])
+    profile = tempfile.mkdtemp(prefix='lo-')
+    try:
+        subprocess.run([
+            'libreoffice', '-env:UserInstallation=file://' + profile, '--headless',
+            '--convert-to', 'pdf', '--outdir', os.path.dirname(input_file), input_file
+        ], check=True, capture_output=True)
+    except subprocess.CalledProcessError as e:
+        raise Exception('libreoffice terminó con código ' + str(e.returncode) + ': ' + e.stderr.decode('utf-8', errors='replace'))
+    finally:
+        shutil.rmtree(profile, ignore_errors=True)
 
 def main(filepath, output_pdf, output):
     try:
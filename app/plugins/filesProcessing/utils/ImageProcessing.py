@@ -1,36 +1,56 @@
 import pyvips
 import exiftool
 
-def main(filepath, output):
-    try:
-        # 1. Extraer metadatos intactos
-        metadata_list = None
-        with exiftool.ExifToolHelper() as et:
-            metadata_list = et.get_metadata([filepath])
+def get_metadata(filepath):
+    metadata_list = None
+    with exiftool.ExifToolHelper() as et:
+        metadata_list = et.get_metadata([filepath])
+    return metadata_list[0] if metadata_list else None
 
-        # 2. Generar las versiones planas usando "shrink-on-load"
-        # pyvips.Image.thumbnail es increíblemente rápido y ahorra RAM
-        img_large = pyvips.Image.thumbnail(filepath, 2500)
+def flat_versions(filepath, output):
+    try:
+        # pyvips.Image.thumbnail usa "shrink-on-load", así que el original se decodifica una sola vez
+        # y las versiones mediana y pequeña se derivan de la grande que ya está en memoria
+        img_large = pyvips.Image.thumbnail(filepath, 2500).copy_memory()
         img_large.write_to_file(output + '_large.jpg', Q=90, optimize_coding=True)
 
-        img_medium = pyvips.Image.thumbnail(filepath, 1100)
+        img_medium = img_large.thumbnail_image(1100)
         img_medium.write_to_file(output + '_medium.jpg', Q=80, optimize_coding=True)
 
-        img_small = pyvips.Image.thumbnail(filepath, 110)
+        img_small = img_large.thumbnail_image(110)
         img_small.write_to_file(output + '_small.jpg', Q=80, optimize_coding=True)
 
-        # 3. Evaluar el sistema de Tiles
+        return True
+    except Exception as e:
+        raise Exception('Error al convertir el archivo: ' + str(e))
+
+def deep_zoom(filepath, output):
+    try:
         # Cargamos la imagen en modo secuencial (bajo consumo de memoria)
         image = pyvips.Image.new_from_file(filepath, access='sequential')
         max_dim = max(image.width, image.height)
 
-        is_dzi = False
         if max_dim >= 4096:
             # dzsave genera un archivo .dzi y una carpeta "_files" con los tiles
             # Ej: output_tiles.dzi y output_tiles_files/
             image.dzsave(output + '_tiles')
-            is_dzi = True
+            return True
+
+        return False
+    except Exception as e:
+        raise Exception('Error al convertir el archivo: ' + str(e))
+
+def main(filepath, output):
+    try:
+        # 1. Extraer metadatos intactos
+        metadata = get_metadata(filepath)
+
+        # 2. Generar las versiones planas
+        flat_versions(filepath, output)
+
+        # 3. Evaluar el sistema de Tiles
+        is_dzi = deep_zoom(filepath, output)
 
-        return True, metadata_list[0] if metadata_list else None, is_dzi
+        return True, metadata, is_dzi
     except Exception as e:
         raise Exception('Error al convertir el archivo: ' + str(e))
\ No newline at end of file
@@ -1,5 +1,5 @@
 import shutil
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 from PIL import Image
 import os
 import pypdf
@@ -29,21 +29,35 @@ def clean_pdf(file_path):
     except Exception as e:
         raise Exception('Error al convertir el archivo: ' + str(e))
 
-def main(path, output_path):
+def get_page_count(path):
+    return int(pdfinfo_from_path(path)['Pages'])
+
+def page_ranges(total, size):
+    return [(first, min(first + size - 1, total)) for first in range(1, total + 1, size)]
+
+def rasterize_pages(path, output_path, first_page, last_page):
+    try:
+        output_big = output_path + '/web/big'
+        output_small = output_path + '/web/small'
+        os.makedirs(output_big, exist_ok=True)
+        os.makedirs(output_small, exist_ok=True)
+
+        # solo se rasteriza el rango pedido y se trabaja con las rutas en disco, de modo
+        # que en memoria nunca hay más de una página a la vez
+        pages = convert_from_path(path, first_page=first_page, last_page=last_page, output_folder=output_big, fmt='jpg', output_file="page_", paths_only=True)
+
+        for page in pages:
+            with Image.open(page) as image:
+                image.thumbnail((100, 100))
+                image.save(output_small + '/' + os.path.splitext(os.path.basename(page))[0] + '.jpg', "JPEG")
+        return True
+    except Exception as e:
+        raise Exception('Error al convertir el archivo: ' + str(e))
+
+def main(path, output_path, range_size=20):
     try:
-        output = output_path + '/web/big'
-        if not os.path.exists(output):
-            os.makedirs(output)
-        
-        images = convert_from_path(path, output_folder=output, fmt='jpg', output_file="page_")
-        
-        output = output_path + '/web/small'
-        if not os.path.exists(output):
-            os.makedirs(output)
-        
-        for image in images:
-            image.thumbnail((100, 100))
-            image.save(output + '/' + os.path.splitext(os.path.basename(image.filename))[0] + '.jpg', "JPEG")
+        for first_page, last_page in page_ranges(get_page_count(path), range_size):
+            rasterize_pages(path, output_path, first_page, last_page)
         return True
     except Exception as e:
         raise Exception('Error al convertir el archivo: ' + str(e))
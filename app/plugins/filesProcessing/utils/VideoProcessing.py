@@ -1,6 +1,12 @@
 import os
 import ffmpeg
 
+# keyframes cada tantos segundos, para que los fragmentos se puedan cortar copiando el video sin recodificar
+VIDEO_KEYFRAME_INTERVAL = float(os.environ.get('VIDEO_KEYFRAME_INTERVAL', 2))
+# segmentos HLS pregenerados al procesar, para servir fragmentos como porciones de la lista sin codificar nada
+VIDEO_HLS = os.environ.get('VIDEO_HLS', '').lower() == 'true'
+VIDEO_HLS_TIME = float(os.environ.get('VIDEO_HLS_TIME', 6))
+
 
 def get_metadata(filepath):
     try:
@@ -24,6 +30,26 @@ def get_metadata(filepath):
             pass
     return metadata
 
+# Segmenta el mp4 ya generado copiando los streams. Los segmentos empiezan en keyframes, que están cada
+# VIDEO_KEYFRAME_INTERVAL segundos
+def hls(output):
+    directory = output + '_hls'
+    os.makedirs(directory, exist_ok=True)
+    (
+        ffmpeg
+        .input(output + '.mp4')
+        .output(
+            os.path.join(directory, 'index.m3u8'),
+            c='copy',
+            f='hls',
+            hls_time=VIDEO_HLS_TIME,
+            hls_playlist_type='vod',
+            hls_segment_filename=os.path.join(directory, '%05d.ts')
+        )
+        .overwrite_output()
+        .run()
+    )
+
 def main(filepath, output):
     import ffprobe3
     try:
@@ -46,43 +72,23 @@ def main(filepath, output):
                 if stream.is_audio():
                     audio = True
 
+        # una sola decodificación del original alimenta todas las salidas
+        source = ffmpeg.input(filepath)
+        outputs = []
         if video:
-            output_file = output + ".mp4"
-            (
-                ffmpeg
-                .input(filepath)
-                .output(output_file, vcodec='libx264', acodec='aac', vf='scale=480:trunc(ow/a/2)*2')
-                .overwrite_output()
-                .run()
-            )
-
-            output_file = output + ".webm"
-            (
-                ffmpeg
-                .input(filepath)
-                .output(output_file, vcodec='libvpx', acodec='libvorbis', vf='scale=480:trunc(ow/a/2)*2')
-                .overwrite_output()
-                .run()
-            )
+            outputs.append(source.output(output + ".mp4", vcodec='libx264', acodec='aac', vf='scale=480:trunc(ow/a/2)*2',
+                                         force_key_frames='expr:gte(t,n_forced*%s)' % VIDEO_KEYFRAME_INTERVAL))
+            outputs.append(source.output(output + ".webm", vcodec='libvpx', acodec='libvorbis', vf='scale=480:trunc(ow/a/2)*2'))
 
         if audio and not video:
-            output_file = output + ".mp3"
-            (
-                ffmpeg
-                .input(filepath)
-                .output(output_file, acodec='libmp3lame', ab='128k')
-                .overwrite_output()
-                .run()
-            )
+            outputs.append(source.output(output + ".mp3", acodec='libmp3lame', ab='128k'))
+            outputs.append(source.output(output + ".ogg", acodec='libvorbis', ab='128k'))
+
+        if len(outputs) > 0:
+            ffmpeg.merge_outputs(*outputs).overwrite_output().run()
 
-            output_file = output + ".ogg"
-            (
-                ffmpeg
-                .input(filepath)
-                .output(output_file, acodec='libvorbis', ab='128k')
-                .overwrite_output()
-                .run()
-            )
+        if video and VIDEO_HLS:
+            hls(output)
 
         return audio, video
     except Exception as e:
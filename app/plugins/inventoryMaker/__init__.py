@@ -1,6 +1,6 @@
 from app.utils.PluginClass import PluginClass
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from celery import shared_task
+from celery import shared_task, current_task
 from flask import request, send_file
 from app.utils import DatabaseHandler
 from app.api.types.services import get_by_slug
@@ -9,6 +9,7 @@ from app.utils.functions import cache_type_roles
 from app.api.resources.services import get_accessRights
 import os
 import uuid
+import datetime
 import pandas as pd
 from dotenv import load_dotenv
 from bson.objectid import ObjectId
@@ -344,12 +345,6 @@ class ExtendedPluginClass(PluginClass):
     
     @shared_task(ignore_result=False, name='inventoryMaker.create_inventory')
     def create(body, user):
-        def clean_string(input_string):
-            if input_string is None:
-                return ''
-            cleaned_string = ''.join(char for char in input_string if ord(char) > 31 or ord(char) in (9, 10, 13))
-            return cleaned_string
-
         filters = {
             'post_type': {'$in': body['post_type']}
         }
@@ -369,9 +364,6 @@ class ExtendedPluginClass(PluginClass):
                 unique[dest] = f
         type_metadata = list(unique.values())
 
-        resources_df = []
-        records_df = []
-
         if 'parent' in body:
             if body['parent']:
                 filters = {'$or': [{'parents.id': body['parent']['id'], 'post_type': {'$in': body['post_type']}}, {'_id': ObjectId(body['parent']['id'])}]}
@@ -399,11 +391,11 @@ class ExtendedPluginClass(PluginClass):
         elif body['status'] == 'published':
             filters['status'] = 'published'
             
-        # buscamos los recursos con los filtros especificados
-        resources = list(mongodb.get_all_records('resources', filters))
+        # contamos los recursos con los filtros especificados
+        total = mongodb.count('resources', filters)
 
         # si no hay recursos, retornamos un error
-        if len(resources) == 0:
+        if total == 0:
             raise Exception('No se encontraron recursos con los filtros especificados')
         
         obj = {}
@@ -417,71 +409,15 @@ class ExtendedPluginClass(PluginClass):
         for f in type_metadata:
             obj[f['label']] = f['destiny']
 
-        resources_df.append(obj)
-
-
-        # si hay recursos, iteramos
-        for r in resources:
-            obj = {}
-            
-            obj['id'] = str(r['_id'])
-            obj['ident'] = r['ident']
-            obj['Tipo de contenido'] = r['post_type']
-
-            for f in type_metadata:
-                if f['type'] == 'text' or f['type'] == 'text-area':
-                    obj[f['label']] = clean_string(get_value_by_path(r, f['destiny']))
-                elif f['type'] == 'select':
-                    obj[f['label'] + '_id'] = clean_string(get_value_by_path(r, f['destiny']))
-                    
-                    if obj[f['label'] + '_id'] and obj[f['label'] + '_id'] != 'none':
-                        option = mongodb.get_record('options', {'_id': ObjectId(obj[f['label'] + '_id'])})
-                        if option:
-                            obj[f['label']] = option['term']
-                elif f['type'] == 'select-multiple2':
-                    obj[f['label'] + '_ids'] = ', '.join([str(o) for o in get_value_by_path(r, f['destiny'])]) if get_value_by_path(r, f['destiny']) else ''
-                    if obj[f['label'] + '_ids']:
-                        options = list(mongodb.get_all_records('options', {'_id': {'$in': [ObjectId(str(o['id'])) for o in get_value_by_path(r, f['destiny'])]}}))
-                        if options:
-                            obj[f['label']] = ', '.join([o['term'] for o in options]) if options else ''
-                elif f['type'] == 'simple-date':
-                    date = get_value_by_path(r, f['destiny'])
-                    if date:
-                        obj[f['label']] = date.strftime('%Y-%m-%d')
-                    else:
-                        obj[f['label']] = ''
-                elif f['type'] == 'number':
-                    obj[f['label']] = get_value_by_path(r, f['destiny'])
-
-            resources_df.append(obj)
-
-            r_ = list(mongodb.get_all_records('records', {'parent.id': str(r['_id'])}, fields={'name': 1, 'displayName': 1}))
-
-            files = [record['name'] for record in r_]
-            obj['files'] = ', '.join(files)
-
-            files_ids = [str(record['_id']) for record in r_]
-            obj['files_ids'] = ', '.join(files_ids)
-
-        resources = [str(resource['_id']) for resource in resources]
-
-        records_filters = {
-            'parent.id': {'$in': resources},
-        }
-
-        records = list(mongodb.get_all_records('records', records_filters, fields={
-            '_id': 1, 'mime': 1, 'filepath': 1, 'hash': 1, 'size': 1}))
-        
-        for r in records:
-            obj = {
-                'id': str(r['_id']),
-                'mime': r['mime'],
-                'filepath': r['filepath'],
-                'hash': r['hash'],
-                'size': r['size']
-            }
-
-            records_df.append(obj)
+        # las columnas se definen antes de escribir la primera fila
+        columns = list(obj.keys())
+        for f in type_metadata:
+            if f['type'] == 'select':
+                columns.append(f['label'] + '_id')
+            elif f['type'] == 'select-multiple2':
+                columns.append(f['label'] + '_ids')
+        columns.extend(['files', 'files_ids'])
+        columns = list(dict.fromkeys(columns))
 
         folder_path = USER_FILES_PATH + '/' + user + '/inventoryMaker'
         if not os.path.exists(folder_path):
@@ -489,13 +425,54 @@ class ExtendedPluginClass(PluginClass):
 
         file_id = str(uuid.uuid4())
 
-        with pd.ExcelWriter(folder_path + '/' + file_id + '.xlsx') as writer:
-            df = pd.DataFrame(resources_df)
-            df.to_excel(writer, sheet_name='Recursos', index=False)
-            df = pd.DataFrame(records_df)
-            df.to_excel(writer, sheet_name='Archivos', index=False)
-
-        return '/' + user + '/inventoryMaker/' + file_id + '.xlsx'
+        from .services import InventoryWriter, iterate_batches, load_terms, get_resource_row
+        writer = InventoryWriter(folder_path, file_id, body.get('format', 'xlsx'))
+        writer.add_sheet('Recursos', columns)
+        writer.add_sheet('Archivos', ['id', 'mime', 'filepath', 'hash', 'size'])
+        writer.append('Recursos', [obj])
+
+        terms = {}
+        written_records = set()
+        processed = 0
+
+        # recorremos los recursos por bloques: los términos de las opciones y los archivos de cada
+        # bloque se obtienen con una sola consulta $in
+        resources = mongodb.get_all_records('resources', filters, sort=[('_id', 1)])
+        for batch in iterate_batches(resources):
+            load_terms(batch, type_metadata, terms)
+
+            records = list(mongodb.get_all_records('records', {'parent.id': {'$in': [str(r['_id']) for r in batch]}}, fields={
+                '_id': 1, 'name': 1, 'mime': 1, 'filepath': 1, 'hash': 1, 'size': 1, 'parent': 1}))
+
+            files = {}
+            for record in records:
+                for parent in record.get('parent', []):
+                    files.setdefault(parent['id'], []).append(record)
+
+            writer.append('Recursos', [get_resource_row(r, type_metadata, terms, files.get(str(r['_id']), [])) for r in batch])
+
+            records_df = []
+            for r in records:
+                if str(r['_id']) in written_records:
+                    continue
+                written_records.add(str(r['_id']))
+                records_df.append({
+                    'id': str(r['_id']),
+                    'mime': r.get('mime'),
+                    'filepath': r.get('filepath'),
+                    'hash': r.get('hash'),
+                    'size': r.get('size')
+                })
+            writer.append('Archivos', records_df)
+
+            processed += len(batch)
+            current_task.update_state(state='PROGRESS', meta={
+                'status': 'Exportando recursos: ' + str(processed) + ' de ' + str(total),
+                'progress': processed / total * 100,
+                'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            })
+
+        return '/' + user + '/inventoryMaker/' + writer.close()
 
         
     
@@ -511,6 +488,19 @@ plugin_info = {
                 'type':  'instructions',
                 'title': 'Instrucciones',
                 'text': 'Este plugin permite generar inventarios en archivo excel del contenido del gestor documental. Para ello, puede especificar el tipo de contenido sobre el cual quiere generar el inventario y los filtros que desea aplicar. El archivo se encontrará en su perfil para su descarga una vez se haya terminado de generar. Es importante notar que el proceso de generación de inventarios puede tardar varios minutos, dependiendo de la cantidad de recursos que se encuentren en el gestor documental.',
+            },
+            {
+                'type': 'select',
+                'label': 'Formato',
+                'id': 'format',
+                'instructions': 'Formato del inventario. En CSV y Parquet se descarga un archivo zip con un archivo por hoja.',
+                'default': 'xlsx',
+                'options': [
+                    {'value': 'xlsx', 'label': 'Excel (xlsx)'},
+                    {'value': 'csv', 'label': 'CSV'},
+                    {'value': 'parquet', 'label': 'Parquet'}
+                ],
+                'required': False,
             }
         ],
         'settings_lunch': [
@@ -1,10 +1,177 @@
 from bson.objectid import ObjectId
 import pandas as pd
 import os
+import csv
 import uuid
+import shutil
+import zipfile
 from app.utils import DatabaseHandler
 mongodb = DatabaseHandler.DatabaseHandler()
 
+INVENTORY_BATCH_SIZE = int(os.environ.get('INVENTORY_BATCH_SIZE', 500))
+INVENTORY_FORMATS = ['xlsx', 'csv', 'parquet']
+
+def clean_string(input_string):
+    if input_string is None:
+        return ''
+    cleaned_string = ''.join(char for char in str(input_string) if ord(char) > 31 or ord(char) in (9, 10, 13))
+    return cleaned_string
+
+# Escribe las hojas del inventario fila por fila sin mantenerlas en memoria. En xlsx usa el modo
+# write_only de openpyxl; en csv y parquet cada hoja es un archivo y el resultado es un zip con todas
+class InventoryWriter:
+    def __init__(self, folder_path, file_id, format='xlsx'):
+        if format not in INVENTORY_FORMATS:
+            raise Exception('Formato no soportado: ' + str(format))
+
+        self.folder_path = folder_path
+        self.file_id = file_id
+        self.format = format
+        self.columns = {}
+        self.sheets = {}
+
+        if format == 'xlsx':
+            from openpyxl import Workbook
+            self.workbook = Workbook(write_only=True)
+        else:
+            self.tmp_path = os.path.join(folder_path, file_id)
+            os.makedirs(self.tmp_path, exist_ok=True)
+
+    def add_sheet(self, name, columns):
+        self.columns[name] = columns
+
+        if self.format == 'xlsx':
+            sheet = self.workbook.create_sheet(name)
+            sheet.append(columns)
+        elif self.format == 'csv':
+            file = open(os.path.join(self.tmp_path, name + '.csv'), 'w', newline='', encoding='utf-8')
+            sheet = (file, csv.writer(file))
+            sheet[1].writerow(columns)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            schema = pa.schema([(column, pa.string()) for column in columns])
+            sheet = (pq.ParquetWriter(os.path.join(self.tmp_path, name + '.parquet'), schema), schema)
+
+        self.sheets[name] = sheet
+
+    def append(self, name, rows):
+        if len(rows) == 0:
+            return
+
+        columns = self.columns[name]
+        sheet = self.sheets[name]
+
+        if self.format == 'xlsx':
+            for row in rows:
+                sheet.append([row.get(column) for column in columns])
+        elif self.format == 'csv':
+            for row in rows:
+                sheet[1].writerow([row.get(column, '') for column in columns])
+        else:
+            import pyarrow as pa
+            data = {column: [None if row.get(column) is None else str(row.get(column)) for row in rows] for column in columns}
+            sheet[0].write_table(pa.Table.from_pydict(data, schema=sheet[1]))
+
+    # Cierra el archivo y retorna su nombre dentro de folder_path
+    def close(self):
+        if self.format == 'xlsx':
+            filename = self.file_id + '.xlsx'
+            self.workbook.save(os.path.join(self.folder_path, filename))
+            return filename
+
+        for sheet in self.sheets.values():
+            sheet[0].close()
+
+        filename = self.file_id + '.zip'
+        with zipfile.ZipFile(os.path.join(self.folder_path, filename), 'w', zipfile.ZIP_DEFLATED) as zip:
+            for name in self.sheets:
+                zip.write(os.path.join(self.tmp_path, name + '.' + self.format), name + '.' + self.format)
+
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        return filename
+
+# Recorre un cursor en bloques de size documentos
+def iterate_batches(cursor, size=INVENTORY_BATCH_SIZE):
+    batch = []
+    for document in cursor.batch_size(size):
+        batch.append(document)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def get_option_ids(resource, field):
+    from app.api.resources.services import get_value_by_path
+    value = get_value_by_path(resource, field['destiny'])
+    if not value:
+        return []
+    if field['type'] == 'select':
+        return [str(value)]
+    return [str(o['id']) for o in value if isinstance(o, dict) and 'id' in o]
+
+# Agrega al diccionario de términos las opciones usadas por un bloque de recursos que aún no se
+# habían consultado, con una sola consulta $in por bloque
+def load_terms(resources, fields, terms):
+    missing = set()
+    for r in resources:
+        for f in fields:
+            if f['type'] == 'select' or f['type'] == 'select-multiple2':
+                missing.update([id for id in get_option_ids(r, f) if id not in terms and ObjectId.is_valid(id)])
+
+    if len(missing) == 0:
+        return terms
+
+    for id in missing:
+        terms[id] = None
+
+    options = mongodb.get_all_records('options', {'_id': {'$in': [ObjectId(id) for id in missing]}}, fields={'term': 1})
+    for option in options:
+        terms[str(option['_id'])] = option['term']
+
+    return terms
+
+def get_resource_row(r, fields, terms, files):
+    from app.api.resources.services import get_value_by_path
+    obj = {}
+
+    obj['id'] = str(r['_id'])
+    obj['ident'] = r['ident']
+    obj['Tipo de contenido'] = r['post_type']
+
+    for f in fields:
+        if f['type'] == 'text' or f['type'] == 'text-area':
+            obj[f['label']] = clean_string(get_value_by_path(r, f['destiny']))
+        elif f['type'] == 'select':
+            obj[f['label'] + '_id'] = clean_string(get_value_by_path(r, f['destiny']))
+
+            if obj[f['label'] + '_id'] and obj[f['label'] + '_id'] != 'none':
+                term = terms.get(obj[f['label'] + '_id'])
+                if term:
+                    obj[f['label']] = term
+        elif f['type'] == 'select-multiple2':
+            value = get_value_by_path(r, f['destiny'])
+            obj[f['label'] + '_ids'] = ', '.join([str(o) for o in value]) if value else ''
+            if obj[f['label'] + '_ids']:
+                options = [terms.get(id) for id in get_option_ids(r, f)]
+                options = [o for o in options if o]
+                if options:
+                    obj[f['label']] = ', '.join(options)
+        elif f['type'] == 'simple-date':
+            date = get_value_by_path(r, f['destiny'])
+            if date:
+                obj[f['label']] = date.strftime('%Y-%m-%d')
+            else:
+                obj[f['label']] = ''
+        elif f['type'] == 'number':
+            obj[f['label']] = get_value_by_path(r, f['destiny'])
+
+    obj['files'] = ', '.join([record.get('name', '') for record in files])
+    obj['files_ids'] = ', '.join([str(record['_id']) for record in files])
+
+    return obj
+
 def generateResourceInventory(body, user=None, path=None, filename=None):
     def clean_string(input_string):
         if input_string is None:
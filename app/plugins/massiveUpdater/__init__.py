@@ -3,22 +3,14 @@ from flask_jwt_extended import jwt_required, get_jwt_identity
 from celery import shared_task
 from flask import request, send_file
 from app.utils import DatabaseHandler
-from app.api.types.services import get_by_slug
-from app.api.resources.services import get_value_by_path
 import os
 from werkzeug.utils import secure_filename
 import uuid
-import re
 import pandas as pd
 import json
 from dotenv import load_dotenv
 from bson.objectid import ObjectId
-from app.api.system.services import set_value_in_dict, validate_text, validate_simple_date
-from app.api.resources.models import ResourceUpdate
-from dateutil import parser
 from flask_babel import _
-from datetime import datetime
-import requests
 
 load_dotenv()
 
@@ -127,210 +119,8 @@ class ExtendedPluginClass(PluginClass):
 
         if content_type == 'Recursos':
 
-            # abrir la hoja de excel
-            df = pd.read_excel(path, sheet_name='Recursos')
-
-            # quitamos el encabezado y dejamos la segunda fila como encabezado
-            new_header = df.iloc[0]
-            df = df[1:]
-            df.columns = new_header
-
-            for index, row in df.iterrows():
-                doUpdate = False
-                if not pd.isna(row['id']):
-                    doUpdate = True
-                    resource = mongodb.get_record('resources', {'_id': ObjectId(row['id'])}, {'_id': 1, 'metadata': 1, 'post_type': 1, 'status': 1})
-
-                    status = resource['status']
-
-                    update = {}
-                    
-                    if resource == None:
-                        error = {
-                            'index': index,
-                            'id': row['id'],
-                            'error': 'Recurso no encontrado'
-                        }
-                        errores.append(error)
-                        continue
-
-                    # recuperamos el tipo de contenido
-                    type = get_by_slug(resource['post_type'])
-                else:
-                    doUpdate = False
-                    update = {
-                        'status': 'published',
-                        'post_type': row['post_type'],
-                        'metadata': {},
-                        'filesIds': [],
-                    }
-                    type = get_by_slug(row['post_type'])
-
-                fields = type['metadata']['fields']
-
-                # iteramos sobre los campos del archivo
-                for field in fields:
-                    try:
-                        # si el campo no está en el archivo, lo dejamos como está
-                        if field['destiny'] not in row:
-                            continue
-                        # else si row[field['destiny']] es Nan, lo dejamos como está
-                        if pd.isna(row[field['destiny']]):
-                            continue
-
-                        if field['type'] == 'text' or field['type'] == 'text-area':
-                            validate_text(row[field['destiny']], field)
-                            set_value_in_dict(update, field['destiny'], row[field['destiny']])
-                        elif field['type'] == 'location':
-                            value = row[field['destiny']]
-                            def get_coordinates(text):
-                                arcgis_sugg_path = f"https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/suggest?f=json&text={text}&maxSuggestions=1"
-                                arcgis_geo_path = "https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/findAddressCandidates?f=json&magicKey="
-
-                                try:
-                                    sugg_response = requests.get(arcgis_sugg_path)
-                                    sugg_response.raise_for_status()
-                                    sugg_data = sugg_response.json()
-
-                                    if sugg_data.get("suggestions") and len(sugg_data["suggestions"]) > 0:
-                                        magic_key = sugg_data["suggestions"][0]["magicKey"]
-                                        geo_response = requests.get(arcgis_geo_path + magic_key)
-                                        geo_response.raise_for_status()
-                                        geo_data = geo_response.json()
-                                        
-                                        if geo_data.get("candidates") and len(geo_data["candidates"]) > 0:
-                                            location = geo_data["candidates"][0]["location"]
-                                            return {"lat": location["y"], "lng": location["x"]}
-                                        else:
-                                            return None
-                                    else:
-                                        return None
-                                except requests.exceptions.RequestException as e:
-                                    print(f"Error fetching coordinates: {e}")
-                                    return None
-
-                            coords = get_coordinates(value)
-                            if coords:
-                                set_value_in_dict(update, field['destiny'], [
-                                    {
-                                        'coordinates': [coords['lng'], coords['lat']]
-                                    }
-                                ])
-                            else:
-                                error = {
-                                    'index': index,
-                                    'id': row['id'],
-                                    'error': f'No se pudieron obtener las coordenadas para: {value}'
-                                }
-                                errores.append(error)
-                                continue                   
-                            
-                        elif field['type'] == 'simple-date':
-                            value = row[field['destiny']]
-                            if isinstance(value, datetime):
-                                parsed_date = value
-                            else:
-                                value = str(value)
-                                if len(value) == 4:
-                                    value = value + '-01-01'
-                                parsed_date = parser.parse(value)
-                            validate_simple_date(parsed_date, field)
-                            set_value_in_dict(update, field['destiny'], parsed_date)
-                        elif field['type'] == 'select' or field['type'] == 'select-multiple2':
-                            value = row[field['destiny']].split(',')
-                            
-                            from app.api.lists.services import get_by_id as get_list
-                            list = get_list(field['list'])
-                            options = list['options']
-                            
-                            resp = []
-                            for v in value:
-                                isFound = False
-                                if bool(re.fullmatch(r'[0-9a-fA-F]{24}', v)):
-                                    for option in options:
-                                        if option['id'] == v:
-                                            isFound = True
-                                            resp.append(option['id'])
-                                            break
-                                else:
-                                    for option in options:
-                                        if option['term'] == v:
-                                            isFound = True
-                                            resp.append(option['id'])
-                                            break
-                                if not isFound:
-                                    error = {
-                                        'index': index,
-                                        'id': row['id'],
-                                        'error': f'Opción {v} no encontrada en la lista {field["list"]}'
-                                    }
-                                    errores.append(error)
-                                    continue
-                            
-                            if field['type'] == 'select':
-                                set_value_in_dict(update, field['destiny'], resp[0])
-                            else:
-                                set_value_in_dict(update, field['destiny'], resp)
-
-                    except Exception as e:
-                        error = {
-                            'index': index,
-                            'id': row['id'],
-                            'error': str(e)
-                        }
-                        errores.append(error)
-                        continue
-
-                # si en la columna parent hay un valor, lo agregamos al update
-                if 'parent' in row and not pd.isna(row['parent']):
-                    
-                    def get_resource_parent(parent):
-                        from app.api.resources.services import get_by_id
-                        
-                        resource = mongodb.get_record('resources', {'$or': [{'_id': ObjectId(parent)}, {'metadata.firstLevel.title': parent}]}, fields={'_id': 1})
-                        
-                        if resource is None:
-                            return None
-                        
-                        resource, status = get_by_id(str(resource['_id']), user)
-                        
-                        if status != 200:
-                            return None
-                        
-                        return {
-                            'id': str(resource['_id']),
-                            'post_type': resource['post_type'],
-                        }
-                    
-                    parent = get_value_by_path(row['parent'])
-                    if parent:
-                        parent = get_resource_parent(parent)
-                        if parent:
-                            update['parent'] = parent
-                            update['parents'] = [parent]
-                        else:
-                            error = {
-                                'index': index,
-                                'id': row['id'],
-                                'error': 'Parent no encontrado'
-                            }
-                            errores.append(error)
-                            continue
-                
-                if doUpdate:
-                    # actualizamos el recurso
-                    update['updatedBy'] = user
-                    update['updatedAt'] = datetime.now()
-                    resource = ResourceUpdate(**update)
-                    updated_resource = mongodb.update_record('resources', {'_id': ObjectId(row['id'])}, resource)
-                    reporte.append({
-                        'id': row['id'],
-                        'status': 'Actualizado'
-                    })
-                else:
-                    from app.api.resources.services import create as create_resource
-                    created_resource = create_resource(update, user, [], True)
-                    
+            from .services import import_resources
+            reporte, errores = import_resources(path, user)
 
         elif content_type == 'Tipo':
             # abrir la hoja de excel
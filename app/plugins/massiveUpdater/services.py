@@ -0,0 +1,451 @@
+from app.utils import DatabaseHandler
+from app.utils import CacheHandler
+from app.api.types.services import get_by_slug
+from app.api.system.services import set_value_in_dict
+from app.api.resources.models import ResourceUpdate
+from app.utils.functions import mark_stats_stale
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from bson.objectid import ObjectId
+from flask_babel import _
+from datetime import datetime
+from dateutil import parser
+from celery import current_task
+import pandas as pd
+import requests
+import os
+
+mongodb = DatabaseHandler.DatabaseHandler()
+cacheHandler = CacheHandler.CacheHandler()
+
+MASSIVE_UPDATER_BATCH_SIZE = int(os.environ.get('MASSIVE_UPDATER_BATCH_SIZE', 500))
+GEOCODE_WORKERS = int(os.environ.get('GEOCODE_WORKERS', 8))
+GEOCODE_CACHE_TTL = int(os.environ.get('GEOCODE_CACHE_TTL', 30 * 86400))
+ARCGIS_SUGGEST_URL = 'https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/suggest'
+ARCGIS_CANDIDATES_URL = 'https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/findAddressCandidates'
+
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_maxsize=GEOCODE_WORKERS))
+
+def add_error(errores, index, id, error):
+    errores.append({
+        'index': index,
+        'id': None if pd.isna(id) else id,
+        'error': error
+    })
+
+# Lee la hoja de recursos del inventario. La primera fila del archivo trae los destinos de los campos
+def read_resources(path):
+    df = pd.read_excel(path, sheet_name='Recursos')
+
+    # quitamos el encabezado y dejamos la segunda fila como encabezado
+    new_header = df.iloc[0]
+    df = df[1:]
+    df.columns = new_header
+
+    # las columnas auxiliares del inventario (ids de opciones, archivos) no tienen destino
+    df = df.loc[:, df.columns.notna()]
+    df = df.loc[:, ~df.columns.duplicated()]
+
+    for column in ['id', 'post_type', 'parent']:
+        if column not in df.columns:
+            df[column] = None
+
+    return df
+
+# Construye el mapa término/id -> id de opción de un listado
+def get_terms_map(list_id, lists):
+    if list_id in lists:
+        return lists[list_id]
+
+    from app.api.lists.services import get_by_id as get_list
+    list = get_list(list_id)
+    terms = {}
+    if isinstance(list, dict):
+        for option in list['options']:
+            terms[option['id']] = option['id']
+            terms.setdefault(option['term'], option['id'])
+
+    lists[list_id] = terms
+    return terms
+
+# Consulta el geocodificador. Los errores de red se propagan para que no queden en la cache y se reintenten en la
+# siguiente importación
+@cacheHandler.cache.cache(ttl=GEOCODE_CACHE_TTL, limit=10000)
+def fetch_coordinates(text):
+    sugg_response = session.get(ARCGIS_SUGGEST_URL, params={'f': 'json', 'text': text, 'maxSuggestions': 1}, timeout=10)
+    sugg_response.raise_for_status()
+    sugg_data = sugg_response.json()
+
+    if not sugg_data.get('suggestions'):
+        return None
+
+    magic_key = sugg_data['suggestions'][0]['magicKey']
+    geo_response = session.get(ARCGIS_CANDIDATES_URL, params={'f': 'json', 'magicKey': magic_key}, timeout=10)
+    geo_response.raise_for_status()
+    geo_data = geo_response.json()
+
+    if not geo_data.get('candidates'):
+        return None
+
+    location = geo_data['candidates'][0]['location']
+    return {'lat': location['y'], 'lng': location['x']}
+
+def geocode(text):
+    try:
+        return fetch_coordinates(text)
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching coordinates: {e}")
+        return None
+
+# Busca en la colección shapes los nombres que no se pudieron geocodificar y retorna el centroide
+# del polígono más específico (mayor nivel administrativo) con ese nombre
+def gazetteer(texts):
+    from shapely.geometry import shape
+
+    # se busca el nombre tal como viene y con las mayúsculas habituales, y se compara sin distinguir mayúsculas
+    names = {}
+    candidates = set()
+    for text in texts:
+        name = str(text).split(',')[0].strip()
+        names.setdefault(name.lower(), []).append(text)
+        candidates.update([name, name.capitalize(), name.title()])
+
+    shapes = mongodb.get_all_records('shapes', {'properties.name': {'$in': list(candidates)}}, fields={
+        'geometry': 1, 'properties.name': 1, 'properties.admin_level': 1
+    }, sort=[('properties.admin_level', -1)])
+
+    coordinates = {}
+    for s in shapes:
+        for text in names.get(str(s['properties']['name']).lower(), []):
+            if text in coordinates:
+                continue
+            centroid = shape(s['geometry']).centroid
+            coordinates[text] = {'lat': centroid.y, 'lng': centroid.x}
+
+    return coordinates
+
+# Geocodifica en paralelo los valores únicos de una columna de ubicación
+def geocode_all(texts):
+    texts = list(set(texts))
+    with ThreadPoolExecutor(max_workers=GEOCODE_WORKERS) as executor:
+        coordinates = dict(zip(texts, executor.map(geocode, texts)))
+
+    missing = [text for text, coords in coordinates.items() if coords is None]
+    if len(missing) > 0:
+        coordinates.update(gazetteer(missing))
+
+    return coordinates
+
+def parse_date(value):
+    try:
+        return parser.parse(value)
+    except (ValueError, OverflowError):
+        return None
+
+# Valida y convierte una columna completa según el tipo del campo. Retorna los valores convertidos y
+# los mensajes de error, ambos indexados como el dataframe
+def parse_column(series, field, lists):
+    present = series.notna()
+    errors = pd.Series(None, index=series.index, dtype=object)
+    message = _(u'Error while validating the field {label}', label=field['label'])
+
+    if field['type'] == 'text' or field['type'] == 'text-area':
+        is_text = series.map(lambda v: isinstance(v, str))
+        invalid = present & ~is_text
+        if field.get('required'):
+            invalid = invalid | (present & is_text & (series.astype(str).str.strip() == ''))
+        errors[invalid] = message
+        return series.where(present & ~invalid), errors
+
+    elif field['type'] == 'simple-date':
+        text = series.astype(str)
+        text = text.where(text.str.len() != 4, text + '-01-01')
+        # cada valor distinto se interpreta una vez con dateutil, igual que en la importación fila por fila
+        dates = {value: parse_date(value) for value in text[present].unique()}
+        parsed = text.where(present).map(dates)
+        errors[present & parsed.isna()] = message
+        return parsed, errors
+
+    elif field['type'] == 'location':
+        values = series[present].astype(str)
+        coordinates = geocode_all(values.tolist())
+        parsed = values.map(coordinates).reindex(series.index)
+        invalid = present & parsed.isna()
+        errors[invalid] = series[invalid].map(lambda v: f'No se pudieron obtener las coordenadas para: {v}')
+        return parsed, errors
+
+    elif field['type'] == 'select' or field['type'] == 'select-multiple2':
+        terms = get_terms_map(field['list'], lists)
+        resolved = {}
+        for value in series[present].astype(str).unique():
+            ids = []
+            missing = []
+            for v in value.split(','):
+                v = v.strip()
+                if v in terms:
+                    ids.append(terms[v])
+                else:
+                    missing.append(v)
+            resolved[value] = (ids, missing)
+
+        parsed = series[present].astype(str).map(resolved).reindex(series.index)
+        invalid = parsed.map(lambda v: isinstance(v, tuple) and len(v[1]) > 0)
+        errors[invalid] = parsed[invalid].map(lambda v: ', '.join([f'Opción {o} no encontrada en la lista {field["list"]}' for o in v[1]]))
+        return parsed.map(lambda v: v[0] if isinstance(v, tuple) and len(v[0]) > 0 else None), errors
+
+    return pd.Series(None, index=series.index, dtype=object), errors
+
+def set_field(update, field, value):
+    if field['type'] == 'location':
+        value = [{'coordinates': [value['lng'], value['lat']]}]
+    elif field['type'] == 'simple-date':
+        value = value.to_pydatetime()
+    elif field['type'] == 'select':
+        value = value[0]
+    set_value_in_dict(update, field['destiny'], value)
+
+# Resuelve los valores de la columna parent (id o título) con una sola consulta y verifica el acceso del usuario
+def get_parents(values, user):
+    from app.api.resources.services import get_by_id
+
+    values = [str(v) for v in set(values)]
+    ids = [ObjectId(v) for v in values if ObjectId.is_valid(v)]
+    resources = mongodb.get_all_records('resources', {'$or': [{'_id': {'$in': ids}}, {'metadata.firstLevel.title': {'$in': values}}]}, fields={
+        '_id': 1, 'post_type': 1, 'metadata.firstLevel.title': 1
+    })
+
+    found = {}
+    for r in resources:
+        found.setdefault(str(r['_id']), r)
+        title = r.get('metadata', {}).get('firstLevel', {}).get('title')
+        if title:
+            found.setdefault(title, r)
+
+    parents = {}
+    for value in values:
+        resource = found.get(value)
+        if resource is None:
+            parents[value] = None
+            continue
+        resp, status = get_by_id(str(resource['_id']), user)
+        parents[value] = {'id': str(resource['_id']), 'post_type': resource['post_type']} if status == 200 else None
+
+    return parents
+
+# Convierte el diccionario anidado del update en rutas con punto para $set, de modo que los campos
+# que no vienen en el archivo se mantienen como están
+def flatten_update(update, prefix=''):
+    flat = {}
+    for key, value in update.items():
+        if isinstance(value, dict) and len(value) > 0:
+            flat.update(flatten_update(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+def write_updates(operations, rows, errores, reporte):
+    failed = set()
+    if len(operations) == 0:
+        return failed
+
+    try:
+        mongodb.bulk_write('resources', operations)
+    except BulkWriteError as e:
+        for error in e.details.get('writeErrors', []):
+            index, id = rows[error['index']]
+            failed.add(error['index'])
+            add_error(errores, index, id, error.get('errmsg'))
+
+    for i, (index, id) in enumerate(rows):
+        if i not in failed:
+            reporte.append({
+                'id': id,
+                'status': 'Actualizado'
+            })
+
+    return failed
+
+# Importa la hoja de recursos: las columnas se validan y convierten completas, los términos de los listados
+# se resuelven con un mapa, las ubicaciones se geocodifican en paralelo y las actualizaciones se escriben
+# con bulk_write en bloques de MASSIVE_UPDATER_BATCH_SIZE filas
+def import_resources(path, user):
+    from app.api.resources.services import validate_parent, sync_resource_tree, update_parents, update_records_parents, update_cache
+    from app.api.resources.services import create as create_resource
+
+    reporte = []
+    errores = []
+
+    df = read_resources(path)
+    total = len(df)
+
+    # validamos los identificadores y recuperamos los recursos existentes en una sola consulta
+    has_id = df['id'].notna()
+    ids = df['id'].astype(str)
+    valid_id = ids.str.fullmatch(r'[0-9a-fA-F]{24}')
+    for index in df.index[has_id & ~valid_id]:
+        add_error(errores, index, df.at[index, 'id'], 'Recurso no encontrado')
+
+    existing = {}
+    object_ids = [ObjectId(id) for id in ids[has_id & valid_id].unique()]
+    for x in range(0, len(object_ids), MASSIVE_UPDATER_BATCH_SIZE):
+        for r in mongodb.get_all_records('resources', {'_id': {'$in': object_ids[x:x + MASSIVE_UPDATER_BATCH_SIZE]}}, fields={'_id': 1, 'post_type': 1}):
+            existing[str(r['_id'])] = r
+
+    found = ids.isin(list(existing.keys()))
+    for index in df.index[has_id & valid_id & ~found]:
+        add_error(errores, index, df.at[index, 'id'], 'Recurso no encontrado')
+
+    # el tipo de contenido de las filas existentes es el del recurso, el de las nuevas el de la columna post_type
+    post_types = ids.map(lambda id: existing[id]['post_type'] if id in existing else None)
+    post_types = post_types.where(has_id, df['post_type'])
+    types = {}
+    for slug in post_types.dropna().unique():
+        type = get_by_slug(slug)
+        if isinstance(type, dict) and 'metadata' in type:
+            types[slug] = type
+
+    valid = (found | ~has_id) & post_types.isin(list(types.keys()))
+    for index in df.index[~has_id & ~post_types.isin(list(types.keys()))]:
+        add_error(errores, index, None, 'Tipo de contenido no encontrado')
+
+    # convertimos cada columna una sola vez por tipo de campo
+    columns = {}
+    for slug, type in types.items():
+        for field in type['metadata']['fields']:
+            if field['destiny'] not in df.columns or field['type'] not in ['text', 'text-area', 'simple-date', 'location', 'select', 'select-multiple2']:
+                continue
+            key = (field['destiny'], field['type'], field.get('list'))
+            columns.setdefault(key, (field, []))[1].append(slug)
+
+    lists = {}
+    parsed = {}
+    for key, (field, slugs) in columns.items():
+        rows = valid & post_types.isin(slugs)
+        parsed[key] = parse_column(df[field['destiny']].where(rows), field, lists)
+
+    parents = get_parents(df['parent'][valid & df['parent'].notna()].tolist(), user)
+    parents_cache = {}
+
+    operations = []
+    operations_rows = []
+    tree_updates = []
+    updated_types = set()
+    updated_ids = []
+    processed = 0
+
+    for index in df.index[valid]:
+        id = df.at[index, 'id'] if has_id[index] else None
+        slug = post_types[index]
+
+        if id:
+            update = {}
+        else:
+            update = {
+                'status': 'published',
+                'post_type': slug,
+                'metadata': {},
+                'filesIds': [],
+            }
+
+        for field in types[slug]['metadata']['fields']:
+            key = (field['destiny'], field['type'], field.get('list'))
+            if key not in parsed:
+                continue
+            values, errors = parsed[key]
+            if not pd.isna(errors[index]):
+                add_error(errores, index, id, errors[index])
+            value = values[index]
+            if value is None or (not isinstance(value, (list, dict)) and pd.isna(value)):
+                continue
+            set_field(update, field, value)
+
+        # si en la columna parent hay un valor, lo agregamos al update
+        skip = False
+        if not pd.isna(df.at[index, 'parent']):
+            parent = parents.get(str(df.at[index, 'parent']))
+            if parent is None or parent['id'] == id:
+                add_error(errores, index, id, 'Parent no encontrado')
+                skip = True
+            elif id:
+                cache_key = (parent['id'], slug)
+                try:
+                    if cache_key not in parents_cache:
+                        parents_cache[cache_key] = validate_parent({'_id': id, 'post_type': slug, 'parent': [dict(parent)]}, True)
+                    update['parent'] = parents_cache[cache_key]['parent']
+                    update['parents'] = parents_cache[cache_key]['parents']
+                    tree_updates.append((index, id, slug, update['parent']))
+                except Exception as e:
+                    add_error(errores, index, id, str(e))
+                    skip = True
+            else:
+                update['parent'] = [parent]
+
+        if not skip:
+            if id:
+                update['updatedBy'] = user
+                update['updatedAt'] = datetime.now()
+                try:
+                    resource = ResourceUpdate(**update)
+                    operations.append(UpdateOne({'_id': ObjectId(id)}, {'$set': flatten_update(resource.dict(exclude_unset=True))}))
+                    operations_rows.append((index, id))
+                    updated_types.add(slug)
+                    updated_ids.append(id)
+                except Exception as e:
+                    add_error(errores, index, id, str(e))
+            else:
+                resp, status = create_resource(update, user, [], True)
+                if status != 201:
+                    add_error(errores, index, None, resp.get('msg'))
+                else:
+                    reporte.append({
+                        'id': resp.get('id'),
+                        'status': 'Creado'
+                    })
+
+        processed += 1
+        if len(operations) >= MASSIVE_UPDATER_BATCH_SIZE:
+            write_updates(operations, operations_rows, errores, reporte)
+            operations = []
+            operations_rows = []
+            current_task.update_state(state='PROGRESS', meta={
+                'status': 'Actualizando recursos: ' + str(processed) + ' de ' + str(total),
+                'progress': processed / total * 100,
+                'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            })
+
+    write_updates(operations, operations_rows, errores, reporte)
+
+    # las filas de la tabla de ancestros se recalculan después de escribir los nuevos padres
+    for index, id, slug, parent in tree_updates:
+        sync_resource_tree(id, parent)
+
+    # igual que en update_by_id, cambian los padres de los descendientes de los recursos movidos y de sus records.
+    # Los records de cada recurso se actualizan una sola vez aunque esté bajo varios recursos movidos
+    moved = {}
+    for index, id, slug, parent in tree_updates:
+        try:
+            update_parents(id, slug, user)
+            moved.setdefault(id, index)
+            for row in mongodb.get_all_records('resources_tree', {'ancestor': id}, fields={'_id': 0, 'descendant': 1}):
+                moved.setdefault(row['descendant'], index)
+        except Exception as e:
+            add_error(errores, index, id, str(e))
+
+    for id, index in moved.items():
+        try:
+            update_records_parents(id, user)
+        except Exception as e:
+            add_error(errores, index, id, str(e))
+
+    if tree_updates:
+        update_cache()
+        # igual que en update_by_id, al mover recursos cambian las estadísticas de todos sus ancestros
+        mark_stats_stale()
+    elif updated_types:
+        update_cache(updated_ids)
+        mark_stats_stale(updated_types)
+
+    return reporte, errores
@@ -1,7 +1,80 @@
 from redis import StrictRedis
 from redis_cache import RedisCache
+from functools import wraps
+from collections import OrderedDict
+import contextvars
+import copy
+import importlib
+import threading
+import hashlib
+import json
+import time
 import os
 
+CACHE_TAG_PREFIX = 'cache:tag:'
+# etiquetas completas de cada entrada, incluidas las que se agregaron al calcularla
+CACHE_ENTRY_PREFIX = 'cache:entry:'
+CACHE_STATS_KEY = 'cache:stats'
+CACHE_TAG_TTL = int(os.environ.get('CACHE_TAG_TTL', 7 * 86400))
+CACHE_STATS_FLUSH_INTERVAL = int(os.environ.get('CACHE_STATS_FLUSH_INTERVAL', 5))
+CACHE_LOCAL_CHANNEL = 'cache:local'
+CACHE_LOCAL_VERSION_PREFIX = 'cache:local:version:'
+CACHE_LOCAL_TTL = float(os.environ.get('CACHE_LOCAL_TTL', 5))
+CACHE_LOCAL_SIZE = int(os.environ.get('CACHE_LOCAL_SIZE', 4096))
+
+# etiquetas de la entrada que se está calculando en el contexto actual, para que las funciones anidadas le agreguen las suyas
+_computing_tags = contextvars.ContextVar('cache_computing_tags', default=None)
+
+# Cache en memoria del proceso con tiempo de vida y descarte del elemento menos usado
+class LocalCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        # cambia en cada invalidación, para no guardar un valor leído antes de invalidar
+        self.generation = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return False, None, self.generation
+            expires, value = item
+            if expires < time.monotonic():
+                del self.data[key]
+                return False, None, self.generation
+            self.data.move_to_end(key)
+            return True, value, self.generation
+
+    def set(self, key, value, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def invalidate(self, key=None):
+        with self.lock:
+            self.generation += 1
+            if key is None:
+                self.data.clear()
+            else:
+                self.data.pop(key, None)
+
+
+def _local_key(args, kwargs):
+    return json.dumps([list(args), kwargs], sort_keys=True, default=str)
+
+
+def _copy_value(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return copy.deepcopy(value)
+
+
 class CacheHandler:
     _instance = None
 
@@ -12,11 +85,276 @@ class CacheHandler:
             cache = RedisCache(redis_client=client)
             cls._instance = super().__new__(cls)
             cls._instance.cache = cache
+            cls._instance.tagged_functions = {}
+            cls._instance.stats_lock = threading.Lock()
+            cls._instance.local_stats = {}
+            cls._instance.last_flush = time.monotonic()
+            cls._instance.local_caches = {}
+            cls._instance.listener_lock = threading.Lock()
+            cls._instance.listener_pid = None
         return cls._instance
-    
+
     def clear_cache(self):
         # Limpiar la cache
         try:
             self.cache.client.flushdb()
         except Exception:
-            pass
\ No newline at end of file
+            pass
+
+    # Decorador de cache con etiquetas de dependencia. tags es un prefijo (la etiqueta es prefijo:primer argumento) o una función
+    # que recibe los argumentos de la función cacheada y retorna la lista de etiquetas de las que depende el resultado
+    def tagged(self, tags, **kwargs):
+        if isinstance(tags, str):
+            prefix = tags
+            def tags(*args, **kw):
+                value = args[0] if args else next(iter(kw.values()), None)
+                return [prefix + ':' + str(value)] if value is not None else []
+
+        def decorator(fn):
+            name = fn.__module__ + '.' + fn.__qualname__
+
+            @wraps(fn)
+            def compute(*args, **kw):
+                self.count(name, 'misses')
+                entry_tags = set(tags(*args, **kw))
+                token = _computing_tags.set(entry_tags)
+                try:
+                    result = fn(*args, **kw)
+                finally:
+                    _computing_tags.reset(token)
+                self.register(fn.__module__, fn.__qualname__, entry_tags, args, kw)
+                self.tag(*entry_tags)
+                return result
+
+            cached = self.cache.cache(**kwargs)(compute)
+
+            @wraps(fn)
+            def inner(*args, **kw):
+                self.count(name, 'calls')
+                self.tag(*tags(*args, **kw))
+                result = cached(*args, **kw)
+                # si se está calculando otra entrada, en un acierto también hereda las etiquetas que esta descubrió al calcularse
+                if _computing_tags.get() is not None:
+                    self.tag(*self.entry_tags(fn.__module__, fn.__qualname__, args, kw))
+                return result
+
+            def invalidate(*args, **kw):
+                self.count(name, 'invalidations')
+                return cached.invalidate(*args, **kw)
+
+            def invalidate_all(*args, **kw):
+                self.count(name, 'invalidations')
+                return cached.invalidate_all(*args, **kw)
+
+            inner.invalidate = invalidate
+            inner.invalidate_all = invalidate_all
+            self.tagged_functions[name] = inner
+            return inner
+
+        return decorator
+
+    # Decorador que agrega una cache en memoria del proceso delante de una función ya cacheada en redis. Se usa para valores
+    # pequeños que se consultan muchas veces por petición (roles, permisos, ajustes). Las invalidaciones se publican en redis
+    # para que todos los procesos descarten sus copias; el tiempo de vida acota lo que dure una copia si se pierde un mensaje
+    def local(self, ttl=CACHE_LOCAL_TTL, maxsize=CACHE_LOCAL_SIZE):
+        def decorator(cached):
+            name = cached.__module__ + '.' + cached.__qualname__
+            local_cache = LocalCache(maxsize, ttl)
+            self.local_caches[name] = local_cache
+
+            @wraps(cached)
+            def inner(*args, **kwargs):
+                # la copia en memoria no conserva las etiquetas, así que dentro del cálculo de otra entrada se consulta redis
+                if _computing_tags.get() is not None:
+                    return _copy_value(cached(*args, **kwargs))
+                self.start_listener()
+                key = _local_key(args, kwargs)
+                hit, value, generation = local_cache.get(key)
+                if not hit:
+                    value = cached(*args, **kwargs)
+                    local_cache.set(key, value, generation)
+                return _copy_value(value)
+
+            def invalidate(*args, **kwargs):
+                result = cached.invalidate(*args, **kwargs)
+                key = _local_key(args, kwargs)
+                local_cache.invalidate(key)
+                self.publish_invalidation(name, key)
+                return result
+
+            def invalidate_all(*args, **kwargs):
+                result = cached.invalidate_all(*args, **kwargs)
+                local_cache.invalidate()
+                self.publish_invalidation(name)
+                return result
+
+            inner.invalidate = invalidate
+            inner.invalidate_all = invalidate_all
+            # las invalidaciones por etiqueta también tienen que pasar por la cache local
+            if name in self.tagged_functions:
+                self.tagged_functions[name] = inner
+            return inner
+
+        return decorator
+
+    def publish_invalidation(self, name, key=None):
+        try:
+            version = self.cache.client.incr(CACHE_LOCAL_VERSION_PREFIX + name)
+            self.cache.client.publish(CACHE_LOCAL_CHANNEL, json.dumps({
+                'name': name,
+                'key': key,
+                'version': version,
+            }))
+        except Exception as e:
+            print(str(e))
+
+    # Inicia el hilo que escucha las invalidaciones. Se revisa el pid porque los hilos no sobreviven al fork de gunicorn o celery
+    def start_listener(self):
+        if self.listener_pid == os.getpid():
+            return
+        with self.listener_lock:
+            if self.listener_pid == os.getpid():
+                return
+            self.listener_pid = os.getpid()
+            for local_cache in self.local_caches.values():
+                local_cache.invalidate()
+            threading.Thread(target=self.listen, daemon=True).start()
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = self.cache.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CACHE_LOCAL_CHANNEL)
+                for message in pubsub.listen():
+                    data = json.loads(message['data'])
+                    local_cache = self.local_caches.get(data.get('name'))
+                    if local_cache:
+                        local_cache.invalidate(data.get('key'))
+            except Exception as e:
+                print(str(e))
+                # sin conexión no llegan las invalidaciones, así que no se confía en lo que hay en memoria
+                for local_cache in self.local_caches.values():
+                    local_cache.invalidate()
+                time.sleep(1)
+
+    # Agrega etiquetas a la entrada que se está calculando. Sirve para dependencias que solo se conocen al leer los datos
+    def tag(self, *tags):
+        current = _computing_tags.get()
+        if current is not None:
+            current.update(t for t in tags if t)
+
+    def register(self, module, qualname, tags, args, kwargs):
+        if not tags:
+            return
+        try:
+            entry = json.dumps([module, qualname, list(args), kwargs])
+            entry_key = CACHE_ENTRY_PREFIX + hashlib.sha1(entry.encode('utf-8')).hexdigest()
+            pipe = self.cache.client.pipeline(transaction=False)
+            for tag in tags:
+                pipe.sadd(CACHE_TAG_PREFIX + tag, entry)
+                pipe.expire(CACHE_TAG_PREFIX + tag, CACHE_TAG_TTL)
+            pipe.delete(entry_key)
+            pipe.sadd(entry_key, *tags)
+            pipe.expire(entry_key, CACHE_TAG_TTL)
+            pipe.execute()
+        except Exception as e:
+            print(str(e))
+
+    # Etiquetas guardadas de una entrada
+    def entry_tags(self, module, qualname, args, kwargs):
+        try:
+            entry = json.dumps([module, qualname, list(args), kwargs])
+            return self.cache.client.smembers(CACHE_ENTRY_PREFIX + hashlib.sha1(entry.encode('utf-8')).hexdigest())
+        except Exception as e:
+            print(str(e))
+            return []
+
+    # Invalida solo las entradas que dependen de alguna de las etiquetas
+    def invalidate_tags(self, *tags):
+        keys = list(dict.fromkeys(CACHE_TAG_PREFIX + str(t) for t in tags if t))
+        if not keys:
+            return 0
+
+        pipe = self.cache.client.pipeline()
+        for key in keys:
+            pipe.smembers(key)
+        pipe.delete(*keys)
+        results = pipe.execute()
+
+        entries = set()
+        for members in results[:-1]:
+            entries.update(members)
+
+        for entry in entries:
+            module, qualname, args, kwargs = json.loads(entry)
+            fn = self.get_tagged_function(module, qualname)
+            if fn:
+                fn.invalidate(*args, **kwargs)
+
+        return len(entries)
+
+    def get_tagged_function(self, module, qualname):
+        name = module + '.' + qualname
+        if name not in self.tagged_functions:
+            try:
+                importlib.import_module(module)
+            except Exception:
+                return None
+        return self.tagged_functions.get(name)
+
+    # Los contadores se acumulan en memoria y se envían a redis cada CACHE_STATS_FLUSH_INTERVAL segundos
+    def count(self, name, field):
+        with self.stats_lock:
+            stats = self.local_stats.setdefault(name, {'calls': 0, 'misses': 0, 'invalidations': 0})
+            stats[field] += 1
+            if time.monotonic() - self.last_flush < CACHE_STATS_FLUSH_INTERVAL:
+                return
+            pending = self.local_stats
+            self.local_stats = {}
+            self.last_flush = time.monotonic()
+        self.flush_stats(pending)
+
+    def flush_stats(self, pending=None):
+        if pending is None:
+            with self.stats_lock:
+                pending = self.local_stats
+                self.local_stats = {}
+                self.last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            pipe = self.cache.client.pipeline(transaction=False)
+            for name, stats in pending.items():
+                for field, value in stats.items():
+                    if value:
+                        pipe.hincrby(CACHE_STATS_KEY, name + '|' + field, value)
+            pipe.execute()
+        except Exception as e:
+            print(str(e))
+
+    # Retorna los aciertos, fallos e invalidaciones de cada función cacheada con etiquetas, sumando todos los procesos
+    def get_stats(self):
+        self.flush_stats()
+        raw = self.cache.client.hgetall(CACHE_STATS_KEY)
+
+        stats = {}
+        for key, value in raw.items():
+            name, field = key.rsplit('|', 1)
+            stats.setdefault(name, {'calls': 0, 'misses': 0, 'invalidations': 0})[field] = int(value)
+
+        resp = {}
+        for name in sorted(stats):
+            calls = stats[name]['calls']
+            misses = stats[name]['misses']
+            resp[name] = {
+                'hits': max(calls - misses, 0),
+                'misses': misses,
+                'invalidations': stats[name]['invalidations'],
+                'hit_ratio': round((calls - misses) / calls, 4) if calls else 0,
+            }
+        return resp
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.local_stats = {}
+        self.cache.client.delete(CACHE_STATS_KEY)
@@ -57,6 +57,14 @@ class DatabaseHandler:
 
         return self.mydb[collection].insert_one(payload)
     
+    # Esta función sirve para insertar varios registros (diccionarios) en una colección en una sola operación
+    def insert_records(self, collection, records, ordered=False):
+        return self.mydb[collection].insert_many(records, ordered=ordered)
+
+    # Esta función sirve para ejecutar varias operaciones de escritura (UpdateOne, InsertOne, etc.) en una sola petición
+    def bulk_write(self, collection, operations, ordered=False):
+        return self.mydb[collection].bulk_write(operations, ordered=ordered)
+
     # Esta función sirve para incrementar un campo de un registro en una colección
     def increment_record(self, collection, filters, field, value):
         return self.mydb[collection].update_one(filters, {'$inc': {field: value}})
@@ -77,6 +85,14 @@ class DatabaseHandler:
     def count(self, collection, filters={}):
         return self.mydb[collection].count_documents(filters)
     
+    # Esta función sirve para obtener el total aproximado de registros de una colección a partir de sus metadatos, sin recorrerla
+    def estimated_count(self, collection):
+        return self.mydb[collection].estimated_document_count()
+
     # Esta función permite hacer una agregación en una colección
     def aggregate(self, collection, pipeline):
-        return self.mydb[collection].aggregate(pipeline)
\ No newline at end of file
+        return self.mydb[collection].aggregate(pipeline)
+
+    # Esta función sirve para crear un índice en una colección si no existe
+    def create_index(self, collection, keys, **kwargs):
+        return self.mydb[collection].create_index(keys, **kwargs)
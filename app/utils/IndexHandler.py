@@ -1,6 +1,10 @@
 import os
+import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 from ssl import create_default_context
 from dotenv import load_dotenv
 load_dotenv()
@@ -15,9 +19,26 @@ ELASTIC_DOMAIN = os.environ.get('ELASTIC_DOMAIN', '')
 ELASTIC_PORT = os.environ.get('ELASTIC_PORT', '')
 ELASTIC_INDEX_PREFIX = os.environ.get('ELASTIC_INDEX_PREFIX', '')
 ELASTIC_CERT = os.environ.get('ELASTIC_CERT', '')
+ELASTIC_POOL_SIZE = int(os.environ.get('ELASTIC_POOL_SIZE', 20))
+ELASTIC_CONNECT_TIMEOUT = float(os.environ.get('ELASTIC_CONNECT_TIMEOUT', 5))
+ELASTIC_READ_TIMEOUT = float(os.environ.get('ELASTIC_READ_TIMEOUT', 60))
+ELASTIC_MAX_RETRIES = int(os.environ.get('ELASTIC_MAX_RETRIES', 3))
+ELASTIC_RETRY_BACKOFF = float(os.environ.get('ELASTIC_RETRY_BACKOFF', 0.5))
+# endpoints que se llaman con POST pero no modifican nada, así que se pueden reintentar con cualquier error
+ELASTIC_READ_ONLY_ENDPOINTS = {'_search', '_count'}
 
 hookHandler = HookHandler.HookHandler()
 
+# Reintentos de las peticiones a elasticsearch. POST (_bulk, _reindex, _delete_by_query, _update) no es idempotente: una
+# respuesta 502/503/504 o un error de lectura no garantiza que no se haya ejecutado, así que solo se reintenta con 429
+# (rechazada antes de ejecutarse) o cuando no se llegó a conectar. Los POST de solo lectura van por otra sesión que sí
+# los reintenta
+class ElasticRetry(Retry):
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method and method.upper() == 'POST':
+            return status_code == 429 and bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
 class IndexHandler:
     _instance = None
 
@@ -33,9 +54,102 @@ class IndexHandler:
                 cls._instance.ssl_context = ELASTIC_CERT
             else:
                 cls._instance.ssl_context = None
+            cls._instance.session = cls._instance.create_session()
+            cls._instance.read_session = cls._instance.create_session(read_only=True)
+            cls._instance.stats_lock = threading.Lock()
+            cls._instance.endpoint_stats = {}
+            cls._instance.in_flight = 0
             cls._instance.start()
         return cls._instance
 
+    # Crea una sesión con pool de conexiones persistentes y reintentos con backoff. Con read_only también se reintentan
+    # los POST
+    def create_session(self, read_only=False):
+        session = requests.Session()
+        session.auth = HTTPBasicAuth(ELASTIC_USER, ELASTIC_PASSWORD)
+        if self.ssl_context:
+            session.verify = self.ssl_context
+
+        retry_class = Retry if read_only else ElasticRetry
+        retry = retry_class(
+            total=ELASTIC_MAX_RETRIES,
+            backoff_factor=ELASTIC_RETRY_BACKOFF,
+            status_forcelist=(429, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'PUT', 'DELETE', 'HEAD'] + (['POST'] if read_only else [])),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=ELASTIC_POOL_SIZE, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    # Ejecuta una petición contra elasticsearch usando la sesión compartida y registra su latencia por endpoint
+    def request(self, method, path, endpoint, **kwargs):
+        url = ELASTIC_DOMAIN + ':' + ELASTIC_PORT + path
+        kwargs.setdefault('timeout', (ELASTIC_CONNECT_TIMEOUT, ELASTIC_READ_TIMEOUT))
+        key = method + ' ' + endpoint
+
+        with self.stats_lock:
+            self.in_flight += 1
+        start = time.perf_counter()
+        error = False
+        try:
+            session = self.read_session if endpoint in ELASTIC_READ_ONLY_ENDPOINTS else self.session
+            response = session.request(method, url, **kwargs)
+            error = response.status_code >= 500
+            return response
+        except Exception:
+            error = True
+            raise
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            with self.stats_lock:
+                self.in_flight -= 1
+                stats = self.endpoint_stats.setdefault(key, {'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+                stats['count'] += 1
+                stats['total_ms'] += elapsed
+                stats['max_ms'] = max(stats['max_ms'], elapsed)
+                if error:
+                    stats['errors'] += 1
+
+    # Retorna el uso del pool de conexiones y la latencia por endpoint del proceso actual
+    def get_stats(self):
+        pools = []
+        for read_only, session in ((False, self.session), (True, self.read_session)):
+            adapter = session.get_adapter(ELASTIC_DOMAIN + ':' + ELASTIC_PORT)
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                pools.append({
+                    'read_only': read_only,
+                    'host': pool.host,
+                    'port': pool.port,
+                    'maxsize': pool.pool.maxsize if pool.pool else ELASTIC_POOL_SIZE,
+                    'idle': pool.pool.qsize() if pool.pool else 0,
+                    'connections_opened': pool.num_connections,
+                    'requests': pool.num_requests,
+                })
+
+        with self.stats_lock:
+            endpoints = {}
+            for key, stats in self.endpoint_stats.items():
+                endpoints[key] = {
+                    'count': stats['count'],
+                    'errors': stats['errors'],
+                    'avg_ms': round(stats['total_ms'] / stats['count'], 2) if stats['count'] else 0,
+                    'max_ms': round(stats['max_ms'], 2),
+                }
+            in_flight = self.in_flight
+
+        return {
+            'pid': os.getpid(),
+            'pool_size': ELASTIC_POOL_SIZE,
+            'in_flight': in_flight,
+            'pools': pools,
+            'endpoints': endpoints,
+        }
+
     def start(self):
         keys = self.get_aliases().keys()
         if len(keys) == 0:
@@ -48,29 +162,19 @@ class IndexHandler:
         self.add_to_alias(ELASTIC_INDEX_PREFIX + '-' + slug, index_name)
 
     def get_aliases(self):
-        url = ELASTIC_DOMAIN + ':' + ELASTIC_PORT + '/_aliases'
-        if self.ssl_context:
-            response = requests.get(url, auth=HTTPBasicAuth(
-                ELASTIC_USER, ELASTIC_PASSWORD), verify=self.ssl_context)
-        else:
-            response = requests.get(url, auth=HTTPBasicAuth(
-            ELASTIC_USER, ELASTIC_PASSWORD))
+        path = '/_aliases'
+        response = self.request('GET', path, '_aliases')
         return response.json()
     
     def get_alias_indexes(self, alias):
-        url = ELASTIC_DOMAIN + ':' + ELASTIC_PORT + '/_alias/' + alias
-        if self.ssl_context:
-            response = requests.get(url, auth=HTTPBasicAuth(
-                ELASTIC_USER, ELASTIC_PASSWORD), verify=self.ssl_context)
-        else:
-            response = requests.get(url, auth=HTTPBasicAuth(
-            ELASTIC_USER, ELASTIC_PASSWORD))
+        path = '/_alias/' + alias
+        response = self.request('GET', path, '_alias')
 
 
         return response.json()
 
     def create_index(self, index, settings=None, mapping=None):
-        url = ELASTIC_DOMAIN + ':' + ELASTIC_PORT + '/' + index
+        path = '/' + index
 
         json = {}
         if settings:
@@ -86,17 +190,12 @@ class IndexHandler:
         if json_temp:
             json = json_temp
 
-        if self.ssl_context:
-            response = requests.put(url, json=json, auth=HTTPBasicAuth(
-                ELASTIC_USER, ELASTIC_PASSWORD), verify=self.ssl_context)
-        else:
-            response = requests.put(url, json=json, auth=HTTPBasicAuth(
-            ELASTIC_USER, ELASTIC_PASSWORD))
+        response = self.request('PUT', path, 'index', json=json)
         
         return response.json()
 
     def add_to_alias(self, alias, index):
-        url = ELASTIC_DOMAIN + ':' + ELASTIC_PORT + '/_aliases'
+        path = '/_aliases'
         body = {
             'actions': [
                 {
@@ -107,16 +206,11 @@ class IndexHandler:
                 }
             ]
         }
-        if self.ssl_context:
-            response = requests.post(url, json=body, auth=HTTPBasicAuth(
-                ELASTIC_USER, ELASTIC_PASSWORD), verify=self.ssl_context)
-        else:
-            response = requests.post(url, json=body, auth=HTTPBasicAuth(
-            ELASTIC_USER, ELASTIC_PASSWORD))
+        response = self.request('POST', path, '_aliases', json=body)
         return response.json()
 
     def remove_from_alias(self, alias, index):
-        url = ELASTIC_DOMAIN + ':' + ELASTIC_PORT + '/_aliases'
+        path = '/_aliases'
         body = {
             'actions': [
                 {
@@ -127,26 +221,16 @@ class IndexHandler:
                 }
             ]
         }
-        if self.ssl_context:
-            response = requests.post(url, json=body, auth=HTTPBasicAuth(
-                ELASTIC_USER, ELASTIC_PASSWORD), verify=self.ssl_context)
-        else:
-            response = requests.post(url, json=body, auth=HTTPBasicAuth(
-            ELASTIC_USER, ELASTIC_PASSWORD))
+        response = self.request('POST', path, '_aliases', json=body)
         return response.json()
     
     def delete_index(self, index):
-        url = ELASTIC_DOMAIN + ':' + ELASTIC_PORT + '/' + index
-        if self.ssl_context:
-            response = requests.delete(url, auth=HTTPBasicAuth(
-                ELASTIC_USER, ELASTIC_PASSWORD), verify=self.ssl_context)
-        else:
-            response = requests.delete(url, auth=HTTPBasicAuth(
-            ELASTIC_USER, ELASTIC_PASSWORD))
+        path = '/' + index
+        response = self.request('DELETE', path, 'index')
         return response.json()
     
     def delete_all_documents(self, index, query=None):
-        url = ELASTIC_DOMAIN + ':' + ELASTIC_PORT + '/' + index + '/_delete_by_query'
+        path = '/' + index + '/_delete_by_query'
         if query is None:
             query = {
                 'query': {
@@ -157,27 +241,17 @@ class IndexHandler:
             query = {
                 'query': query
             }
-        if self.ssl_context:
-            response = requests.post(url, json=query, auth=HTTPBasicAuth(
-                ELASTIC_USER, ELASTIC_PASSWORD), verify=self.ssl_context)
-        else:
-            response = requests.post(url, json=query, auth=HTTPBasicAuth(
-            ELASTIC_USER, ELASTIC_PASSWORD))
+        response = self.request('POST', path, '_delete_by_query', json=query, timeout=(ELASTIC_CONNECT_TIMEOUT, None))
         return response.json()
     
     def delete_document(self, index, id):
-        url = ELASTIC_DOMAIN + ':' + ELASTIC_PORT + '/' + index + '/_doc/' + id
-        if self.ssl_context:
-            response = requests.delete(url, auth=HTTPBasicAuth(
-                ELASTIC_USER, ELASTIC_PASSWORD), verify=self.ssl_context)
-        else:
-            response = requests.delete(url, auth=HTTPBasicAuth(
-            ELASTIC_USER, ELASTIC_PASSWORD))
+        path = '/' + index + '/_doc/' + id
+        response = self.request('DELETE', path, '_doc')
         
         return response.json()
     
     def reindex(self, source, dest):
-        url = ELASTIC_DOMAIN + ':' + ELASTIC_PORT + '/_reindex'
+        path = '/_reindex'
         body = {
             'source': {
                 'index': source
@@ -186,46 +260,32 @@ class IndexHandler:
                 'index': dest
             }
         }
-        if self.ssl_context:
-            response = requests.post(url, json=body, auth=HTTPBasicAuth(
-                ELASTIC_USER, ELASTIC_PASSWORD), verify=self.ssl_context)
-        else:
-            response = requests.post(url, json=body, auth=HTTPBasicAuth(
-            ELASTIC_USER, ELASTIC_PASSWORD))
+        response = self.request('POST', path, '_reindex', json=body, timeout=(ELASTIC_CONNECT_TIMEOUT, None))
         return response.json()
 
     def set_mapping(self, index, mapping):
-        url = ELASTIC_DOMAIN + ':' + \
-            ELASTIC_PORT + '/' + index + '/_mapping'
-        if self.ssl_context:
-            response = requests.put(url, json=mapping, auth=HTTPBasicAuth(
-                ELASTIC_USER, ELASTIC_PASSWORD), verify=self.ssl_context)
-        else:
-            response = requests.put(url, json=mapping, auth=HTTPBasicAuth(
-            ELASTIC_USER, ELASTIC_PASSWORD))
+        path = '/' + index + '/_mapping'
+        response = self.request('PUT', path, '_mapping', json=mapping)
         return response.json()
     
     def index_document(self, index, id, document):
-        url = ELASTIC_DOMAIN + ':' + \
-            ELASTIC_PORT + '/' + index + '/_doc/' + id
-        if self.ssl_context:
-            response = requests.put(url, json=document, auth=HTTPBasicAuth(
-                ELASTIC_USER, ELASTIC_PASSWORD), verify=self.ssl_context)
-        else:
-            response = requests.put(url, json=document, auth=HTTPBasicAuth(
-            ELASTIC_USER, ELASTIC_PASSWORD))
+        path = '/' + index + '/_doc/' + id
+        response = self.request('PUT', path, '_doc', json=document)
         
         return response
-    
+
+    # Envía un lote de operaciones en formato NDJSON al endpoint _bulk de elasticsearch
+    def bulk(self, payload):
+        path = '/_bulk'
+        headers = {'Content-Type': 'application/x-ndjson'}
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        response = self.request('POST', path, '_bulk', data=payload, headers=headers)
+        return response.json()
+
     def search(self, index, query):
-        url = ELASTIC_DOMAIN + ':' + \
-            ELASTIC_PORT + '/' + index + '/_search'
-        if self.ssl_context:
-            response = requests.post(url, json=query, auth=HTTPBasicAuth(
-                ELASTIC_USER, ELASTIC_PASSWORD), verify=self.ssl_context)
-        else:
-            response = requests.post(url, json=query, auth=HTTPBasicAuth(
-            ELASTIC_USER, ELASTIC_PASSWORD))
+        path = '/' + index + '/_search'
+        response = self.request('POST', path, '_search', json=query)
         return response.json()
     
     def regenerate_index(self, index, mapping):
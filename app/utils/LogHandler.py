@@ -0,0 +1,175 @@
+from app.utils import DatabaseHandler
+from app.utils import CacheHandler
+from bson import json_util
+from celery.signals import worker_process_shutdown
+from pymongo.errors import AutoReconnect, NetworkTimeout, BulkWriteError, InvalidDocument, DocumentTooLarge, DuplicateKeyError
+from datetime import datetime
+import threading
+import atexit
+import copy
+import os
+
+LOG_COLLECTION = 'logs'
+# campos de los logs por los que se filtra el listado y que tienen un contador incremental
+LOG_COUNTED_FIELDS = ('action', 'username')
+LOG_BUFFER_SIZE = int(os.environ.get('LOG_BUFFER_SIZE', 200))
+LOG_BUFFER_MAX = int(os.environ.get('LOG_BUFFER_MAX', 10000))
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 2))
+# memory: cada proceso escribe sus logs en lotes. redis: los logs se encolan en un stream y un worker de celery los escribe
+LOG_SPOOL = os.environ.get('LOG_SPOOL', 'memory')
+LOG_SPOOL_STREAM = 'logs:spool'
+LOG_SPOOL_LOCK = 'logs:spool:lock'
+LOG_SPOOL_MAXLEN = int(os.environ.get('LOG_SPOOL_MAXLEN', 1000000))
+# logs que no se pudieron escribir por un error del documento (inválido, demasiado grande), guardados como texto
+LOG_REJECTED_COLLECTION = 'logs_rejected'
+LOG_REJECTED_MAX_CHARS = 10000
+
+mongodb = DatabaseHandler.DatabaseHandler()
+cacheHandler = CacheHandler.CacheHandler()
+
+# Escritura de los logs fuera del hilo de la petición. Los logs se acumulan en memoria y se insertan con insert_many cuando
+# se llena el lote o pasa LOG_FLUSH_INTERVAL, y lo pendiente se escribe al terminar el proceso
+class LogHandler:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.lock = threading.Lock()
+            cls._instance.flush_lock = threading.Lock()
+            cls._instance.buffer = []
+            cls._instance.event = threading.Event()
+            cls._instance.writer_pid = None
+            atexit.register(cls._instance.flush)
+            worker_process_shutdown.connect(cls._instance.on_worker_shutdown, weak=False)
+        return cls._instance
+
+    def add(self, log):
+        if LOG_SPOOL == 'redis' and self.spool(log):
+            return
+
+        self.start_writer()
+        with self.lock:
+            self.buffer.append(copy.deepcopy(log))
+            if len(self.buffer) > LOG_BUFFER_MAX:
+                del self.buffer[:len(self.buffer) - LOG_BUFFER_MAX]
+            full = len(self.buffer) >= LOG_BUFFER_SIZE
+        if full:
+            self.event.set()
+
+    def spool(self, log):
+        try:
+            cacheHandler.cache.client.xadd(LOG_SPOOL_STREAM, {'log': json_util.dumps(log)},
+                                           maxlen=LOG_SPOOL_MAXLEN, approximate=True)
+            return True
+        except Exception as e:
+            print(str(e))
+            return False
+
+    # Inicia el hilo que escribe los lotes. Se revisa el pid porque los hilos no sobreviven al fork de gunicorn o celery
+    def start_writer(self):
+        if self.writer_pid == os.getpid():
+            return
+        with self.lock:
+            if self.writer_pid == os.getpid():
+                return
+            # lo que haya en memoria pertenece al proceso padre, que lo escribe él mismo
+            self.buffer = []
+            self.writer_pid = os.getpid()
+            threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def write_loop(self):
+        while True:
+            self.event.wait(LOG_FLUSH_INTERVAL)
+            self.event.clear()
+            self.flush()
+
+    def flush(self):
+        # un proceso hijo que no ha registrado logs tiene la copia de lo pendiente del padre
+        if self.writer_pid != os.getpid():
+            return 0
+        with self.flush_lock:
+            with self.lock:
+                if not self.buffer:
+                    return 0
+                batch = self.buffer
+                self.buffer = []
+            try:
+                self.write(batch)
+                return len(batch)
+            except (AutoReconnect, NetworkTimeout) as e:
+                print(str(e))
+                # error transitorio: se devuelven al inicio de la cola para reintentar en el siguiente ciclo, sin el _id
+                # que les asignó insert_many
+                for log in batch:
+                    log.pop('_id', None)
+                with self.lock:
+                    self.buffer = (batch + self.buffer)[-LOG_BUFFER_MAX:]
+                return 0
+            except Exception as e:
+                # cualquier otro error no se resuelve reintentando; el lote se descarta
+                print(str(e))
+                return 0
+
+    # Inserta los logs y actualiza los contadores de los que se escribieron. Los documentos que mongo rechaza se apartan
+    # en LOG_REJECTED_COLLECTION en lugar de reintentarlos. Los errores de conexión se propagan
+    def write(self, logs):
+        from app.utils.functions import update_counters
+        written = logs
+        try:
+            mongodb.insert_records(LOG_COLLECTION, logs)
+        except BulkWriteError as e:
+            failed = {error['index']: error.get('errmsg') for error in e.details.get('writeErrors', [])}
+            written = [log for x, log in enumerate(logs) if x not in failed]
+            self.reject([(logs[x], message) for x, message in failed.items()])
+        except (InvalidDocument, DocumentTooLarge):
+            # un documento que no se puede codificar hace fallar toda la llamada; se insertan uno a uno
+            written = []
+            rejected = []
+            for log in logs:
+                try:
+                    mongodb.insert_record(LOG_COLLECTION, log)
+                    written.append(log)
+                except DuplicateKeyError:
+                    # ya se había escrito en la llamada anterior
+                    written.append(log)
+                except (InvalidDocument, DocumentTooLarge) as e:
+                    rejected.append((log, str(e)))
+            self.reject(rejected)
+        update_counters(LOG_COLLECTION, written, LOG_COUNTED_FIELDS)
+
+    def reject(self, items):
+        if not items:
+            return
+        try:
+            mongodb.insert_records(LOG_REJECTED_COLLECTION, [{
+                'error': message,
+                'log': json_util.dumps({k: v for k, v in log.items() if k != '_id'}, default=str)[:LOG_REJECTED_MAX_CHARS],
+                'date': datetime.now(),
+            } for log, message in items])
+        except Exception as e:
+            print(str(e))
+
+    def on_worker_shutdown(self, **kwargs):
+        self.flush()
+
+    # Escribe en la base de datos los logs encolados en redis. Solo un worker a la vez vacía el stream
+    def drain_spool(self, batch_size=None, timeout=60):
+        batch_size = batch_size or LOG_BUFFER_SIZE
+        client = cacheHandler.cache.client
+        if not client.set(LOG_SPOOL_LOCK, os.getpid(), nx=True, ex=timeout):
+            return 0
+
+        total = 0
+        try:
+            while True:
+                entries = client.xrange(LOG_SPOOL_STREAM, '-', '+', count=batch_size)
+                if not entries:
+                    break
+                self.write([json_util.loads(fields['log']) for _id, fields in entries])
+                client.xdel(LOG_SPOOL_STREAM, *[_id for _id, fields in entries])
+                total += len(entries)
+                client.expire(LOG_SPOOL_LOCK, timeout)
+        finally:
+            client.delete(LOG_SPOOL_LOCK)
+        return total
@@ -0,0 +1,70 @@
+from app.utils import DatabaseHandler
+import threading
+
+mongodb = DatabaseHandler.DatabaseHandler()
+
+class PluginRegistry:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance.lock = threading.Lock()
+            cls._instance.plugins = None
+        return cls._instance
+
+    # Importa los plugins activos una sola vez y guarda su información, sus capacidades y una instancia para leer sus acciones.
+    # Se vuelve a cargar solo cuando cambia el conjunto de plugins activos
+    def load(self, active=None):
+        if active is None:
+            record = mongodb.get_record('system', {'name': 'active_plugins'})
+            active = record['data'] if record else []
+
+        plugins = {}
+        for slug in active:
+            try:
+                plugin_module = __import__(f'app.plugins.{slug}', fromlist=[
+                    'ExtendedPluginClass', 'plugin_info'])
+                plugin_info = plugin_module.plugin_info.copy()
+                instance = plugin_module.ExtendedPluginClass(
+                    slug, __name__, **plugin_info, isTask=True)
+            except Exception as e:
+                print(slug, str(e))
+                continue
+
+            plugins[slug] = {
+                'info': plugin_info,
+                'instance': instance,
+                'capabilities': instance.get_capabilities() or [],
+            }
+
+        with self.lock:
+            self.plugins = plugins
+        return plugins
+
+    def get_plugins(self):
+        plugins = self.plugins
+        if plugins is None:
+            with self.lock:
+                plugins = self.plugins
+            if plugins is None:
+                plugins = self.load()
+        return plugins
+
+    def get_capabilities(self):
+        capabilities = []
+        for plugin in self.get_plugins().values():
+            capabilities = [*capabilities, *plugin['capabilities']]
+        return capabilities
+
+    # Las acciones se traducen en cada llamada porque dependen del idioma de la petición
+    def get_actions(self, placement):
+        actions = []
+        for slug, plugin in self.get_plugins().items():
+            a = plugin['instance'].get_actions()
+            if a:
+                for _a in a:
+                    if _a['placement'] == placement:
+                        _a['plugin'] = slug
+                        actions.append(_a)
+        return actions
@@ -1,15 +1,26 @@
 from qdrant_client import QdrantClient, models
+from app.utils import DatabaseHandler
+from collections import OrderedDict
+from datetime import datetime
 from dotenv import load_dotenv
+import threading
+import uuid
 import os
 load_dotenv()
 
 VECTOR_HOST = os.environ.get('VECTOR_HOST', 'localhost')
 VECTOR_PORT = os.environ.get('VECTOR_PORT', '6333')
-VECTOR_SIZE = os.environ.get('VECTOR_SIZE', 768)
+VECTOR_SIZE = int(os.environ.get('VECTOR_SIZE', 768))
+VECTOR_ENCODE_BATCH_SIZE = int(os.environ.get('VECTOR_ENCODE_BATCH_SIZE', 32))
+VECTOR_ENCODE_THREADS = int(os.environ.get('VECTOR_ENCODE_THREADS', 0))
+VECTOR_UPSERT_SIZE = int(os.environ.get('VECTOR_UPSERT_SIZE', 256))
+VECTOR_QUERY_CACHE_SIZE = int(os.environ.get('VECTOR_QUERY_CACHE_SIZE', 1024))
 
 METADATA_RESOURCES = 'metadata_resources'
 TRANSCRIPT_RECORDS = 'transcript_records'
 
+mongodb = DatabaseHandler.DatabaseHandler()
+
 class VectorDatabaseHandler:
     _instance = None
     
@@ -18,9 +29,14 @@ class VectorDatabaseHandler:
             cls._instance = super().__new__(cls)
             cls._instance.vector_host = VECTOR_HOST
             cls._instance.vector_port = VECTOR_PORT
+            if VECTOR_ENCODE_THREADS > 0:
+                import torch
+                torch.set_num_threads(VECTOR_ENCODE_THREADS)
             from sentence_transformers import SentenceTransformer, util
             cls._instance.embedding_model = SentenceTransformer("jinaai/jina-embeddings-v2-base-es", trust_remote_code=True)
             cls._instance.qdrant = QdrantClient(host=cls._instance.vector_host, port=cls._instance.vector_port)
+            cls._instance.query_cache = OrderedDict()
+            cls._instance.query_cache_lock = threading.Lock()
             
             if not cls._instance.qdrant.collection_exists(METADATA_RESOURCES):
                 cls._instance.qdrant.create_collection(METADATA_RESOURCES, vectors_config=models.VectorParams(
@@ -44,26 +60,101 @@ class VectorDatabaseHandler:
                     field_name='id',
                     field_schema=models.PayloadSchemaType.KEYWORD
                 )
+
+            # los fragmentos de contexto de las conversaciones se filtran por record, procesamiento, versión y página
+            collection_info = cls._instance.qdrant.get_collection(TRANSCRIPT_RECORDS)
+            for field, schema in (('record_id', models.PayloadSchemaType.KEYWORD), ('slug', models.PayloadSchemaType.KEYWORD),
+                                  ('version', models.PayloadSchemaType.KEYWORD), ('page', models.PayloadSchemaType.INTEGER)):
+                if field not in collection_info.payload_schema:
+                    cls._instance.qdrant.create_payload_index(
+                        collection_name=TRANSCRIPT_RECORDS,
+                        field_name=field,
+                        field_schema=schema
+                    )
             
         return cls._instance
     
-    def insert_vector(self, collection, text, payload):
-        vector = self.embedding_model.encode(text)
-        self.qdrant.upsert(
-            collection_name=collection,
-            points=vector[0],
-            payload=payload
+    # Codifica una lista de textos en lotes. Retorna una lista de vectores en el mismo orden
+    def encode(self, texts, batch_size=None):
+        if not texts:
+            return []
+        vectors = self.embedding_model.encode(
+            texts,
+            batch_size=batch_size or VECTOR_ENCODE_BATCH_SIZE,
+            show_progress_bar=False,
+            convert_to_numpy=True
         )
-        
-    def search_vector(self, collection, text, limit=5):
-        vector = self.embedding_model.encode(text)
+        return [v.tolist() for v in vectors]
+
+    # Codifica una consulta reutilizando los vectores de las consultas recientes
+    def encode_query(self, text):
+        with self.query_cache_lock:
+            if text in self.query_cache:
+                self.query_cache.move_to_end(text)
+                return self.query_cache[text]
+
+        vector = self.encode([text])[0]
+
+        with self.query_cache_lock:
+            self.query_cache[text] = vector
+            self.query_cache.move_to_end(text)
+            while len(self.query_cache) > VECTOR_QUERY_CACHE_SIZE:
+                self.query_cache.popitem(last=False)
+        return vector
+
+    def point_id(self, id):
+        try:
+            return str(uuid.UUID(str(id)))
+        except ValueError:
+            return str(uuid.uuid5(uuid.NAMESPACE_URL, str(id)))
+
+    def insert_vector(self, collection, text, payload, id=None):
+        return self.insert_vectors(collection, [{'id': id or uuid.uuid4(), 'text': text, 'payload': payload}])
+
+    # Inserta varios textos codificándolos por lotes y haciendo upsert en bloques.
+    # Si se indica checkpoint, el avance se guarda en la colección vector_checkpoints y una nueva llamada
+    # con el mismo checkpoint y los mismos items continúa desde el último bloque confirmado
+    def insert_vectors(self, collection, items, batch_size=None, upsert_size=None, checkpoint=None):
+        batch_size = batch_size or VECTOR_ENCODE_BATCH_SIZE
+        upsert_size = upsert_size or VECTOR_UPSERT_SIZE
+
+        start = 0
+        if checkpoint:
+            saved = mongodb.get_record('vector_checkpoints', {'name': checkpoint, 'collection': collection})
+            if saved:
+                start = saved['position']
+
+        inserted = 0
+        for x in range(start, len(items), upsert_size):
+            chunk = items[x:x + upsert_size]
+            vectors = self.encode([i['text'] for i in chunk], batch_size=batch_size)
+            points = [
+                models.PointStruct(id=self.point_id(i['id']), vector=v, payload=i.get('payload', {}))
+                for i, v in zip(chunk, vectors)
+            ]
+            self.qdrant.upsert(collection_name=collection, points=points, wait=True)
+            inserted += len(points)
+
+            if checkpoint:
+                mongodb.update_record_operator('vector_checkpoints', {'name': checkpoint, 'collection': collection}, {
+                    '$set': {'position': x + len(chunk), 'total': len(items), 'updatedAt': datetime.now()}
+                }, upsert=True)
+
+        if checkpoint:
+            mongodb.delete_record('vector_checkpoints', {'name': checkpoint, 'collection': collection})
+
+        return inserted
+
+    def search_vector(self, collection, text, limit=5, query_filter=None, indexed_only=True):
+        vector = self.encode_query(text)
         return self.qdrant.search(
             collection_name=collection,
-            query=vector[0],
+            query_vector=vector,
+            query_filter=query_filter,
             limit=limit,
-            search_params=models.SearchRequest(
+            search_params=models.SearchParams(
                 hnsw_ef=128,
                 exact=False,
-                indexed_only=True,
+                indexed_only=indexed_only,
             )
-        )
\ No newline at end of file
+        )
@@ -4,17 +4,57 @@ from functools import lru_cache
 from bson import json_util
 import json
 from bson.objectid import ObjectId
+from pymongo import UpdateOne
 import os
 from dotenv import load_dotenv
 from PIL import Image
-from flask import Response, jsonify
+from flask import Response, current_app, jsonify, send_file, stream_with_context
+from itsdangerous import URLSafeTimedSerializer, URLSafeSerializer, BadSignature
 from flask_babel import gettext as _
 import datetime
 import base64
+import mimetypes
+import hashlib
+import zipfile
+import io
 import unicodedata
+import math
+import time
+import uuid
+import tempfile
+import ffmpeg
 load_dotenv()
 
 WEB_FILES_PATH = os.environ.get('WEB_FILES_PATH', '')
+ORIGINAL_FILES_PATH = os.environ.get('ORIGINAL_FILES_PATH', '')
+WEB_FILES_ACCEL_PREFIX = os.environ.get('WEB_FILES_ACCEL_PREFIX', '')
+WEB_FILES_MAX_AGE = int(os.environ.get('WEB_FILES_MAX_AGE', 86400))
+ZIP_DOWNLOAD_EXPIRATION = int(os.environ.get('ZIP_DOWNLOAD_EXPIRATION', 86400))
+THUMBNAIL_MAX_AGE = int(os.environ.get('THUMBNAIL_MAX_AGE', 31536000))
+THUMBNAIL_TOKEN_EXPIRATION = int(os.environ.get('THUMBNAIL_TOKEN_EXPIRATION', 86400))
+# fragmentos de audio y video: carpeta dentro de WEB_FILES_PATH, tamaño máximo en bytes y tolerancia para cortar sin recodificar
+FRAGMENTS_CACHE_DIR = os.environ.get('FRAGMENTS_CACHE_DIR', 'fragments_cache')
+FRAGMENTS_CACHE_SIZE = int(os.environ.get('FRAGMENTS_CACHE_SIZE', 5 * 1024 ** 3))
+FRAGMENTS_KEYFRAME_TOLERANCE = float(os.environ.get('FRAGMENTS_KEYFRAME_TOLERANCE', 1))
+FRAGMENTS_KEYFRAME_WINDOW = float(os.environ.get('FRAGMENTS_KEYFRAME_WINDOW', 10))
+FRAGMENTS_MAX_AGE = int(os.environ.get('FRAGMENTS_MAX_AGE', 86400))
+# segundos mínimos entre dos limpiezas de la cache de fragmentos, compartidos entre procesos
+FRAGMENTS_TRIM_INTERVAL = int(os.environ.get('FRAGMENTS_TRIM_INTERVAL', 300))
+FRAGMENTS_TRIM_LOCK = 'fragments_cache:trim'
+HLS_SUFFIX = '_hls'
+COUNTERS_COLLECTION = 'counters'
+COUNTER_REFRESH = int(os.environ.get('COUNTER_REFRESH', 3600))
+STATS_COLLECTION = 'stats'
+STATS_REFRESH_INTERVAL = float(os.environ.get('STATS_REFRESH_INTERVAL', 60))
+STATS_REFRESH_BATCH = int(os.environ.get('STATS_REFRESH_BATCH', 100))
+# segundos tras los que una estadística se recalcula aunque no se haya marcado, por si algún cambio no la marcó
+STATS_MAX_AGE = float(os.environ.get('STATS_MAX_AGE', 3600))
+ZIP_CHUNK_SIZE = 1024 * 1024
+# formatos que ya vienen comprimidos y se guardan en el zip sin volver a comprimir
+ZIP_STORED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.jp2', '.mp4', '.webm', '.mov', '.mkv', '.mp3', '.ogg',
+    '.m4a', '.aac', '.flac', '.zip', '.gz', '.7z', '.rar', '.pdf', '.docx', '.xlsx', '.pptx', '.odt'
+}
 try:
     TRANSCRIPTION_PAGE_CHAR_LIMIT = int(os.environ.get('TRANSCRIPTION_PAGE_CHAR_LIMIT', 6000))
     if TRANSCRIPTION_PAGE_CHAR_LIMIT <= 0:
@@ -22,10 +62,17 @@ try:
 except (TypeError, ValueError):
     TRANSCRIPTION_PAGE_CHAR_LIMIT = 6000
 
+TRANSCRIPTION_INDEX_COLLECTION = 'transcription_index'
+TRANSCRIPTION_PAGES_COLLECTION = 'transcription_pages'
+
 mongodb = DatabaseHandler.DatabaseHandler()
 cacheHandler = CacheHandler.CacheHandler()
 
 PAGE_DIRECTORIES = {'small': 'small', 'big': 'big'}
+THUMBNAIL_SUFFIXES = {
+    'small': '_small.jpg',
+    'medium': '_medium.jpg',
+}
 GALLERY_SUFFIXES = {
     'small': '_small.jpg',
     'medium': '_medium.jpg',
@@ -67,14 +114,15 @@ def clear_cache():
     cache_get_record_transcription.invalidate_all()
     cache_get_record_document_detail.invalidate_all()
     cache_get_block_by_page_id.invalidate_all()
-    cache_get_pages_by_id.invalidate_all()
-    cache_get_imgs_gallery_by_id.invalidate_all()
+    cache_get_pages_manifest.invalidate_all()
+    cache_get_gallery_manifest.invalidate_all()
     cache_type_roles.invalidate_all()
     cache_get_processing_metadata.invalidate_all()
     cache_get_processing_result.invalidate_all()
     has_right.invalidate_all()
     has_role.invalidate_all()
 
+@cacheHandler.local()
 @cacheHandler.cache.cache()
 def get_roles_id():
     try:
@@ -91,6 +139,7 @@ def get_roles_id():
         return None
 
 
+@cacheHandler.local()
 @cacheHandler.cache.cache()
 def get_roles():
     try:
@@ -123,6 +172,7 @@ def get_roles():
             _('Error while getting the access_rights record: {error}', error=str(e)))
 
 
+@cacheHandler.local()
 @cacheHandler.cache.cache()
 def get_access_rights_id():
     try:
@@ -140,6 +190,7 @@ def get_access_rights_id():
         return None
 
 
+@cacheHandler.local()
 @cacheHandler.cache.cache()
 def get_access_rights():
     try:
@@ -218,7 +269,57 @@ def parse_result(result):
     return json.loads(json_util.dumps(result))
 
 
-@cacheHandler.cache.cache(limit=500)
+# Resuelve una sola vez los roles y derechos de acceso de un usuario, para revisar conjuntos completos de records
+@cacheHandler.local()
+@cacheHandler.cache.cache()
+def get_user_access(username):
+    if not username:
+        return {'admin': False, 'rights': []}
+
+    user = mongodb.get_record('users', {'username': username}, fields={'roles': 1, 'accessRights': 1})
+    if not user:
+        return {'admin': False, 'rights': []}
+
+    return {
+        'admin': 'admin' in (user.get('roles') or []),
+        'rights': user.get('accessRights') or []
+    }
+
+
+# Retorna para cada record si el usuario lo puede ver según su campo accessRights
+def records_access(records, user):
+    access = get_user_access(user)
+    rights = set(access['rights'])
+    return [access['admin'] or not r.get('accessRights') or r['accessRights'] in rights for r in records]
+
+
+# Retorna en una sola consulta la ruta del archivo procesado de los records que el usuario puede ver
+def get_records_paths(ids, user):
+    ids = [id for id in dict.fromkeys(ids) if id]
+    if not ids:
+        return {}
+
+    records = list(mongodb.get_all_records('records', {'_id': {'$in': [ObjectId(id) for id in ids]}}, fields={
+        'accessRights': 1, 'processing.fileProcessing.path': 1}))
+
+    paths = {}
+    for record, allowed in zip(records, records_access(records, user)):
+        path = record.get('processing', {}).get('fileProcessing', {}).get('path')
+        if allowed and path:
+            paths[str(record['_id'])] = path
+
+    return paths
+
+
+# Etiquetas de cache de una lista de records serializada en json
+def records_tags(ids, *args, **kwargs):
+    try:
+        return ['record:' + str(item['id']) for item in json.loads(ids)]
+    except Exception:
+        return []
+
+
+@cacheHandler.tagged(records_tags, limit=500)
 def get_resource_records(ids, user, page=0, limit=10, groupImages=False):
     ids = json.loads(ids)
     
@@ -267,19 +368,18 @@ def get_resource_records(ids, user, page=0, limit=10, groupImages=False):
                   'name': 1, 'size': 1, 'accessRights': 1, 'displayName': 1, 'processing': 1, 'hash': 1, 'filepath': 1})
         
         r_ = list(cursor)
+        ids_map = {x['id']: x for x in ids}
         
-        for r in r_:
+        for r, allowed in zip(r_, records_access(r_, user)):
             r['_id'] = str(r['_id'])
-            r['tag'] = [x['tag'] for x in ids if x['id'] == r['_id']][0]
-            r['order'] = [x['order'] for x in ids if x['id'] == r['_id']][0]
+            r['tag'] = ids_map[r['_id']]['tag']
+            r['order'] = ids_map[r['_id']]['order']
 
-            if 'accessRights' in r:
-                if r['accessRights']:
-                    if not has_right(user, r['accessRights']) and not has_role(user, 'admin'):
-                        r['name'] = 'No tiene permisos para ver este archivo'
-                        r['displayName'] = 'No tiene permisos para ver este archivo'
-                        r['_id'] = None
-                        r.pop('filepath', None)
+            if not allowed:
+                r['name'] = 'No tiene permisos para ver este archivo'
+                r['displayName'] = 'No tiene permisos para ver este archivo'
+                r['_id'] = None
+                r.pop('filepath', None)
 
             pro_dict = {}
             if 'processing' in r:
@@ -317,7 +417,7 @@ def get_resource_records(ids, user, page=0, limit=10, groupImages=False):
     except Exception as e:
         raise Exception(str(e))
 
-@cacheHandler.cache.cache(limit=500)
+@cacheHandler.tagged(records_tags, limit=500)
 def get_resource_records_public(ids, page=0, limit=10, groupImages=False):
     ids = json.loads(ids)
     ids_filter = []
@@ -338,10 +438,11 @@ def get_resource_records_public(ids, page=0, limit=10, groupImages=False):
             cursor = cursor.skip(page * limit).limit(limit)
         
         r_ = list(cursor)
+        ids_map = {x['id']: x for x in ids}
         
         for r in r_:
             r['_id'] = str(r['_id'])
-            r['tag'] = [x['tag'] for x in ids if x['id'] == r['_id']][0]
+            r['tag'] = ids_map[r['_id']]['tag']
 
             if 'accessRights' in r:
                 if r['accessRights']:
@@ -383,7 +484,7 @@ def get_resource_records_public(ids, page=0, limit=10, groupImages=False):
     except Exception as e:
         raise Exception(str(e))
 
-def _load_chunked_result(record_id, storage):
+def _load_chunked_result(record_id, storage, chunks=None):
     if storage.get('type') != 'chunked':
         return []
     collection = storage.get('collection')
@@ -394,6 +495,8 @@ def _load_chunked_result(record_id, storage):
     chunk_filters = {'recordId': ObjectId(record_id)}
     if batch_id:
         chunk_filters['batchId'] = batch_id
+    if chunks is not None:
+        chunk_filters['chunkIndex'] = {'$in': list(chunks)}
 
     chunk_docs = list(mongodb.get_all_records(
         collection,
@@ -409,7 +512,84 @@ def _load_chunked_result(record_id, storage):
     return pages
 
 
-@cacheHandler.cache.cache(limit=1000)
+
+@lru_cache(maxsize=None)
+def _ensure_chunk_index(collection):
+    mongodb.create_index(collection, [('recordId', 1), ('batchId', 1), ('pageStart', 1)])
+    return True
+
+
+def _chunk_filters(record_id, storage):
+    chunk_filters = {'recordId': ObjectId(record_id)}
+    if storage.get('batchId'):
+        chunk_filters['batchId'] = storage['batchId']
+    return chunk_filters
+
+
+# Guarda en cada chunk el rango de páginas que contiene (pageStart, pageEnd). Para los chunks que no lo tienen, el número
+# de páginas se cuenta en Mongo sin traer su contenido
+def _index_chunk_pages(record_id, storage):
+    collection = storage['collection']
+    chunk_filters = _chunk_filters(record_id, storage)
+    if not mongodb.get_record(collection, {**chunk_filters, 'pageStart': {'$exists': False}}, fields={'_id': 1}):
+        return
+
+    sizes = mongodb.aggregate(collection, [
+        {'$match': chunk_filters},
+        {'$sort': {'chunkIndex': 1}},
+        {'$project': {'count': {'$size': {'$ifNull': ['$pages', []]}}}},
+    ])
+
+    operations = []
+    start = 0
+    for chunk in sizes:
+        operations.append(UpdateOne({'_id': chunk['_id']}, {'$set': {'pageStart': start, 'pageEnd': start + chunk['count']}}))
+        start += chunk['count']
+    if operations:
+        mongodb.bulk_write(collection, operations)
+
+
+# Lee una sola página (índice desde 0) de un resultado guardado por chunks, consultando solo el chunk que la contiene.
+# Con block='blocks' se quitan las palabras de los bloques y con block='words' se retorna la lista de palabras de la página;
+# ambas proyecciones se hacen en Mongo
+def _load_chunked_page(record_id, storage, page, block=None):
+    collection = storage.get('collection')
+    if storage.get('type') != 'chunked' or not collection:
+        return None
+
+    _ensure_chunk_index(collection)
+    _index_chunk_pages(record_id, storage)
+
+    pipeline = [
+        {'$match': {**_chunk_filters(record_id, storage), 'pageStart': {'$lte': page}, 'pageEnd': {'$gt': page}}},
+        {'$sort': {'pageStart': -1}},
+        {'$limit': 1},
+        {'$project': {'_id': 0, 'page': {'$arrayElemAt': ['$pages', {'$subtract': [page, '$pageStart']}]}}},
+    ]
+    if block == 'blocks':
+        pipeline.append({'$project': {'page': {'$mergeObjects': ['$page', {'blocks': {'$map': {
+            'input': {'$ifNull': ['$page.blocks', []]},
+            'as': 'block',
+            'in': {'$arrayToObject': {'$filter': {
+                'input': {'$objectToArray': '$$block'},
+                'as': 'field',
+                'cond': {'$ne': ['$$field.k', 'words']}
+            }}}
+        }}}]}}})
+    elif block == 'words':
+        pipeline.append({'$project': {'page': {'$reduce': {
+            'input': {'$ifNull': ['$page.blocks', []]},
+            'initialValue': [],
+            'in': {'$concatArrays': ['$$value', {'$ifNull': ['$$this.words', []]}]}
+        }}}})
+
+    docs = list(mongodb.aggregate(collection, pipeline))
+    if not docs:
+        return None
+    return docs[0].get('page')
+
+
+@cacheHandler.tagged('record', limit=1000)
 def cache_get_record_stream(id):
     # Buscar el record en la base de datos
     record = mongodb.get_record('records', {'_id': ObjectId(id)}, fields={
@@ -433,8 +613,8 @@ def cache_get_record_stream(id):
     
     return path, type
 
-@cacheHandler.cache.cache(limit=1000)
-def cache_get_processing_result(id, slug):
+@cacheHandler.tagged('record', limit=1000)
+def cache_get_processing_result(id, slug, page=None):
     # Buscar el record en la base de datos
     record = mongodb.get_record(
         'records', {'_id': ObjectId(id)}, fields={'processing': 1})
@@ -451,10 +631,22 @@ def cache_get_processing_result(id, slug):
     processing_data = record['processing'][slug]
     storage = processing_data.get('result_storage', {})
     
+    # con page (desde 0) solo se retorna esa página del resultado
+    if page is not None and int(page) < 0:
+        raise Exception(_('Record does not have that many pages'))
     if storage.get('type') == 'chunked':
-        result = _load_chunked_result(id, storage)
+        if page is not None:
+            result = _load_chunked_page(id, storage, int(page))
+            if result is None:
+                raise Exception(_('Record does not have that many pages'))
+        else:
+            result = _load_chunked_result(id, storage)
     else:
         result = processing_data.get('result', [])
+        if page is not None:
+            if not isinstance(result, list) or int(page) >= len(result):
+                raise Exception(_('Record does not have that many pages'))
+            result = result[int(page)]
 
     if isinstance(result, dict):
         # iterate each key in result and if the value is a datetime, convert it to string
@@ -468,7 +660,7 @@ def cache_get_processing_result(id, slug):
 
     return result
 
-@cacheHandler.cache.cache(limit=1000)
+@cacheHandler.tagged('record', limit=1000)
 def cache_get_processing_metadata(id, slug):
     # Buscar el record en la base de datos
     record = mongodb.get_record(
@@ -512,10 +704,20 @@ def _build_segment_page_boundaries(segments, char_limit):
     return boundaries
 
 
-@cacheHandler.cache.cache(limit=1000)
-def _get_transcription_result_cached(id, slug):
-    record = mongodb.get_record(
-        'records', {'_id': ObjectId(id)}, fields={'processing': 1})
+# Calcula la versión de una transcripción a partir de la fecha de actualización del record. Mongo guarda las fechas con precisión de milisegundos
+def _transcription_version(updated_at):
+    if isinstance(updated_at, datetime.datetime):
+        updated_at = updated_at.replace(microsecond=updated_at.microsecond // 1000 * 1000)
+        return updated_at.isoformat()
+    if updated_at:
+        return str(updated_at)
+    return ''
+
+
+def _get_transcription_entry(id, slug, fields=None):
+    if fields is None:
+        fields = {'processing.' + slug: 1, 'updatedAt': 1}
+    record = mongodb.get_record('records', {'_id': ObjectId(id)}, fields=fields)
 
     if not record:
         raise Exception(_('Record does not exist'))
@@ -526,67 +728,21 @@ def _get_transcription_result_cached(id, slug):
 
     processing_entry = processing[slug]
 
-    if processing_entry.get('type') == 'labeling':
-        return processing_entry.get('result', {})
-    
-    if processing_entry.get('type') != 'av_transcribe':
+    if processing_entry.get('type') not in ('labeling', 'av_transcribe'):
         raise Exception(_('Record has not been processed with {slug}', slug=slug))
 
-    return processing_entry.get('result', {})
-
-
-def cache_get_record_transcription(id, slug, segments=True, page=0):
-    if isinstance(segments, int) and (page == 0 or page is None):
-        page = segments
-        segments = True
-
-    if isinstance(segments, str):
-        segments_flag = segments.lower() not in ('false', '0', 'no', 'off')
-    else:
-        segments_flag = bool(segments)
-
-    try:
-        page_index = int(page)
-    except (TypeError, ValueError):
-        page_index = 0
-
-    if page_index < 0:
-        page_index = 0
-
-    result = _get_transcription_result_cached(id, slug)
-
-    segments_source = result.get('segments') or []
-    vision_segments_source = result.get('vision_segment')
-    if vision_segments_source is None:
-        vision_segments_source = result.get('vision_segments')
-    if vision_segments_source is None:
-        vision_segments_source = result.get('frames')
-    if not isinstance(vision_segments_source, list):
-        vision_segments_source = []
-    full_text = result.get('text', '')
-
-    total_chars = sum(len(segment.get('text') or '') for segment in segments_source)
-    boundaries = _build_segment_page_boundaries(segments_source, TRANSCRIPTION_PAGE_CHAR_LIMIT)
-    total_pages = len(boundaries)
-
-    if total_pages == 0:
-        boundaries = [(0, 0)]
-        total_pages = 1
+    return processing_entry, _transcription_version(record.get('updatedAt'))
 
-    if page_index >= total_pages:
-        page_index = total_pages - 1
-
-    start_idx, end_idx = boundaries[page_index]
-    visible_segments = segments_source[start_idx:end_idx]
-    page_chars = sum(len(segment.get('text') or '') for segment in visible_segments)
 
+# Procesa los segmentos de una página de la transcripción: etiquetas, lugares, grupos y hablantes
+def _build_transcription_page(visible_segments):
     labels_counter = {}
     locations_counter = {}
-    vision_counter = {}
     groups = []
     groups_seen = set()
+    groups_from = None
     processed_segments = []
-    has_speakers = False
+    speakers = {}
 
     for segment in visible_segments:
         speaker = segment.get('speaker')
@@ -628,52 +784,63 @@ def cache_get_record_transcription(id, slug, segments=True, page=0):
                 else:
                     locations_counter[key] = {**loc, 'count': 1, 'group': normalized_group}
 
-        if groups:
-            obj['groups'] = groups
+        if groups and groups_from is None:
+            groups_from = len(processed_segments)
 
         if speaker:
-            has_speakers = True
-
-        processed_segments.append(obj)
-
-    speakers = None
-    if has_speakers and processed_segments:
-        speakers = []
-        for segment in processed_segments:
-            speaker_name = segment.get('speaker')
-            if not speaker_name:
-                continue
-
-            existing = next((item for item in speakers if item['name'] == speaker_name), None)
+            start_value = segment.get('start')
+            end_value = segment.get('end')
+            existing = speakers.get(speaker)
             if not existing:
-                existing = {
-                    'name': speaker_name,
-                    'segments': [{'start': segment.get('start'), 'end': segment.get('end')}]
+                speakers[speaker] = {
+                    'name': speaker,
+                    'segments': [{'start': start_value, 'end': end_value}]
                 }
-                speakers.append(existing)
             else:
                 last_segment = existing['segments'][-1]
-                start_value = segment.get('start')
-                end_value = segment.get('end')
                 if start_value is not None and last_segment['end'] is not None and start_value - last_segment['end'] < 5:
                     last_segment['end'] = end_value
                 else:
                     existing['segments'].append({'start': start_value, 'end': end_value})
 
-        for speaker_entry in speakers:
-            total = 0
-            for seg in speaker_entry['segments']:
-                start_value = seg.get('start')
-                end_value = seg.get('end')
-                if start_value is None or end_value is None:
-                    continue
-                total += end_value - start_value
-            speaker_entry['total'] = total
+        processed_segments.append(obj)
+
+    for speaker_entry in speakers.values():
+        total = 0
+        for seg in speaker_entry['segments']:
+            start_value = seg.get('start')
+            end_value = seg.get('end')
+            if start_value is None or end_value is None:
+                continue
+            total += end_value - start_value
+        speaker_entry['total'] = total
+
+    return {
+        'segments': processed_segments,
+        'speakers': list(speakers.values()) if speakers else None,
+        'labels': sorted(labels_counter.values(), key=lambda x: x['count'], reverse=True),
+        'locations': sorted(locations_counter.values(), key=lambda x: x['count'], reverse=True),
+        'groups': groups,
+        'groups_from': groups_from,
+        'page_characters': sum(len(segment.get('text') or '') for segment in visible_segments)
+    }
 
-    labels_array = sorted(labels_counter.values(), key=lambda x: x['count'], reverse=True)
-    locations_array = sorted(locations_counter.values(), key=lambda x: x['count'], reverse=True)
 
+# Normaliza los segmentos de visión de la transcripción y calcula sus agregados, que son los mismos para todas las páginas
+def _build_transcription_vision(result):
+    vision_segments_source = result.get('vision_segment')
+    if vision_segments_source is None:
+        vision_segments_source = result.get('vision_segments')
+    if vision_segments_source is None:
+        vision_segments_source = result.get('frames')
+    if not isinstance(vision_segments_source, list):
+        vision_segments_source = []
+
+    vision_counter = {}
+    groups = []
+    groups_seen = set()
     normalized_vision_segments = []
+
     for vision_segment in vision_segments_source:
         labels = vision_segment.get('label')
         if labels is None:
@@ -716,50 +883,239 @@ def cache_get_record_transcription(id, slug, segments=True, page=0):
             else:
                 vision_counter[key] = {**normalized_label, 'count': 1}
 
-            vision_group_key = (normalized_label_group, 'vision_segment')
-            if normalized_label_group and vision_group_key not in groups_seen:
+            if normalized_label_group and normalized_label_group not in groups_seen:
                 groups.append({'name': normalized_label_group, 'type': 'vision_segment'})
-                groups_seen.add(vision_group_key)
+                groups_seen.add(normalized_label_group)
 
         normalized_vision_segments.append(vision_obj)
 
     frames_array = sorted(vision_counter.values(), key=lambda x: x['count'], reverse=True)
 
+    return normalized_vision_segments, frames_array, groups
+
+
+def _transcription_batch_id(slug, version):
+    return slug + ':' + version
+
+
+def _save_transcription_pages(id, slug, batch_id, pages):
+    if not pages:
+        return
+    mongodb.bulk_write(TRANSCRIPTION_PAGES_COLLECTION, [
+        UpdateOne(
+            {'recordId': ObjectId(id), 'slug': slug, 'chunkIndex': chunk_index},
+            {'$set': {'batchId': batch_id, 'pages': [page]}},
+            upsert=True
+        )
+        for chunk_index, page in pages.items()
+    ])
+
+
+# Crea los índices de las colecciones del índice y de las páginas de las transcripciones
+def create_transcription_indexes():
+    mongodb.create_index(TRANSCRIPTION_INDEX_COLLECTION, [('recordId', 1), ('slug', 1)], unique=True)
+    mongodb.create_index(TRANSCRIPTION_PAGES_COLLECTION, [('recordId', 1), ('slug', 1), ('chunkIndex', 1)], unique=True)
+    mongodb.create_index(TRANSCRIPTION_PAGES_COLLECTION, [('recordId', 1), ('batchId', 1), ('chunkIndex', 1)])
+
+
+# Construye el índice de la transcripción (límites de página, totales y agregados de visión) y guarda cada página ya procesada
+# como un chunk, para que la lectura de una página solo tenga que cargar ese chunk
+def build_transcription_index(id, slug, result=None, updated_at=None):
+    if result is None:
+        processing_entry, version = _get_transcription_entry(id, slug)
+        result = processing_entry.get('result', {})
+    else:
+        version = _transcription_version(updated_at)
+    if not isinstance(result, dict):
+        result = {}
+
+    segments_source = result.get('segments') or []
+    boundaries = _build_segment_page_boundaries(segments_source, TRANSCRIPTION_PAGE_CHAR_LIMIT)
+    batch_id = _transcription_batch_id(slug, version)
+
+    pages = {}
+    for page_index, (start_idx, end_idx) in enumerate(boundaries):
+        pages[page_index] = _build_transcription_page(segments_source[start_idx:end_idx])
+
+    vision_segment, frames, vision_groups = _build_transcription_vision(result)
+
+    index = {
+        'version': version,
+        'page_char_limit': TRANSCRIPTION_PAGE_CHAR_LIMIT,
+        'boundaries': [list(boundary) for boundary in boundaries],
+        'total_characters': sum(len(segment.get('text') or '') for segment in segments_source),
+        'total_segments': len(segments_source),
+        'text': result.get('text', ''),
+        'vision_segment': vision_segment,
+        'frames': frames,
+        'vision_groups': vision_groups,
+        'storage': {
+            'type': 'chunked',
+            'collection': TRANSCRIPTION_PAGES_COLLECTION,
+            'batchId': batch_id
+        }
+    }
+
+    _save_transcription_pages(id, slug, batch_id, pages)
+    mongodb.delete_records(TRANSCRIPTION_PAGES_COLLECTION, {
+        'recordId': ObjectId(id), 'slug': slug, 'chunkIndex': {'$gte': len(boundaries)}})
+    mongodb.update_record_operator(TRANSCRIPTION_INDEX_COLLECTION, {'recordId': ObjectId(id), 'slug': slug}, {
+        '$set': index}, upsert=True)
+
+    return index
+
+
+# Actualiza el índice de la transcripción después de editar sus segmentos. Solo se vuelven a procesar las páginas que contienen
+# segmentos modificados o cuyos límites cambiaron; las demás se mantienen y solo cambian de versión
+def update_transcription_index(id, slug, result, changed, updated_at):
+    version = _transcription_version(updated_at)
+    index = mongodb.get_record(TRANSCRIPTION_INDEX_COLLECTION, {'recordId': ObjectId(id), 'slug': slug}, fields={'_id': 0, 'recordId': 0})
+
+    if not index or index.get('page_char_limit') != TRANSCRIPTION_PAGE_CHAR_LIMIT:
+        return build_transcription_index(id, slug, result, updated_at)
+
+    segments_source = result.get('segments') or []
+    boundaries = [list(boundary) for boundary in _build_segment_page_boundaries(segments_source, TRANSCRIPTION_PAGE_CHAR_LIMIT)]
+    old_boundaries = index.get('boundaries', [])
+    changed = set(changed)
+    batch_id = _transcription_batch_id(slug, version)
+
+    pages = {}
+    for page_index, (start_idx, end_idx) in enumerate(boundaries):
+        moved = page_index >= len(old_boundaries) or old_boundaries[page_index] != [start_idx, end_idx]
+        if moved or any(start_idx <= i < end_idx for i in changed):
+            pages[page_index] = _build_transcription_page(segments_source[start_idx:end_idx])
+
+    _save_transcription_pages(id, slug, batch_id, pages)
+    mongodb.update_records(TRANSCRIPTION_PAGES_COLLECTION, {
+        'recordId': ObjectId(id), 'slug': slug, 'chunkIndex': {'$nin': list(pages.keys())}}, {'batchId': batch_id})
+    mongodb.delete_records(TRANSCRIPTION_PAGES_COLLECTION, {
+        'recordId': ObjectId(id), 'slug': slug, 'chunkIndex': {'$gte': len(boundaries)}})
+
+    index['version'] = version
+    index['boundaries'] = boundaries
+    index['total_characters'] = sum(len(segment.get('text') or '') for segment in segments_source)
+    index['total_segments'] = len(segments_source)
+    index['text'] = result.get('text', '')
+    index['storage']['batchId'] = batch_id
+
+    mongodb.update_record_operator(TRANSCRIPTION_INDEX_COLLECTION, {'recordId': ObjectId(id), 'slug': slug}, {
+        '$set': index})
+
+    return index
+
+
+@cacheHandler.cache.cache(limit=1000)
+def _get_transcription_index_cached(id, slug, version):
+    index = mongodb.get_record(TRANSCRIPTION_INDEX_COLLECTION, {'recordId': ObjectId(id), 'slug': slug}, fields={'_id': 0, 'recordId': 0})
+
+    if not index or index.get('version') != version or index.get('page_char_limit') != TRANSCRIPTION_PAGE_CHAR_LIMIT:
+        index = build_transcription_index(id, slug)
+
+    return index
+
+
+@cacheHandler.cache.cache(limit=1000)
+def _get_transcription_page_cached(id, batch_id, page):
+    storage = {
+        'type': 'chunked',
+        'collection': TRANSCRIPTION_PAGES_COLLECTION,
+        'batchId': batch_id
+    }
+    pages = _load_chunked_result(id, storage, chunks=[page])
+    return pages[0] if pages else None
+
+
+def get_transcription_index(id, slug):
+    record = mongodb.get_record('records', {'_id': ObjectId(id)}, fields={'processing.' + slug + '.type': 1, 'updatedAt': 1})
+    if not record:
+        raise Exception(_('Record does not exist'))
+
+    processing = record.get('processing')
+    if not processing or slug not in processing:
+        raise Exception(_('Record has not been processed'))
+    if processing[slug].get('type') not in ('labeling', 'av_transcribe'):
+        raise Exception(_('Record has not been processed with {slug}', slug=slug))
+
+    return _get_transcription_index_cached(id, slug, _transcription_version(record.get('updatedAt')))
+
+
+def cache_get_record_transcription(id, slug, segments=True, page=0):
+    if isinstance(segments, int) and (page == 0 or page is None):
+        page = segments
+        segments = True
+
+    if isinstance(segments, str):
+        segments_flag = segments.lower() not in ('false', '0', 'no', 'off')
+    else:
+        segments_flag = bool(segments)
+
+    try:
+        page_index = int(page)
+    except (TypeError, ValueError):
+        page_index = 0
+
+    if page_index < 0:
+        page_index = 0
+
+    index = get_transcription_index(id, slug)
+
+    boundaries = index.get('boundaries') or [[0, 0]]
+    total_pages = len(boundaries)
+
+    if page_index >= total_pages:
+        page_index = total_pages - 1
+
+    start_idx, end_idx = boundaries[page_index]
+    batch_id = index['storage']['batchId']
+
+    page_data = _get_transcription_page_cached(id, batch_id, page_index)
+    if page_data is None:
+        _get_transcription_index_cached.invalidate(id, slug, index['version'])
+        index = build_transcription_index(id, slug)
+        page_data = _get_transcription_page_cached(id, index['storage']['batchId'], page_index)
+
+    groups = page_data['groups'] + index.get('vision_groups', [])
+    processed_segments = page_data['segments']
+    if page_data['groups_from'] is not None:
+        for obj in processed_segments[page_data['groups_from']:]:
+            obj['groups'] = groups
+
     pagination = {
         'page': page_index,
         'total_pages': total_pages,
         'page_char_limit': TRANSCRIPTION_PAGE_CHAR_LIMIT,
-        'total_characters': total_chars,
-        'page_characters': page_chars,
-        'total_segments': len(segments_source),
-        'page_segments': len(visible_segments),
+        'total_characters': index['total_characters'],
+        'page_characters': page_data['page_characters'],
+        'total_segments': index['total_segments'],
+        'page_segments': end_idx - start_idx,
         'from_segment': start_idx,
         'to_segment': end_idx - 1 if end_idx > start_idx else -1,
         'has_more': page_index < (total_pages - 1)
     }
 
     transcription = {
-        'text': full_text
+        'text': index.get('text', '')
     }
 
     if segments_flag:
         transcription['segments'] = processed_segments
-        transcription['speakers'] = speakers
+        transcription['speakers'] = page_data['speakers']
         transcription['pagination'] = pagination
     elif total_pages > 1:
         transcription['pagination'] = pagination
 
-    if normalized_vision_segments:
-        transcription['vision_segment'] = normalized_vision_segments
+    if index.get('vision_segment'):
+        transcription['vision_segment'] = index['vision_segment']
 
-    if labels_array:
-        transcription['labels'] = labels_array
+    if page_data['labels']:
+        transcription['labels'] = page_data['labels']
 
-    if locations_array:
-        transcription['locations'] = locations_array
+    if page_data['locations']:
+        transcription['locations'] = page_data['locations']
 
-    if frames_array:
-        transcription['frames'] = frames_array
+    if index.get('frames'):
+        transcription['frames'] = index['frames']
 
     if groups:
         transcription['groups'] = groups
@@ -767,18 +1123,23 @@ def cache_get_record_transcription(id, slug, segments=True, page=0):
     return transcription
 
 
-def _invalidate_cached_transcription(*args, **kwargs):
-    if args:
-        key_args = list(args)[:2]
-        return _get_transcription_result_cached.invalidate(*key_args, **kwargs)
-    return _get_transcription_result_cached.invalidate(**kwargs)
+def _invalidate_cached_transcription(id, slug, *args, **kwargs):
+    mongodb.delete_record(TRANSCRIPTION_INDEX_COLLECTION, {'recordId': ObjectId(id), 'slug': slug})
+    record = mongodb.get_record('records', {'_id': ObjectId(id)}, fields={'updatedAt': 1})
+    if record:
+        _get_transcription_index_cached.invalidate(id, slug, _transcription_version(record.get('updatedAt')))
+
+
+def _invalidate_all_cached_transcriptions():
+    _get_transcription_index_cached.invalidate_all()
+    _get_transcription_page_cached.invalidate_all()
 
 
 cache_get_record_transcription.invalidate = _invalidate_cached_transcription
-cache_get_record_transcription.invalidate_all = _get_transcription_result_cached.invalidate_all
+cache_get_record_transcription.invalidate_all = _invalidate_all_cached_transcriptions
 
 
-@cacheHandler.cache.cache(limit=1000)
+@cacheHandler.tagged('record', limit=1000)
 def cache_get_record_document_detail(id):
     # Buscar el record en la base de datos
     record = mongodb.get_record(
@@ -830,7 +1191,7 @@ def cache_get_record_document_detail(id):
             'aspect_ratio': aspect_ratio
         }
     
-@cacheHandler.cache.cache(limit=1000)
+@cacheHandler.tagged('record', limit=1000)
 def cache_get_block_by_page_id(id, page, slug, block=None, user=None):
     record = mongodb.get_record(
         'records', {'_id': ObjectId(id)}, fields={'processing': 1})
@@ -874,15 +1235,25 @@ def cache_get_block_by_page_id(id, page, slug, block=None, user=None):
 
         processing_data = record['processing'][slug]
         storage = processing_data.get('result_storage', {})
-        if storage.get('type') == 'chunked':
-            full_result = _load_chunked_result(id, storage)
-            resp = full_result[page - 1] if page - 1 < len(full_result) else {}
-        else:
-            full_result = processing_data.get('result', [])
-            resp = full_result[page - 1] if page - 1 < len(full_result) else {}
-
         labels = record['processing'][slug]['labels'] if 'labels' in record['processing'][slug] else []
 
+        # con resultados por chunks solo se lee la página pedida, ya proyectada
+        if storage.get('type') == 'chunked' and block in ('blocks', 'words'):
+            resp = _load_chunked_page(str(record['_id']), storage, page - 1, block)
+            if block == 'blocks':
+                resp = resp if resp is not None else {}
+                resp['labels'] = labels
+            else:
+                resp = {
+                    'page': page,
+                    'words': resp or [],
+                    'labels': labels
+                }
+            return resp, 200
+
+        full_result = processing_data.get('result', [])
+        resp = full_result[page - 1] if page - 1 < len(full_result) else {}
+
         if block == 'blocks':
             resp['labels'] = labels
             for b in resp['blocks']:
@@ -914,52 +1285,75 @@ def cache_get_block_by_page_id(id, page, slug, block=None, user=None):
     else:
         return {'msg': _('Record is not a document')}, 400    
 
-@cacheHandler.cache.cache(limit=5000)
-def cache_get_imgs_gallery_by_id(id, pages, size):
-    pages = json.loads(pages)
+def _image_entry(path_img, **extra):
+    with Image.open(path_img) as img_:
+        width, height = img_.size
+    return {
+        **extra,
+        'filename': os.path.basename(path_img),
+        'path': os.path.relpath(path_img, WEB_FILES_PATH),
+        'width': width,
+        'height': height,
+        'aspect_ratio': width / height,
+    }
+
+
+def public_manifest(manifest):
+    """The manifest entries without the internal file paths."""
+    return [{k: v for k, v in entry.items() if k != 'path'} for entry in manifest]
+
+
+@cacheHandler.tagged('resource', limit=5000)
+def cache_get_gallery_manifest(id, size):
+    """The ordered images of a resource gallery: filenames and dimensions, no image data."""
+    suffix = GALLERY_SUFFIXES.get(size)
+    if suffix is None:
+        raise Exception(_('File not found'))
 
-    if len(pages) == 0:
-        return []
-    
     resource = mongodb.get_record('resources', {'_id': ObjectId(id)}, fields={'filesObj': 1})
-    ids = []
-    if 'filesObj' in resource:
-        for r in resource['filesObj']:
-            ids.append(r['id'])
+    if not resource or 'filesObj' not in resource:
+        return []
 
+    ids = [r['id'] for r in resource['filesObj']]
     img = list(mongodb.get_all_records('records', {'_id': {'$in': [ObjectId(id) for id in ids]}, 'processing.fileProcessing.type': 'image'}, fields={'processing': 1}))
-    
-    order_dict = {file['id']: file['order'] if 'order' in file else 0 for file in resource['filesObj']}
-
-    img_sorted = sorted(img, key=lambda x: order_dict.get(x['_id'], float('inf')))
+    cacheHandler.tag(*['record:' + str(r) for r in ids])
 
-    img = img_sorted
-    
-    img = img[pages[0]:pages[0] + len(pages)]
-    
-    response = []
-    
-    for i in range(len(img)):
-        path = img[i]['processing']['fileProcessing']['path']
-        suffix = GALLERY_SUFFIXES.get(size)
-        if suffix is None:
-            raise Exception(_('File not found'))
-        path_img = os.path.join(WEB_FILES_PATH, path) + suffix
+    order_dict = {file['id']: file['order'] if 'order' in file else 0 for file in resource['filesObj']}
+    img = sorted(img, key=lambda x: order_dict.get(x['_id'], float('inf')))
 
+    manifest = []
+    for i in img:
+        path_img = os.path.join(WEB_FILES_PATH, i['processing']['fileProcessing']['path']) + suffix
         if not os.path.exists(path_img):
             raise Exception(_('File not found'))
-        
-        img_ = Image.open(path_img)
-        width, height = img_.size
-        aspect_ratio = width / height
+        manifest.append(_image_entry(path_img, id=str(i['_id'])))
 
-        with open(path_img, 'rb') as f:
-            data = f.read()
-            encoded_data = base64.b64encode(data).decode('utf-8')
-            response.append({'filename': os.path.basename(path_img), 'data': encoded_data, 'aspect_ratio': aspect_ratio})
+    return manifest
+
+
+def get_gallery_image_file(id, index, size):
+    manifest = cache_get_gallery_manifest(id, size)
+    index = _page_index(index, len(manifest))
+    return os.path.join(WEB_FILES_PATH, manifest[index]['path'])
+
+
+def cache_get_imgs_gallery_by_id(id, pages, size):
+    pages = json.loads(pages)
+
+    if len(pages) == 0:
+        return []
+
+    manifest = cache_get_gallery_manifest(id, size)
+    manifest = manifest[pages[0]:pages[0] + len(pages)]
+
+    response = []
+    for entry in manifest:
+        with open(os.path.join(WEB_FILES_PATH, entry['path']), 'rb') as f:
+            encoded_data = base64.b64encode(f.read()).decode('utf-8')
+        response.append({'filename': entry['filename'], 'data': encoded_data, 'aspect_ratio': entry['aspect_ratio']})
 
     return response
-        
+
 
 def get_dzi_data(resource_id, pages, dzi_payload):
     """
@@ -1036,12 +1430,13 @@ def get_dzi_data(resource_id, pages, dzi_payload):
     else:
         raise Exception(_('Invalid dzi_payload type, expected xml or tile'))
 
-@cacheHandler.cache.cache(limit=5000)
-def cache_get_pages_by_id(id, pages, size):
-    pages = json.loads(pages)
-    
-    if len(pages) == 0:
-        return []
+@cacheHandler.tagged('record', limit=5000)
+def cache_get_pages_manifest(id, size):
+    """The pages of a record in the given size: filenames and dimensions, no image data.
+
+    Only this lightweight manifest is memoized; the image bytes are read from
+    WEB_FILES_PATH on demand.
+    """
     # Buscar el record en la base de datos
     record = mongodb.get_record(
         'records', {'_id': ObjectId(id)}, fields={'processing': 1})
@@ -1054,57 +1449,426 @@ def cache_get_pages_by_id(id, pages, size):
         raise Exception(_('Record has not been processed'))
     if 'fileProcessing' not in record['processing']:
         raise Exception(_('Record has not been processed'))
-    
-    
+
     if record['processing']['fileProcessing']['type'] == 'document':
         path = record['processing']['fileProcessing']['path']
         directory = PAGE_DIRECTORIES.get(size)
         if directory is None:
             raise Exception(_('Record does not have files'))
         path_files = os.path.join(WEB_FILES_PATH, path, 'web', directory)
-        path = os.path.join(WEB_FILES_PATH, path)
 
         files = sorted(os.listdir(path_files))
+        return {'type': 'document', 'pages': [_image_entry(os.path.join(path_files, file)) for file in files]}
 
-        response = []
-        for x in pages:
-            x = _page_index(x, len(files))
-
-            # verificar si el archivo existe
-            file = files[x]
-            file = os.path.join(path_files, file)
-            if not os.path.exists(file):
-                raise Exception(_('File not found'))
-            
-            with open(file, 'rb') as f:
-                data = f.read()
-                encoded_data = base64.b64encode(data).decode('utf-8')
-                response.append({'filename': os.path.basename(file), 'data': encoded_data})
-            
-        return response
-    
     elif record['processing']['fileProcessing']['type'] == 'image':
         path = record['processing']['fileProcessing']['path']
-        path_img = os.path.join(WEB_FILES_PATH, path)
-        if size == 'big': size = 'large'
-        path_img = path_img + '_' + size + '.jpg'
+        suffix = GALLERY_SUFFIXES.get(size)
+        if suffix is None:
+            raise Exception(_('File not found'))
+        path_img = os.path.join(WEB_FILES_PATH, path) + suffix
 
         if not os.path.exists(path_img):
             raise Exception(_('File not found'))
-        
-        response = {}
-        img = Image.open(path_img)
-        width, height = img.size
-        aspect_ratio = width / height
 
-        with open(path_img, 'rb') as f:
-            data = f.read()
-            encoded_data = base64.b64encode(data).decode('utf-8')
-            response = [{'filename': os.path.basename(path_img), 'data': encoded_data, 'aspect_ratio': aspect_ratio}]
+        return {'type': 'image', 'pages': [_image_entry(path_img)]}
 
-        return response
-        
-@cacheHandler.cache.cache()
+    raise Exception(_('Record is not a document'))
+
+
+def get_page_file(id, page, size):
+    manifest = cache_get_pages_manifest(id, size)['pages']
+    page = _page_index(page, len(manifest))
+    return os.path.join(WEB_FILES_PATH, manifest[page]['path'])
+
+
+def cache_get_pages_by_id(id, pages, size):
+    pages = json.loads(pages)
+    
+    if len(pages) == 0:
+        return []
+
+    manifest = cache_get_pages_manifest(id, size)
+    is_image = manifest['type'] == 'image'
+    manifest = manifest['pages']
+
+    response = []
+    for x in ([0] if is_image else pages):
+        entry = manifest[_page_index(x, len(manifest))]
+        file = os.path.join(WEB_FILES_PATH, entry['path'])
+        if not os.path.exists(file):
+            raise Exception(_('File not found'))
+
+        with open(file, 'rb') as f:
+            encoded_data = base64.b64encode(f.read()).decode('utf-8')
+        if is_image:
+            response.append({'filename': entry['filename'], 'data': encoded_data, 'aspect_ratio': entry['aspect_ratio']})
+        else:
+            response.append({'filename': entry['filename'], 'data': encoded_data})
+
+    return response
+
+
+def send_web_file(path, private=True, max_age=None):
+    """Streams a file under WEB_FILES_PATH with conditional and Range support.
+
+    When WEB_FILES_ACCEL_PREFIX is set the transfer is delegated to nginx through
+    X-Accel-Redirect, otherwise Flask serves it (X-Sendfile if USE_X_SENDFILE is on).
+    """
+    if max_age is None:
+        max_age = WEB_FILES_MAX_AGE
+
+    if WEB_FILES_ACCEL_PREFIX:
+        relative = os.path.relpath(path, WEB_FILES_PATH).replace(os.sep, '/')
+        response = Response(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = WEB_FILES_ACCEL_PREFIX.rstrip('/') + '/' + relative
+    else:
+        response = send_file(path, conditional=True, etag=True, max_age=max_age)
+
+    response.cache_control.max_age = max_age
+    if private:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    return response
+
+# Ruta de la miniatura de un record a partir de la ruta de su archivo procesado
+def get_thumbnail_file(path, size):
+    suffix = THUMBNAIL_SUFFIXES.get(size)
+    if suffix is None:
+        raise Exception(_('File not found'))
+    return os.path.join(WEB_FILES_PATH, path + suffix)
+
+
+# Versión de la miniatura para armar su url. Cambia cuando se vuelve a procesar el archivo, así la url se puede cachear como inmutable
+def get_thumbnail_version(file):
+    try:
+        return str(int(os.stat(file).st_mtime))
+    except OSError:
+        return None
+
+
+def _thumbnail_serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='record-thumbnail')
+
+
+# Token firmado para pedir la miniatura de un record desde <img>, que no puede enviar la cabecera Authorization. La
+# expiración se redondea para que el token, y con él la url, sea el mismo durante un periodo y el navegador la pueda cachear
+def get_thumbnail_token(record_id, size, user):
+    expires = (int(time.time()) // THUMBNAIL_TOKEN_EXPIRATION + 2) * THUMBNAIL_TOKEN_EXPIRATION
+    return _thumbnail_serializer().dumps({'id': str(record_id), 'size': size, 'user': user, 'exp': expires})
+
+
+# Retorna el usuario del token si es válido para el record y el tamaño, si no None
+def read_thumbnail_token(token, record_id, size):
+    try:
+        data = _thumbnail_serializer().loads(token)
+    except BadSignature:
+        return None
+    if data.get('id') != str(record_id) or data.get('size') != size or data.get('exp', 0) < time.time():
+        return None
+    return data.get('user')
+
+
+def send_thumbnail_file(file, private=True):
+    response = send_web_file(file, private=private, max_age=THUMBNAIL_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+# Clave de un fragmento: depende del archivo de origen (y su versión) y del rango, así un archivo reprocesado genera
+# fragmentos nuevos y los anteriores salen de la cache por antigüedad
+def get_fragment_path(path, record_id, start, end):
+    version = str(int(os.stat(path).st_mtime))
+    payload = json.dumps([str(record_id), os.path.basename(path), version, round(start, 3), round(end, 3)])
+    key = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    return os.path.join(WEB_FILES_PATH, FRAGMENTS_CACHE_DIR, key[:2], key + os.path.splitext(path)[1])
+
+
+# Último keyframe del video en o antes de start, buscándolo solo en los segundos previos
+def get_keyframe_before(path, start):
+    try:
+        probe = ffmpeg.probe(path, select_streams='v:0', skip_frame='nokey', show_entries='frame=pts_time,best_effort_timestamp_time',
+                             read_intervals='%s%%%s' % (max(start - FRAGMENTS_KEYFRAME_WINDOW, 0), start + 0.001))
+    except ffmpeg.Error:
+        return None
+
+    keyframes = []
+    for frame in probe.get('frames', []):
+        value = frame.get('pts_time', frame.get('best_effort_timestamp_time'))
+        try:
+            keyframes.append(float(value))
+        except (TypeError, ValueError):
+            continue
+    keyframes = [k for k in keyframes if k <= start]
+    return max(keyframes) if keyframes else None
+
+
+# Genera el fragmento. El mp3 se puede cortar en cualquier frame, así que siempre se copia. El video se copia sin
+# recodificar si hay un keyframe a menos de FRAGMENTS_KEYFRAME_TOLERANCE segundos del inicio; si no, se recodifica
+def render_fragment(path, output, start, end):
+    if path.endswith('.mp3'):
+        stream = ffmpeg.input(path, ss=start).output(output, t=end - start, acodec='copy')
+    else:
+        keyframe = get_keyframe_before(path, start)
+        if keyframe is not None and start - keyframe <= FRAGMENTS_KEYFRAME_TOLERANCE:
+            stream = ffmpeg.input(path, ss=keyframe).output(
+                output, t=end - keyframe, c='copy', movflags='faststart', avoid_negative_ts='make_zero')
+        else:
+            stream = ffmpeg.input(path).output(
+                output,
+                ss=start,
+                t=end - start,
+                vcodec='libx264',
+                acodec='aac',
+                movflags='faststart',
+                avoid_negative_ts='make_zero',
+                **{'fflags': '+genpts'}
+            )
+    stream.overwrite_output().run(capture_stdout=True, capture_stderr=True)
+
+
+# Retorna la ruta del fragmento en la cache de disco, generándolo si no existe. Los fragmentos servidos se tocan
+# para que la limpieza descarte primero los menos usados
+def get_media_fragment(path, record_id, start, end):
+    output = get_fragment_path(path, record_id, start, end)
+    if os.path.exists(output):
+        try:
+            os.utime(output)
+        except OSError:
+            pass
+        return output
+
+    # se escribe en un temporal y se mueve, para que otra petición no sirva un archivo a medio escribir
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(output), prefix=os.path.basename(output) + '.', suffix='.tmp' + os.path.splitext(path)[1])
+    os.close(fd)
+    try:
+        render_fragment(path, tmp, start, end)
+        if not os.path.exists(tmp) or os.path.getsize(tmp) == 0:
+            raise Exception('ffmpeg failed to produce output')
+        os.replace(tmp, output)
+    except ffmpeg.Error as e:
+        raise Exception(e.stderr.decode('utf-8', errors='replace') if e.stderr else str(e))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    # recorrer la cache es caro, así que se limpia como mucho una vez cada FRAGMENTS_TRIM_INTERVAL segundos
+    if cacheHandler.cache.client.set(FRAGMENTS_TRIM_LOCK, os.getpid(), nx=True, ex=FRAGMENTS_TRIM_INTERVAL):
+        trim_fragments_cache()
+    return output
+
+
+# Borra los fragmentos menos usados hasta que la cache quede bajo FRAGMENTS_CACHE_SIZE bytes
+def trim_fragments_cache():
+    files = []
+    total = 0
+    for root, dirs, names in os.walk(os.path.join(WEB_FILES_PATH, FRAGMENTS_CACHE_DIR)):
+        for name in names:
+            if '.tmp' in name:
+                continue
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+            total += stat.st_size
+
+    for mtime, size, file in sorted(files):
+        if total <= FRAGMENTS_CACHE_SIZE:
+            break
+        try:
+            os.remove(file)
+            total -= size
+        except OSError:
+            pass
+
+
+def send_media_fragment(file, private=True, as_attachment=False):
+    response = send_web_file(file, private=private, max_age=FRAGMENTS_MAX_AGE)
+    if as_attachment:
+        response.headers['Content-Disposition'] = 'attachment; filename=' + os.path.basename(file)
+    return response
+
+
+# Segmentos de la lista HLS de un video, con su inicio y duración en segundos
+def get_hls_segments(path):
+    playlist = path + HLS_SUFFIX + '/index.m3u8'
+    if not os.path.exists(playlist):
+        return None
+
+    segments = []
+    position = 0.0
+    duration = None
+    with open(playlist, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#EXTINF:'):
+                duration = float(line[len('#EXTINF:'):].split(',')[0])
+            elif line and not line.startswith('#') and duration is not None:
+                segments.append({'name': line, 'start': position, 'duration': duration})
+                position += duration
+                duration = None
+    return segments
+
+
+# Lista HLS con solo los segmentos que se cruzan con el rango. Los segmentos ya están generados, así que el
+# fragmento no requiere codificar nada; el reproductor recibe en start_offset dónde empieza el rango en el primero
+def get_hls_slice(segments, start, end, segment_url):
+    if start is not None and end is not None:
+        segments = [s for s in segments if s['start'] < end and s['start'] + s['duration'] > start]
+    if not segments:
+        return None
+
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:3',
+        '#EXT-X-TARGETDURATION:' + str(math.ceil(max(s['duration'] for s in segments))),
+        '#EXT-X-MEDIA-SEQUENCE:0',
+        '#EXT-X-PLAYLIST-TYPE:VOD',
+    ]
+    if start is not None:
+        lines.append('#EXT-X-START:TIME-OFFSET=%.3f,PRECISE=YES' % max(start - segments[0]['start'], 0))
+    for s in segments:
+        lines.append('#EXTINF:%.6f,' % s['duration'])
+        lines.append(segment_url(s['name']))
+    lines.append('#EXT-X-ENDLIST')
+
+    response = Response('\n'.join(lines) + '\n', mimetype='application/vnd.apple.mpegurl')
+    response.cache_control.max_age = FRAGMENTS_MAX_AGE
+    return response
+
+
+def get_hls_segment_file(path, segment):
+    if segment != os.path.basename(segment) or not segment.endswith('.ts'):
+        raise Exception(_('File not found'))
+    file = os.path.join(path + HLS_SUFFIX, segment)
+    if not os.path.exists(file):
+        raise Exception(_('File not found'))
+    return file
+
+# Ruta del archivo de un record según el tipo de descarga: el original o la versión de consulta
+def get_download_path(record, type):
+    if type == 'original':
+        return os.path.join(ORIGINAL_FILES_PATH, record['filepath'])
+
+    path = os.path.join(WEB_FILES_PATH, record['processing']['fileProcessing']['path'])
+    if record['processing']['fileProcessing']['type'] == 'image':
+        path = path + '_large.jpg'
+    elif record['processing']['fileProcessing']['type'] == 'audio':
+        path = path + '.mp3'
+    elif record['processing']['fileProcessing']['type'] == 'video':
+        path = path + '.mp4'
+    elif record['processing']['fileProcessing']['type'] == 'document':
+        path = os.path.join(ORIGINAL_FILES_PATH, record['filepath'])
+    return path
+
+# Listado (ruta, nombre en el zip) de los archivos existentes de un conjunto de records
+def get_zip_entries(records, type):
+    entries = []
+    for record in records:
+        if not record.get('filepath'):
+            continue
+        path = get_download_path(record, type)
+        if os.path.isfile(path):
+            entries.append((path, record['name']))
+    return entries
+
+# Hash del contenido del zip: cambia si cambia algún archivo, su nombre o su fecha de modificación
+def zip_entries_hash(entries):
+    digest = hashlib.sha1()
+    for path, name in entries:
+        stat = os.stat(path)
+        digest.update((path + '\0' + name + '\0' + str(stat.st_size) + '\0' + str(stat.st_mtime_ns) + '\n').encode('utf-8'))
+    return digest.hexdigest()
+
+def get_zip_path(entries):
+    return os.path.join(WEB_FILES_PATH, 'zipfiles', zip_entries_hash(entries) + '.zip')
+
+class _ZipStreamBuffer(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+# Genera el zip por bloques a medida que se leen los archivos. El buffer no es seekable, así que zipfile
+# escribe los tamaños y el crc al final de cada entrada y no hace falta tener el zip completo en disco
+def stream_zip(entries):
+    buffer = _ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', allowZip64=True) as zipf:
+        for path, name in entries:
+            info = zipfile.ZipInfo.from_file(path, name)
+            if os.path.splitext(name)[1].lower() in ZIP_STORED_EXTENSIONS or os.path.splitext(path)[1].lower() in ZIP_STORED_EXTENSIONS:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+
+            with open(path, 'rb') as source, zipf.open(info, 'w') as dest:
+                while True:
+                    chunk = source.read(ZIP_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    yield buffer.pop()
+            yield buffer.pop()
+    yield buffer.pop()
+
+# Escribe en la caché (zippath) lo que se va enviando. El temporal se renombra solo si el zip se envió completo
+def _cache_zip_stream(entries, zippath):
+    os.makedirs(os.path.dirname(zippath), exist_ok=True)
+    temp_path = zippath + '.' + str(os.getpid()) + '.' + uuid.uuid4().hex + '.tmp'
+    completed = False
+    try:
+        with open(temp_path, 'wb') as f:
+            for chunk in stream_zip(entries):
+                f.write(chunk)
+                yield chunk
+        os.replace(temp_path, zippath)
+        completed = True
+    finally:
+        if not completed and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def send_zip_stream(entries, filename, zippath=None):
+    stream = _cache_zip_stream(entries, zippath) if zippath else stream_zip(entries)
+    response = Response(stream_with_context(stream), mimetype='application/zip', direct_passthrough=True)
+    response.headers['Content-Disposition'] = 'attachment; filename="' + filename + '"'
+    response.cache_control.no_store = True
+    return response
+
+# Escribe el zip en zippath. Se escribe a un archivo temporal y se renombra, de modo que un zip
+# a medio generar nunca se sirve desde la caché
+def write_zip(entries, zippath):
+    os.makedirs(os.path.dirname(zippath), exist_ok=True)
+    temp_path = zippath + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'wb') as f:
+        for chunk in stream_zip(entries):
+            f.write(chunk)
+    os.replace(temp_path, zippath)
+    return zippath
+
+def _zip_serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='zip-download')
+
+# Token firmado para descargar un zip generado en segundo plano; expira después de ZIP_DOWNLOAD_EXPIRATION segundos
+def get_zip_download_token(zippath, filename):
+    return _zip_serializer().dumps({'zip': os.path.basename(zippath), 'filename': filename})
+
+def read_zip_download_token(token):
+    data = _zip_serializer().loads(token, max_age=ZIP_DOWNLOAD_EXPIRATION)
+    return os.path.join(WEB_FILES_PATH, 'zipfiles', os.path.basename(data['zip'])), data['filename']
+
+@cacheHandler.local()
+@cacheHandler.tagged('type')
 def cache_type_roles(slug):
     try:
         # Obtener el tipo de contenido por su slug
@@ -1132,6 +1896,7 @@ def cache_type_roles(slug):
         raise Exception(
             _('Error while getting the access_rights record: {error}', error=str(e)))
     
+@cacheHandler.local()
 @cacheHandler.cache.cache()
 def has_right(username, right):
     user = mongodb.get_record('users', {'username': username})
@@ -1144,6 +1909,7 @@ def has_right(username, right):
     # Si el usuario no tiene el rol, retornar False
     return False
 
+@cacheHandler.local()
 @cacheHandler.cache.cache()
 def has_role(username, role):
     user = mongodb.get_record('users', {'username': username})
@@ -1160,4 +1926,255 @@ def find_by_id(data_array, id_value):
     for item in data_array:
         if item.get('id') == id_value:
             return item
-    return None
\ No newline at end of file
+    return None
+
+
+# Valor de un campo con notación de puntos dentro de un documento
+def get_nested_value(doc, path):
+    for key in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+
+# Token opaco con la posición de un documento en un listado ordenado por (campo, _id)
+def encode_cursor(doc, sort_field, direction):
+    cursor = {'v': get_nested_value(doc, sort_field), 'id': doc['_id'], 'd': direction}
+    return base64.urlsafe_b64encode(json_util.dumps(cursor).encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(token):
+    try:
+        cursor = json_util.loads(base64.urlsafe_b64decode(token.encode('utf-8')).decode('utf-8'))
+        if cursor['d'] not in ('next', 'prev'):
+            raise ValueError()
+        return cursor
+    except Exception:
+        raise Exception(_('Invalid cursor'))
+
+
+# Filtro de los documentos que van después de (value, id) al recorrer el listado en la dirección indicada.
+# Los valores nulos o ausentes van primero en orden ascendente y al final en orden descendente
+def keyset_filter(field, direction, value, id):
+    op = '$gt' if direction == 1 else '$lt'
+    if field == '_id':
+        return {'_id': {op: id}}
+    if value is None:
+        if direction == 1:
+            return {'$or': [{field: None, '_id': {op: id}}, {field: {'$ne': None}}]}
+        return {field: None, '_id': {op: id}}
+
+    conditions = [{field: {op: value}}, {field: value, '_id': {op: id}}]
+    if direction == -1:
+        conditions.append({field: None})
+    return {'$or': conditions}
+
+
+# Pagina un listado por (campo de orden, _id) en lugar de usar skip, así el costo de una página no depende de su profundidad.
+# Retorna los documentos de la página y los tokens de la página siguiente y la anterior (None si no hay)
+def get_keyset_page(collection, filters, sort_field, sort_direction, limit, cursor=None, fields={}):
+    backwards = False
+    direction = sort_direction
+    query = filters
+    if cursor:
+        position = decode_cursor(cursor)
+        backwards = position['d'] == 'prev'
+        direction = -sort_direction if backwards else sort_direction
+        query = {'$and': [filters, keyset_filter(sort_field, direction, position['v'], position['id'])]}
+
+    fields = dict(fields)
+    hide_id = fields.pop('_id', 1) == 0
+    if fields and any(v for v in fields.values()):
+        fields[sort_field] = 1
+
+    sort = [(sort_field, direction)]
+    if sort_field != '_id':
+        sort.append(('_id', direction))
+
+    items = list(mongodb.get_all_records(collection, query, sort=sort, limit=limit + 1, fields=fields))
+    more = len(items) > limit
+    items = items[:limit]
+    if backwards:
+        items.reverse()
+
+    has_next = True if backwards else more
+    has_prev = more if backwards else bool(cursor)
+    next_cursor = encode_cursor(items[-1], sort_field, 'next') if items and has_next else None
+    prev_cursor = encode_cursor(items[0], sort_field, 'prev') if items and has_prev else None
+
+    if hide_id:
+        for item in items:
+            item.pop('_id', None)
+
+    return items, next_cursor, prev_cursor
+
+
+def counter_key(collection, field, value):
+    return collection + ':' + field + ':' + str(value)
+
+
+# Total de un listado. Sin filtros se usa el conteo estimado de la colección; con un solo filtro de igualdad sobre uno
+# de los campos contados se usa un contador incremental. En otro caso se cuenta con fallback (si se pasa) o count_documents
+def count_total(collection, filters, counted_fields=(), fallback=None):
+    if not filters:
+        return mongodb.estimated_count(collection)
+
+    if len(filters) == 1:
+        field, value = next(iter(filters.items()))
+        if field in counted_fields and isinstance(value, str):
+            return get_counter(collection, field, value)
+
+    if fallback:
+        return fallback(json.dumps(filters))
+    return mongodb.count(collection, filters)
+
+
+# Los contadores se crean con un conteo real la primera vez que se leen y se recalculan cada COUNTER_REFRESH segundos,
+# lo que acota la diferencia por borrados que no pasan por update_counters (por ejemplo los índices TTL)
+def get_counter(collection, field, value):
+    key = counter_key(collection, field, value)
+    counter = mongodb.get_record(COUNTERS_COLLECTION, {'_id': key})
+    now = datetime.datetime.now()
+    if counter and counter.get('refreshedAt') and (now - counter['refreshedAt']).total_seconds() < COUNTER_REFRESH:
+        return counter['count']
+
+    count = mongodb.count(collection, {field: value})
+    mongodb.update_record_operator(COUNTERS_COLLECTION, {'_id': key}, {'$set': {'count': count, 'refreshedAt': now}}, upsert=True)
+    return count
+
+
+# Suma (o resta con sign=-1) los documentos insertados o eliminados a los contadores que ya existen
+def update_counters(collection, docs, counted_fields, sign=1):
+    totals = {}
+    for doc in docs:
+        for field in counted_fields:
+            value = doc.get(field)
+            if isinstance(value, str):
+                key = counter_key(collection, field, value)
+                totals[key] = totals.get(key, 0) + sign
+
+    if not totals:
+        return
+    try:
+        mongodb.bulk_write(COUNTERS_COLLECTION, [UpdateOne({'_id': key}, {'$inc': {'count': n}}) for key, n in totals.items()])
+    except Exception as e:
+        print(str(e))
+
+
+# Estadísticas de los records que cumplen el filtro: total y conteo por tipo de archivo en una sola agregación. Con
+# file_types se retornan solo esos tipos, con conteo 0 para los que no tienen records
+def compute_records_stats(filters, file_types=None):
+    result = list(mongodb.aggregate('records', [
+        {'$match': filters},
+        {'$facet': {
+            'total': [{'$count': 'count'}],
+            'types': [
+                {'$group': {'_id': '$processing.fileProcessing.type', 'count': {'$sum': 1}}},
+                {'$sort': {'count': -1}}
+            ]
+        }}
+    ]))
+    facet = result[0] if result else {'total': [], 'types': []}
+    total = facet['total'][0]['count'] if facet['total'] else 0
+    data = facet['types']
+
+    if file_types is not None:
+        counts = {t['_id']: t['count'] for t in data}
+        data = [{'_id': t, 'count': counts.get(t, 0)} for t in file_types]
+        data.sort(key=lambda x: x['count'], reverse=True)
+
+    return {'total': total, 'data': data}
+
+
+# Número de recursos publicados de cada tipo en una sola agregación
+def compute_resources_stats(post_types):
+    counts = {p: 0 for p in post_types}
+    for r in mongodb.aggregate('resources', [
+        {'$match': {'post_type': {'$in': list(post_types)}, 'status': 'published'}},
+        {'$group': {'_id': '$post_type', 'count': {'$sum': 1}}}
+    ]):
+        counts[r['_id']] = r['count']
+    return {'counts': counts}
+
+
+STATS_BUILDERS = {
+    'records': lambda params: compute_records_stats(json_util.loads(params['filters']), params.get('file_types')),
+    'resources': lambda params: compute_resources_stats(params['post_types']),
+}
+
+
+# Retorna las estadísticas materializadas de key. Si no existen se calculan y se guardan junto con sus dependencias
+# (tipos de post y recursos padre), que sirven para marcarlas como desactualizadas. Las desactualizadas se siguen
+# sirviendo hasta que refresh_stats las recalcula
+def get_materialized_stats(key, kind, params, post_types=(), parents=()):
+    stats = mongodb.get_record(STATS_COLLECTION, {'_id': key})
+    if stats and stats.get('params') == params and not _stats_expired(stats):
+        return stats['value']
+
+    value = STATS_BUILDERS[kind](params)
+    mongodb.update_record_operator(STATS_COLLECTION, {'_id': key}, {'$set': {
+        'kind': kind,
+        'params': params,
+        'post_types': list(post_types),
+        'parents': [str(p) for p in parents],
+        'value': value,
+        'stale': False,
+        'refreshedAt': datetime.datetime.now()
+    }}, upsert=True)
+    return value
+
+
+def _stats_expired(stats):
+    refreshed = stats.get('refreshedAt')
+    return not refreshed or refreshed < datetime.datetime.now() - datetime.timedelta(seconds=STATS_MAX_AGE)
+
+
+# Marca como desactualizadas las estadísticas que dependen de alguno de los tipos de post o recursos padre. Sin
+# argumentos se marcan todas
+def mark_stats_stale(post_types=(), parents=()):
+    post_types = [p for p in post_types if p]
+    parents = [str(p) for p in parents if p]
+    if post_types or parents:
+        filters = {'$or': [{'post_types': {'$in': post_types}}, {'parents': {'$in': parents}}]}
+    else:
+        filters = {}
+    try:
+        mongodb.update_records(STATS_COLLECTION, filters, {'stale': True, 'staleAt': datetime.datetime.now()})
+    except Exception as e:
+        print(str(e))
+
+
+# Marca como desactualizadas las estadísticas de los padres de los records, por ejemplo cuando cambia su tipo de archivo
+def mark_records_stats_stale(ids):
+    post_types = set()
+    parents = set()
+    for r in mongodb.get_all_records('records', {'_id': {'$in': [ObjectId(i) for i in ids]}}, fields={'parent': 1, 'parents': 1}):
+        for p in r.get('parent', []) + r.get('parents', []):
+            if isinstance(p, dict):
+                post_types.add(p.get('post_type'))
+                parents.add(p.get('id'))
+    if post_types or parents:
+        mark_stats_stale(post_types, parents)
+
+
+# Recalcula las estadísticas desactualizadas o calculadas hace más de STATS_MAX_AGE segundos. Si se vuelven a marcar
+# mientras se calculan quedan desactualizadas para la siguiente ejecución. Retorna el número de estadísticas recalculadas
+def refresh_stats(limit=STATS_REFRESH_BATCH):
+    refreshed = 0
+    expired = datetime.datetime.now() - datetime.timedelta(seconds=STATS_MAX_AGE)
+    filters = {'$or': [{'stale': True}, {'refreshedAt': {'$lt': expired}}]}
+    for stats in mongodb.get_all_records(STATS_COLLECTION, filters, limit=limit):
+        try:
+            value = STATS_BUILDERS[stats['kind']](stats['params'])
+        except Exception as e:
+            print(str(e))
+            continue
+
+        update = {'value': value, 'refreshedAt': datetime.datetime.now()}
+        result = mongodb.update_record_operator(STATS_COLLECTION, {'_id': stats['_id'], 'staleAt': stats.get('staleAt')},
+                                                {'$set': {**update, 'stale': False}})
+        if result.matched_count == 0:
+            mongodb.update_record_operator(STATS_COLLECTION, {'_id': stats['_id']}, {'$set': update})
+        refreshed += 1
+    return refreshed
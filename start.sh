@@ -51,7 +51,9 @@ while true; do
       echo "Running Flask in development mode"
       flask run --host=0.0.0.0 &
   elif [ "$FLASK_ENV" = "PROD" ]; then
-      gunicorn -w ${GUNICORN_WORKERS} -b 0.0.0.0:${FLASK_RUN_PORT} app:app &
+      # los streams de eventos (/tasks/events) ocupan un hilo mientras están abiertos, así que necesitan workers
+      # gthread con varios hilos o workers asíncronos (gevent, eventlet con TASK_EVENTS_ASYNC_WORKERS=true)
+      gunicorn -w ${GUNICORN_WORKERS} -k ${GUNICORN_WORKER_CLASS:-sync} --threads ${GUNICORN_THREADS:-1} -b 0.0.0.0:${FLASK_RUN_PORT} app:app &
   else
       echo "Unknown FLASK_ENV: ${FLASK_ENV}"
       exit 1